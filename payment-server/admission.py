@@ -0,0 +1,197 @@
+# admission.py - admission control and load shedding shared by the payment server and the WhatsApp bot
+import functools
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from structured_logging import get_logger, sample
+
+log = get_logger("admission")
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+# Requests handled at once by one process before new ones get 503 (0 = no cap)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64"))
+# Token buckets: sustained requests per second and burst size (rate 0 = no limit)
+ADMISSION_IP_RATE = float(os.getenv("ADMISSION_IP_RATE", "5"))
+ADMISSION_IP_BURST = float(os.getenv("ADMISSION_IP_BURST", "20"))
+ADMISSION_NUMBER_RATE = float(os.getenv("ADMISSION_NUMBER_RATE", "0.5"))
+ADMISSION_NUMBER_BURST = float(os.getenv("ADMISSION_NUMBER_BURST", "5"))
+# Use the last X-Forwarded-For hop (added by our own load balancer) as the client IP
+ADMISSION_TRUST_FORWARDED_FOR = os.getenv("ADMISSION_TRUST_FORWARDED_FOR", "0") == "1"
+# Buckets kept per limiter; the least recently used are forgotten first
+ADMISSION_MAX_KEYS = int(os.getenv("ADMISSION_MAX_KEYS", "10000"))
+
+# Never shed: scrapes and health probes must keep working while the service is overloaded
+EXEMPT_ENDPOINTS = {"metrics_endpoint", "static", "healthz", "readyz"}
+EXEMPT_PATHS = {"/metrics", "/healthz", "/readyz"}
+
+
+class TokenBucketLimiter:
+    """One token bucket per key: `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst, max_keys=ADMISSION_MAX_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def acquire(self, key):
+        """Take a token; returns 0.0, or the seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1.0:
+                tokens -= 1.0
+                wait = 0.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class InFlightLimiter:
+    """Counts requests in progress and refuses new ones past `limit`"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.limit and self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+# Limits are per process: with several gunicorn workers a client can get up to
+# workers x the configured rate
+ip_limiter = TokenBucketLimiter(ADMISSION_IP_RATE, ADMISSION_IP_BURST)
+number_limiter = TokenBucketLimiter(ADMISSION_NUMBER_RATE, ADMISSION_NUMBER_BURST)
+in_flight_limiter = InFlightLimiter(ADMISSION_MAX_IN_FLIGHT)
+
+_shed_lock = threading.Lock()
+_shed_counts = {}
+
+
+def record_shed(method, route, reason):
+    """Count and log one rejected request"""
+    with _shed_lock:
+        _shed_counts[(reason, route)] = _shed_counts.get((reason, route), 0) + 1
+    log.warning("Shed %s %s (%s)", method, route, reason, extra=sample())
+
+
+def shed_counts():
+    """{(reason, route): requests shed}, reason being ip_rate, number_rate or in_flight"""
+    with _shed_lock:
+        return dict(_shed_counts)
+
+
+def client_ip(headers, remote_addr):
+    if ADMISSION_TRUST_FORWARDED_FOR:
+        forwarded = headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.split(",")[-1].strip()
+    return remote_addr or "unknown"
+
+
+def check_rate(ip=None, whatsapp=None):
+    """Take a token from the IP and WhatsApp number buckets
+
+    Returns None when the request is admitted, else (reason, retry_after seconds).
+    """
+    if ip is not None:
+        wait = ip_limiter.acquire(ip)
+        if wait:
+            return 'ip_rate', math.ceil(wait)
+    if whatsapp:
+        wait = number_limiter.acquire(str(whatsapp))
+        if wait:
+            return 'number_rate', math.ceil(wait)
+    return None
+
+
+def rejection_body(status_code, retry_after):
+    return {
+        'error': 'Too many requests' if status_code == 429 else 'Server is busy',
+        'retry_after': retry_after
+    }
+
+
+def register_metrics():
+    metrics.gauge('admission_in_flight', 'Requests being handled by this process', lambda: in_flight_limiter.in_flight)
+    metrics.counter('admission_shed_total', 'Requests rejected by admission control, by reason and route',
+                    shed_counts, labelnames=['reason', 'route'])
+
+
+def _reject(status_code, reason, retry_after):
+    from flask import jsonify, request
+
+    record_shed(request.method, request.url_rule.rule if request.url_rule is not None else "unmatched", reason)
+    response = jsonify(rejection_body(status_code, retry_after))
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def install(app):
+    """Cap in-flight requests of a Flask app (503 + Retry-After past the cap) and export shed metrics
+
+    Call after metrics.install so rejected requests are still timed.
+    """
+    register_metrics()
+    if not ADMISSION_ENABLED:
+        return
+
+    from flask import g, request
+
+    @app.before_request
+    def _admit():
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        if not in_flight_limiter.try_acquire():
+            return _reject(503, 'in_flight', 1)
+        g.admission_slot = True
+        return None
+
+    @app.teardown_request
+    def _release(exc):
+        if g.pop('admission_slot', False):
+            in_flight_limiter.release()
+
+
+def limited(per_ip=True, number=None):
+    """Rate limit a Flask view per client IP and/or per WhatsApp number (429 + Retry-After)
+
+    number(json_body) returns the WhatsApp number the request is for, or None
+    to skip the per-number limit.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if ADMISSION_ENABLED:
+                from flask import request
+
+                rejected = check_rate(
+                    client_ip(request.headers, request.remote_addr) if per_ip else None,
+                    number(request.get_json(silent=True)) if number else None
+                )
+                if rejected:
+                    return _reject(429, *rejected)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
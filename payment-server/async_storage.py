@@ -0,0 +1,288 @@
+# async_storage.py - awaitable payment_requests storage for the asyncio payment server
+import asyncio
+import time
+
+from metrics import observe_dependency
+from storage import (ALREADY_IN_STATUS, REQUESTS_COLLECTION, TOMBSTONES_COLLECTION, FirestoreStorage, TimedStorage,
+                     firestore_client_args, import_firebase)
+from structured_logging import get_logger
+
+log = get_logger("async_storage")
+
+# Imported by the first AsyncFirestoreStorage (see storage.import_firebase)
+firestore = None
+NotFound = None
+
+
+class AsyncFirestoreStorage:
+    """The FirestoreStorage operations on Firestore's AsyncClient
+
+    Same documents, counters and tombstones as FirestoreStorage, but every
+    call is awaited on the event loop instead of holding a thread. Firebase
+    must already be initialized (get_storage() does that).
+    """
+
+    name = "firestore"
+
+    def __init__(self, sync_storage):
+        global firestore, NotFound
+        _, firestore, NotFound = import_firebase()
+        self.sync_storage = sync_storage
+        self.db = firestore.AsyncClient(**firestore_client_args())
+        self.collection = self.db.collection(REQUESTS_COLLECTION)
+
+    def describe(self):
+        return f"{self.sync_storage.describe()} via AsyncClient"
+
+    def _stats_ref(self):
+        return self.db.collection('payment_stats').document(REQUESTS_COLLECTION)
+
+    def _tombstone_ref(self, unique_id):
+        return self.db.collection(TOMBSTONES_COLLECTION).document(unique_id)
+
+    _counter_changes = staticmethod(FirestoreStorage._counter_changes)
+    _add_transition = staticmethod(FirestoreStorage._add_transition)
+
+    def _with_timestamps(self, fields, timestamp_fields):
+        return {**fields, **{field: firestore.SERVER_TIMESTAMP for field in timestamp_fields},
+                'updated_at': firestore.SERVER_TIMESTAMP}
+
+    # ---- writes ----
+
+    async def _set_in_transaction(self, transaction, doc_ref, record):
+        snapshot = await doc_ref.get(transaction=transaction)
+        previous_status = (snapshot.to_dict() or {}).get('status') if snapshot.exists else None
+
+        transaction.set(doc_ref, record)
+        transaction.delete(self._tombstone_ref(doc_ref.id))
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, record['status'])
+        changes = self._counter_changes(0 if snapshot.exists else 1, status_deltas)
+        if changes:
+            transaction.set(self._stats_ref(), changes, merge=True)
+
+    async def save_request(self, record):
+        record = self._with_timestamps(record, ['created_at'])
+        doc_ref = self.collection.document(record['unique_id'])
+        await firestore.async_transactional(self._set_in_transaction)(self.db.transaction(), doc_ref, record)
+
+    async def save_requests(self, records):
+        doc_refs = [self.collection.document(record['unique_id']) for record in records]
+        previous_statuses = {
+            snapshot.id: (snapshot.to_dict() or {}).get('status')
+            async for snapshot in self.db.get_all(doc_refs, field_paths=['status'])
+            if snapshot.exists
+        }
+
+        batch = self.db.batch()
+        total_delta = 0
+        status_deltas = {}
+        for doc_ref, record in zip(doc_refs, records):
+            batch.set(doc_ref, self._with_timestamps(record, ['created_at']))
+            batch.delete(self._tombstone_ref(doc_ref.id))
+
+            if doc_ref.id not in previous_statuses:
+                total_delta += 1
+            self._add_transition(status_deltas, previous_statuses.get(doc_ref.id), record['status'])
+
+        changes = self._counter_changes(total_delta, status_deltas)
+        if changes:
+            batch.set(self._stats_ref(), changes, merge=True)
+        await batch.commit()
+
+    async def _update_status_in_transaction(self, transaction, doc_ref, status, timestamp_fields):
+        snapshot = await doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return False
+
+        previous_status = (snapshot.to_dict() or {}).get('status')
+        transaction.update(doc_ref, self._with_timestamps({'status': status}, timestamp_fields))
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, status)
+        changes = self._counter_changes(0, status_deltas)
+        if changes:
+            transaction.set(self._stats_ref(), changes, merge=True)
+        return True
+
+    async def update_status(self, unique_id, status, timestamp_fields=()):
+        doc_ref = self.collection.document(unique_id)
+        return await firestore.async_transactional(self._update_status_in_transaction)(
+            self.db.transaction(), doc_ref, status, timestamp_fields)
+
+    async def update_statuses(self, unique_ids, status):
+        doc_refs = [self.collection.document(unique_id) for unique_id in unique_ids]
+        snapshots = {snapshot.id: snapshot async for snapshot in self.db.get_all(doc_refs, field_paths=['status'])}
+
+        batch = self.db.batch()
+        status_deltas = {}
+        outcome = {}
+        for doc_ref in doc_refs:
+            snapshot = snapshots.get(doc_ref.id)
+            if snapshot is None or not snapshot.exists:
+                outcome[doc_ref.id] = 'Payment request not found'
+                continue
+            previous_status = (snapshot.to_dict() or {}).get('status')
+            if previous_status == status:
+                outcome[doc_ref.id] = ALREADY_IN_STATUS
+                continue
+
+            batch.update(doc_ref, self._with_timestamps({'status': status}, ()),
+                         option=self.db.write_option(last_update_time=snapshot.update_time))
+            outcome[doc_ref.id] = None
+            self._add_transition(status_deltas, previous_status, status)
+
+        changes = self._counter_changes(0, status_deltas)
+        if changes:
+            batch.set(self._stats_ref(), changes, merge=True)
+        if any(error is None for error in outcome.values()):
+            await batch.commit()
+        return outcome
+
+    async def update_fields(self, unique_id, fields, timestamp_fields=()):
+        try:
+            await self.collection.document(unique_id).update(self._with_timestamps(fields, timestamp_fields))
+        except NotFound:
+            return False
+        return True
+
+    async def _delete_in_transaction(self, transaction, doc_ref):
+        snapshot = await doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return False
+        previous_status = (snapshot.to_dict() or {}).get('status')
+
+        transaction.delete(doc_ref)
+        transaction.set(self._tombstone_ref(doc_ref.id), {
+            'unique_id': doc_ref.id,
+            'deleted_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, None)
+        transaction.set(self._stats_ref(), self._counter_changes(-1, status_deltas), merge=True)
+        return True
+
+    async def delete_request(self, unique_id):
+        doc_ref = self.collection.document(unique_id)
+        return await firestore.async_transactional(self._delete_in_transaction)(self.db.transaction(), doc_ref)
+
+    # ---- reads ----
+
+    async def get_request(self, unique_id):
+        snapshot = await self.collection.document(unique_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def record_counts(self):
+        snapshot = await self._stats_ref().get()
+        stats = snapshot.to_dict() if snapshot.exists else None
+        if not stats or 'seeded_at' not in stats:
+            # Seeding runs once per collection; leave it to the sync backend
+            return await asyncio.to_thread(self.sync_storage.record_counts)
+        return {
+            'total': stats.get('total', 0),
+            'status_counts': {status: count for status, count in stats.get('status_counts', {}).items() if count}
+        }
+
+    async def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        query = self.collection
+        if status:
+            query = query.where('status', '==', status)
+        if created_from:
+            query = query.where('created_at', '>=', created_from)
+        if created_to:
+            query = query.where('created_at', '<', created_to)
+
+        query = query.order_by('created_at', direction=firestore.Query.DESCENDING)
+
+        if fields:
+            query = query.select(fields)
+
+        if after:
+            cursor_snapshot = await self.collection.document(after).get()
+            if not cursor_snapshot.exists:
+                raise ValueError('Invalid cursor')
+            query = query.start_after(cursor_snapshot)
+
+        docs = [doc async for doc in query.limit(page_size + 1).stream()]
+        return [(doc.id, doc.to_dict()) for doc in docs[:page_size]], len(docs) > page_size
+
+    def _changes_query(self, collection_name, position, limit, fields=None):
+        query = self.db.collection(collection_name).order_by('updated_at').order_by('__name__')
+        if fields:
+            query = query.select(fields)
+        if position:
+            query = query.start_after({'updated_at': position[0], '__name__': position[1]})
+        return query.limit(limit)
+
+    async def changes(self, position, limit, fields=None):
+        if fields and 'updated_at' not in fields:
+            fields = fields + ['updated_at']
+
+        changes = [
+            (doc.get('updated_at'), doc.id, doc.to_dict(), False)
+            async for doc in self._changes_query(REQUESTS_COLLECTION, position, limit, fields).stream()
+        ]
+        changes += [
+            (doc.get('updated_at'), doc.id, None, True)
+            async for doc in self._changes_query(TOMBSTONES_COLLECTION, position, limit, ['updated_at']).stream()
+        ]
+        changes.sort(key=lambda change: (change[0], change[1]))
+        return changes[:limit]
+
+
+class AsyncTimedStorage:
+    """Times every awaited storage call in dependency_call_duration_seconds"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        for operation in TimedStorage.TIMED_OPERATIONS:
+            if hasattr(backend, operation):
+                setattr(self, operation, self._timed(backend.name, operation, getattr(backend, operation)))
+
+    @staticmethod
+    def _timed(dependency, operation, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                observe_dependency(dependency, operation, time.perf_counter() - start, error=True)
+                raise
+            observe_dependency(dependency, operation, time.perf_counter() - start)
+            return result
+        return timed
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+class ThreadedAsyncStorage:
+    """Awaitable wrapper that runs a sync backend (e.g. SQLite) in the default executor
+
+    Calls are already timed by the wrapped TimedStorage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        for operation in TimedStorage.TIMED_OPERATIONS:
+            setattr(self, operation, self._threaded(getattr(storage, operation)))
+
+    @staticmethod
+    def _threaded(func):
+        async def threaded(*args, **kwargs):
+            return await asyncio.to_thread(func, *args, **kwargs)
+        return threaded
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+def get_async_storage(storage):
+    """Awaitable counterpart of the get_storage() storage: AsyncClient for Firestore, a thread pool otherwise"""
+    if storage.name == "firestore":
+        log.info("Using Firestore AsyncClient")
+        return AsyncTimedStorage(AsyncFirestoreStorage(storage.backend))
+    return ThreadedAsyncStorage(storage)
@@ -0,0 +1,54 @@
+# compare_async.py - benchmark the Flask and asyncio payment servers with the same settings
+#
+# From the payment-server directory:
+#     python -m bench.compare_async --concurrency 64 --requests 2000 --graph-latency-ms 200
+#
+# Runs bench.run_bench once per server (each appends its own block to
+# bench_output.txt), then appends a side-by-side req/s and p99 table.
+import copy
+from datetime import datetime, timezone
+
+from bench.run_bench import build_parser, git_revision, run
+
+VARIANTS = [
+    ("sync", "payment_server:app", "gthread"),
+    ("async", "payment_server_async:app", "aiohttp.GunicornWebWorker"),
+]
+
+
+def main():
+    parser = build_parser()
+    parser.description = "Benchmark payment_server (gthread) against payment_server_async (aiohttp)"
+    args = parser.parse_args()
+
+    results = {}
+    for name, app, worker_class in VARIANTS:
+        print(f"▶ {name}: {app} ({worker_class})")
+        variant_args = copy.copy(args)
+        variant_args.app = app
+        variant_args.worker_class = worker_class
+        results[name] = {row[0]: row for row in run(variant_args)}
+
+    lines = [
+        f"=== sync vs async payment server {datetime.now(timezone.utc).isoformat(timespec='seconds')} "
+        f"(git {git_revision()}) ===",
+        f"workers={args.workers} threads={args.threads} storage={args.storage} "
+        f"storage_latency_ms={args.storage_latency_ms} graph_latency_ms={args.graph_latency_ms} "
+        f"concurrency={args.concurrency} requests={args.requests}",
+        f"{'endpoint':<26} {'sync_req/s':>10} {'async_req/s':>11} {'sync_p99':>9} {'async_p99':>9}",
+    ]
+    for label in results["sync"]:
+        sync_row, async_row = results["sync"][label], results["async"].get(label)
+        if async_row is None:
+            continue
+        lines.append(f"{label:<26} {sync_row[3]:>10.1f} {async_row[3]:>11.1f} "
+                     f"{sync_row[6]:>9.2f} {async_row[6]:>9.2f}")
+
+    report = "\n".join(lines) + "\n\n"
+    with open(args.output, "a") as f:
+        f.write(report)
+    print(report, end="")
+
+
+if __name__ == "__main__":
+    main()
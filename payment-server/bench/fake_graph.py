@@ -0,0 +1,58 @@
+# fake_graph.py - local stand-in for the WhatsApp Graph API with configurable latency
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    """Answers every Graph call the services make with a canned success response"""
+
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, payload):
+        time.sleep(self.server.latency_ms / 1000)
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.counter_lock:
+            self.server.requests += 1
+            request_number = self.server.requests
+
+        if self.path.endswith("/media"):
+            self._respond({"id": f"media-{request_number}"})
+        else:
+            self._respond({"messaging_product": "whatsapp", "messages": [{"id": f"wamid.{request_number}"}]})
+
+    def do_GET(self):
+        with self.server.counter_lock:
+            self.server.requests += 1
+        self._respond({"id": self.path.strip("/").split("/")[-1], "display_phone_number": "0000000000"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients (outbox senders) are killed mid-request when the benchmark stops
+        pass
+
+
+def start_fake_graph(latency_ms=50.0, host="127.0.0.1", port=0):
+    """Serve the fake Graph API on a background thread; returns (server, base_url)"""
+    server = FakeGraphServer((host, port), FakeGraphHandler)
+    server.latency_ms = latency_ms
+    server.requests = 0
+    server.counter_lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, name="fake-graph", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v19.0"
@@ -0,0 +1,97 @@
+# import_time.py - measure how long a service takes to import (its cold start before the first request)
+#
+# From the payment-server directory:
+#     python -m bench.import_time
+#     python -m bench.import_time --module app --chdir ../whatsapp-bot
+#
+# Imports the module in fresh interpreters under `python -X importtime` and
+# appends the median total and the slowest imports made by the module to
+# bench_output.txt, so runs before and after a change can be compared.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+from bench.run_bench import DEFAULT_OUTPUT, SERVER_DIR, git_revision
+
+
+def profile_import(module, chdir, env):
+    """Import `module` once in a new interpreter
+
+    Returns (total seconds of all top-level imports, {direct import of module: cumulative seconds}).
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=chdir, env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    total = 0.0
+    children = {}
+    breakdown = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Nested imports are indented two spaces per level and listed before their parent
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0:
+            total += seconds
+            if name.strip() == module:
+                breakdown = children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = seconds
+    return total, breakdown
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the import time of a service")
+    parser.add_argument("--module", default="payment_server", help="module to import")
+    parser.add_argument("--chdir", default=SERVER_DIR, help="directory the module lives in")
+    parser.add_argument("--storage", default="firestore", help="STORAGE_BACKEND to import with")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to list")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="import-time-") as workdir:
+        env = {
+            **os.environ,
+            "STORAGE_BACKEND": args.storage,
+            "SQLITE_STORAGE_PATH": os.path.join(workdir, "payments.db"),
+            "OUTBOX_DB": os.path.join(workdir, "outbox.db"),
+            "IDEMPOTENCY_DB": os.path.join(workdir, "idempotency.db"),
+            "EXPIRY_SWEEP_LOCK": os.path.join(workdir, "expiry_sweeper.lock"),
+            "PAYMENT_HISTORY_DIR": os.path.join(workdir, "payment_history"),
+            "PAYMENT_CODE_FILE": os.path.join(workdir, "current_payment_code.json"),
+            "LOG_LEVEL": "ERROR",
+        }
+        runs = [profile_import(args.module, os.path.abspath(args.chdir), env) for _ in range(args.runs)]
+
+    totals = [total for total, _ in runs]
+    slowest = sorted(runs[-1][1].items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+    lines = [
+        f"=== import time of {args.module} {datetime.now(timezone.utc).isoformat(timespec='seconds')} "
+        f"(git {git_revision()}) ===",
+        f"storage={args.storage} runs={args.runs} median={statistics.median(totals) * 1000:.1f} ms "
+        f"min={min(totals) * 1000:.1f} ms max={max(totals) * 1000:.1f} ms",
+        f"{'imported by ' + args.module:<40} {'cumulative_ms':>13}",
+    ]
+    for name, seconds in slowest:
+        lines.append(f"{name:<40} {seconds * 1000:>13.1f}")
+
+    report = "\n".join(lines) + "\n\n"
+    with open(args.output, "a") as f:
+        f.write(report)
+    print(report, end="")
+
+
+if __name__ == "__main__":
+    main()
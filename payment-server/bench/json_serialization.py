@@ -0,0 +1,97 @@
+# json_serialization.py - time JSON encoding of a /firestore-data sized payload
+#
+# From the payment-server directory:
+#     python -m bench.json_serialization --records 10000
+#
+# Compares the old response path (every record's timestamps converted to ISO
+# strings one by one, then Flask's default stdlib encoder) with json_provider,
+# with and without orjson, and parsing the same body back. Appends one block to
+# bench_output.txt like the other benchmarks.
+import argparse
+import json
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import json_provider
+from bench.run_bench import DEFAULT_OUTPUT, git_revision, payment_code
+
+
+def firestore_page(records):
+    """A /firestore-data response body with `records` records, timestamps as storage returns them"""
+    now = datetime.now(timezone.utc)
+    data = []
+    for index in range(records):
+        record = payment_code(index, "json")
+        record.update({
+            "created_at": now - timedelta(seconds=index),
+            "updated_at": now - timedelta(seconds=index, microseconds=index),
+            "expiry_time": now + timedelta(minutes=15),
+        })
+        data.append(record)
+    return {"firestore_enabled": True, "total_records": records, "page_size": records, "next_cursor": None,
+            "data": data}
+
+
+def legacy_dumps(payload):
+    """Before json_provider: per-record isoformat() (on copies, as the records were fresh), then jsonify's encoder"""
+    data = []
+    for record in payload["data"]:
+        record = dict(record)
+        for field in ("created_at", "updated_at", "expiry_time"):
+            if field in record and record[field]:
+                record[field] = record[field].isoformat()
+        data.append(record)
+    return json.dumps({**payload, "data": data}, sort_keys=True, separators=(",", ":"))
+
+
+def median_seconds(func, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON encoding of a /firestore-data payload")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    payload = firestore_page(args.records)
+    body = json_provider.dumps_bytes(payload)
+    cases = [
+        ("dumps: per-record isoformat + stdlib json (before)", lambda: legacy_dumps(payload)),
+        ("dumps: json_provider, stdlib fallback", lambda: json_provider.stdlib_dumps(payload)),
+    ]
+    if json_provider.orjson is not None:
+        cases.append(("dumps: json_provider, orjson", lambda: json_provider.dumps_bytes(payload)))
+    cases.append(("loads: stdlib json", lambda: json.loads(body)))
+    if json_provider.orjson is not None:
+        cases.append(("loads: json_provider, orjson", lambda: json_provider.loads(body)))
+
+    results = [(label, median_seconds(func, args.runs)) for label, func in cases]
+    baselines = {"dumps": results[0][1], "loads": next(seconds for label, seconds in results
+                                                       if label.startswith("loads"))}
+
+    lines = [
+        f"=== JSON serialization {datetime.now(timezone.utc).isoformat(timespec='seconds')} "
+        f"(git {git_revision()}) ===",
+        f"records={args.records} runs={args.runs} body={len(body) / 1024:.0f} KiB backend={json_provider.JSON_BACKEND}",
+        f"{'case':<52} {'median_ms':>10} {'speedup':>8}",
+    ]
+    for label, seconds in results:
+        baseline = baselines[label.split(":")[0]]
+        lines.append(f"{label:<52} {seconds * 1000:>10.2f} {baseline / seconds:>7.1f}x")
+
+    report = "\n".join(lines) + "\n\n"
+    with open(args.output, "a") as f:
+        f.write(report)
+    print(report, end="")
+
+
+if __name__ == "__main__":
+    main()
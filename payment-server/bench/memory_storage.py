@@ -0,0 +1,196 @@
+# memory_storage.py - in-memory stand-in for the Firestore backend, used by the benchmarks
+import bisect
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from storage import PaymentStorage, parse_timestamp
+
+# Simulated round trip per storage call, to mimic a remote database
+MEMORY_STORAGE_LATENCY_MS = float(os.getenv("MEMORY_STORAGE_LATENCY_MS", "0"))
+
+
+class MemoryStorage(PaymentStorage):
+    """payment_requests held in process memory
+
+    Select it with STORAGE_BACKEND=bench.memory_storage.MemoryStorage. Every
+    process has its own copy, so benchmark it with a single gunicorn worker.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._tombstones = {}
+        # (created_at, unique_id) ascending, for newest-first pages
+        self._by_created = []
+        # (updated_at, unique_id, deleted) ascending, for delta sync
+        self._by_updated = []
+        self._last_time = None
+
+    def describe(self):
+        return "In-memory (benchmark)"
+
+    def _round_trip(self):
+        if MEMORY_STORAGE_LATENCY_MS:
+            time.sleep(MEMORY_STORAGE_LATENCY_MS / 1000)
+
+    def _now(self):
+        """Strictly increasing timestamps, like Firestore commit times"""
+        now = datetime.now(timezone.utc)
+        if self._last_time is not None and now <= self._last_time:
+            now = self._last_time + timedelta(microseconds=1)
+        self._last_time = now
+        return now
+
+    # ---- index bookkeeping (call with the lock held) ----
+
+    def _remove_from_indexes(self, unique_id):
+        record = self._records.get(unique_id)
+        if record is not None:
+            self._by_created.remove((record['created_at'], unique_id))
+            self._by_updated.remove((record['updated_at'], unique_id, False))
+        tombstone = self._tombstones.pop(unique_id, None)
+        if tombstone is not None:
+            self._by_updated.remove((tombstone, unique_id, True))
+
+    def _put(self, record, created_at, updated_at):
+        unique_id = record['unique_id']
+        self._remove_from_indexes(unique_id)
+        self._records[unique_id] = {**record, 'created_at': created_at, 'updated_at': updated_at}
+        bisect.insort(self._by_created, (created_at, unique_id))
+        bisect.insort(self._by_updated, (updated_at, unique_id, False))
+
+    # ---- writes ----
+
+    def save_request(self, record):
+        self.save_requests([record])
+
+    def save_requests(self, records):
+        self._round_trip()
+        with self._lock:
+            for record in records:
+                now = self._now()
+                self._put(record, now, now)
+
+    def _update(self, unique_id, fields, timestamp_fields):
+        record = self._records.get(unique_id)
+        if record is None:
+            return False
+        now = self._now()
+        self._put({**record, **fields, **{field: now for field in timestamp_fields}}, record['created_at'], now)
+        return True
+
+    def update_status(self, unique_id, status, timestamp_fields=()):
+        self._round_trip()
+        with self._lock:
+            return self._update(unique_id, {'status': status}, timestamp_fields)
+
+    def update_statuses(self, unique_ids, status):
+        self._round_trip()
+        with self._lock:
+            return {
+                unique_id: None if self._update(unique_id, {'status': status}, ()) else 'Payment request not found'
+                for unique_id in unique_ids
+            }
+
+    def update_fields(self, unique_id, fields, timestamp_fields=()):
+        self._round_trip()
+        with self._lock:
+            return self._update(unique_id, fields, timestamp_fields)
+
+    def delete_request(self, unique_id):
+        self._round_trip()
+        with self._lock:
+            if unique_id not in self._records:
+                return False
+            self._remove_from_indexes(unique_id)
+            del self._records[unique_id]
+            now = self._now()
+            self._tombstones[unique_id] = now
+            bisect.insort(self._by_updated, (now, unique_id, True))
+            return True
+
+    # ---- reads ----
+
+    def get_request(self, unique_id):
+        self._round_trip()
+        with self._lock:
+            record = self._records.get(unique_id)
+            return dict(record) if record is not None else None
+
+    def record_counts(self):
+        self._round_trip()
+        with self._lock:
+            status_counts = {}
+            for record in self._records.values():
+                status = record.get('status')
+                if status:
+                    status_counts[status] = status_counts.get(status, 0) + 1
+            return {'total': len(self._records), 'status_counts': status_counts}
+
+    def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        self._round_trip()
+        with self._lock:
+            end = len(self._by_created)
+            if after:
+                record = self._records.get(after)
+                if record is None:
+                    raise ValueError('Invalid cursor')
+                end = bisect.bisect_left(self._by_created, (record['created_at'], after))
+
+            page = []
+            for index in range(end - 1, -1, -1):
+                created_at, unique_id = self._by_created[index]
+                if created_from and created_at < created_from:
+                    break
+                if created_to and created_at >= created_to:
+                    continue
+                record = self._records[unique_id]
+                if status and record.get('status') != status:
+                    continue
+                if len(page) == page_size:
+                    return page, True
+                page.append((unique_id, {field: record[field] for field in fields if field in record}
+                             if fields else dict(record)))
+            return page, False
+
+    def changes(self, position, limit, fields=None):
+        self._round_trip()
+        with self._lock:
+            start = bisect.bisect_right(self._by_updated, (position[0], position[1], True)) if position else 0
+            changes = []
+            for updated_at, unique_id, deleted in self._by_updated[start:start + limit]:
+                if deleted:
+                    changes.append((updated_at, unique_id, None, True))
+                    continue
+                record = self._records[unique_id]
+                if fields:
+                    record = {field: record[field] for field in fields + ['updated_at'] if field in record}
+                changes.append((updated_at, unique_id, dict(record), False))
+            return changes
+
+    def current_pending_request(self, now):
+        self._round_trip()
+        with self._lock:
+            best = None
+            for unique_id, record in self._records.items():
+                expiry_time = parse_timestamp(record.get('expiry_time'))
+                if record.get('status') == 'pending' and expiry_time and expiry_time > now:
+                    if best is None or expiry_time > best[0]:
+                        best = (expiry_time, unique_id)
+            return (best[1], dict(self._records[best[1]])) if best else None
+
+    def expire_pending_requests(self, now, limit):
+        self._round_trip()
+        with self._lock:
+            due = sorted(
+                (expiry_time, unique_id) for unique_id, record in self._records.items()
+                if record.get('status') == 'pending'
+                and (expiry_time := parse_timestamp(record.get('expiry_time'))) and expiry_time <= now
+            )[:limit]
+            for _, unique_id in due:
+                self._update(unique_id, {'status': 'expired'}, ['expired_at'])
+            return [unique_id for _, unique_id in due]
@@ -0,0 +1,271 @@
+# run_bench.py - run the payment server under gunicorn and measure its endpoints
+#
+# From the payment-server directory:
+#     python -m bench.run_bench --concurrency 16 --requests 2000 --graph-latency-ms 50
+#
+# Storage is the in-memory MemoryStorage and WhatsApp calls go to a local fake
+# Graph API, so no network access or credentials are needed. Each run appends
+# one block to bench_output.txt (repository root) so runs can be compared.
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from bench.fake_graph import start_fake_graph
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(SERVER_DIR), "bench_output.txt")
+
+STORAGE_BACKENDS = {
+    "memory": "bench.memory_storage.MemoryStorage",
+    "sqlite": "sqlite",
+}
+
+
+def payment_code(index, run_id):
+    now = datetime.now(timezone.utc)
+    return {
+        "unique_id": f"bench-{run_id}-{index}",
+        "first_name": "Bench",
+        "last_name": f"User{index}",
+        "email": f"bench{index}@example.com",
+        "whatsapp": f"91{9000000000 + index}",
+        "customer_upi_id": "bench@upi",
+        "timestamp": now.isoformat(),
+        "expiry_time": (now + timedelta(minutes=15)).isoformat(),
+        "status": "pending",
+    }
+
+
+def scenarios(run_id):
+    """(label, function(session, base_url, index) -> response), run in this order"""
+    return [
+        ("POST /save-payment-code",
+         lambda session, base, i: session.post(f"{base}/save-payment-code", json=payment_code(i, run_id))),
+        ("POST /confirm-payment",
+         lambda session, base, i: session.post(f"{base}/confirm-payment", json={
+             "uniqueId": f"bench-{run_id}-{i}", "firstName": "Bench", "lastName": f"User{i}",
+             "whatsapp": f"91{9000000000 + i}"})),
+        ("GET /firestore-data",
+         lambda session, base, i: session.get(f"{base}/firestore-data", params={"page_size": 100})),
+        ("GET /payment-history",
+         lambda session, base, i: session.get(f"{base}/payment-history", params={"limit": 50})),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def drive(call, base_url, total, concurrency):
+    """Send `total` requests from `concurrency` threads; returns (latencies, errors, elapsed)"""
+    latencies = []
+    errors = [0]
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next_index[0]
+                if index >= total:
+                    return
+                next_index[0] += 1
+
+            start = time.perf_counter()
+            try:
+                ok = call(session, base_url, index).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors[0], time.perf_counter() - start
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid):
+    """pid and all its descendants (Linux /proc)"""
+    pids = [pid]
+    for candidate in pids:
+        try:
+            with open(f"/proc/{candidate}/task/{candidate}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_kib(pids):
+    """Sum of the peak resident set sizes (VmHWM) of the given processes, or None off Linux"""
+    total = 0
+    found = False
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+                        found = True
+        except OSError:
+            pass
+    return total if found else None
+
+
+def start_server(args, graph_base_url, workdir):
+    port = free_port()
+    env = {
+        **os.environ,
+        "STORAGE_BACKEND": STORAGE_BACKENDS.get(args.storage, args.storage),
+        "SQLITE_STORAGE_PATH": os.path.join(workdir, "payments.db"),
+        "GRAPH_API_BASE": graph_base_url,
+        "OUTBOX_DB": os.path.join(workdir, "outbox.db"),
+        "IDEMPOTENCY_DB": os.path.join(workdir, "idempotency.db"),
+        "EXPIRY_SWEEP_LOCK": os.path.join(workdir, "expiry_sweeper.lock"),
+        "PAYMENT_HISTORY_DIR": os.path.join(workdir, "payment_history"),
+        "PAYMENT_CODE_FILE": os.path.join(workdir, "current_payment_code.json"),
+        "MEMORY_STORAGE_LATENCY_MS": str(args.storage_latency_ms),
+        # Every bench request comes from one IP, so the per-IP limit would shed nearly all of them
+        "ADMISSION_ENABLED": "1" if args.admission else "0",
+    }
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers),
+        "--worker-class", args.worker_class,
+        "--threads", str(args.threads),
+        "--chdir", SERVER_DIR,
+        "--log-level", "warning",
+        args.app,
+    ]
+    server = subprocess.Popen(command, env=env, cwd=SERVER_DIR,
+                              stdout=subprocess.DEVNULL if not args.verbose else None,
+                              stderr=subprocess.DEVNULL if not args.verbose else None)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            requests.get(f"{base_url}/get-upi-config", timeout=1)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 30 seconds")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def run(args):
+    graph_server, graph_base_url = start_fake_graph(args.graph_latency_ms)
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+
+    with tempfile.TemporaryDirectory(prefix="payment-bench-") as workdir:
+        server, base_url = start_server(args, graph_base_url, workdir)
+        try:
+            rows = []
+            for label, call in scenarios(run_id):
+                if args.only and not any(name in label for name in args.only):
+                    continue
+                latencies, errors, elapsed = drive(call, base_url, args.requests, args.concurrency)
+                rows.append((label, len(latencies), errors, len(latencies) / elapsed if elapsed else 0.0,
+                             percentile(latencies, 0.50) * 1000,
+                             percentile(latencies, 0.95) * 1000,
+                             percentile(latencies, 0.99) * 1000))
+                print(f"  {label}: {rows[-1][3]:.1f} req/s, p99 {rows[-1][6]:.2f} ms, {errors} errors")
+
+            pids = process_tree(server.pid)
+            rss = peak_rss_kib(pids)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            graph_server.shutdown()
+
+    lines = [
+        f"=== payment-server benchmark {datetime.now(timezone.utc).isoformat(timespec='seconds')} "
+        f"(git {git_revision()}) ===",
+        f"app={args.app} workers={args.workers} worker_class={args.worker_class} threads={args.threads} "
+        f"storage={args.storage} storage_latency_ms={args.storage_latency_ms} "
+        f"graph_latency_ms={args.graph_latency_ms} concurrency={args.concurrency} requests={args.requests} "
+        f"admission={'on' if args.admission else 'off'}",
+        f"{'endpoint':<26} {'reqs':>6} {'errors':>6} {'req/s':>9} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8}",
+    ]
+    for label, count, errors, rps, p50, p95, p99 in rows:
+        lines.append(f"{label:<26} {count:>6} {errors:>6} {rps:>9.1f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+    lines.append(f"peak RSS: {rss / 1024:.1f} MiB across {len(pids)} processes" if rss is not None
+                 else "peak RSS: n/a")
+    lines.append(f"fake Graph API calls: {graph_server.requests}")
+
+    report = "\n".join(lines) + "\n\n"
+    with open(args.output, "a") as f:
+        f.write(report)
+    print(report, end="")
+    print(f"📄 Results appended to {args.output}")
+    return rows
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the payment server endpoints under gunicorn")
+    parser.add_argument("--app", default="payment_server:app",
+                        help="app to serve (payment_server_async:app with --worker-class aiohttp.GunicornWebWorker)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="gunicorn workers (memory storage is per process, so keep 1 unless --storage sqlite)")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--storage", default="memory",
+                        help="memory, sqlite or a STORAGE_BACKEND dotted path")
+    parser.add_argument("--storage-latency-ms", type=float, default=0.0,
+                        help="simulated round trip per memory storage call")
+    parser.add_argument("--graph-latency-ms", type=float, default=50.0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--only", nargs="*", help="only run endpoints whose label contains one of these")
+    parser.add_argument("--admission", action="store_true",
+                        help="keep admission control on (shed requests count as errors)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--verbose", action="store_true", help="show gunicorn output")
+    return parser
+
+
+def main():
+    run(build_parser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
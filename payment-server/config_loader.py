@@ -0,0 +1,98 @@
+# config_loader.py - frozen config.py snapshot, rebuilt only when config.py changes or on SIGHUP
+import importlib.util
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+
+from structured_logging import get_logger
+
+log = get_logger("config_loader")
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.py")
+
+# How often get_config() may stat config.py to look for changes
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1.0"))
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Immutable view of the values both services read from config.py"""
+    verify_token: str
+    access_token: str
+    phone_number_id: str
+    upi_config: MappingProxyType
+    firebase_credentials: MappingProxyType
+    version: tuple
+
+
+_lock = threading.Lock()
+_state = {"snapshot": None, "checked_at": 0.0, "reload_requested": False}
+
+
+def _file_version():
+    stat_result = os.stat(CONFIG_FILE)
+    return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def _build_snapshot(version):
+    """Execute config.py as a private module (never touching sys.modules) and freeze its values"""
+    spec = importlib.util.spec_from_file_location("_config_snapshot", CONFIG_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    firebase_credentials = module.get_firebase_credentials() if hasattr(module, "get_firebase_credentials") else None
+
+    return ConfigSnapshot(
+        verify_token=getattr(module, "VERIFY_TOKEN", None),
+        access_token=getattr(module, "ACCESS_TOKEN", None),
+        phone_number_id=getattr(module, "PHONE_NUMBER_ID", None),
+        upi_config=MappingProxyType(dict(getattr(module, "UPI_CONFIG", {}))),
+        firebase_credentials=MappingProxyType(firebase_credentials) if firebase_credentials else None,
+        version=version,
+    )
+
+
+def get_config():
+    """Get the current config snapshot
+
+    The snapshot is shared and read-only. config.py is stat'ed at most every
+    CONFIG_CHECK_INTERVAL seconds and only re-executed when it changed.
+    """
+    snapshot = _state["snapshot"]
+    if (snapshot is not None and not _state["reload_requested"]
+            and time.monotonic() - _state["checked_at"] < CONFIG_CHECK_INTERVAL):
+        return snapshot
+
+    with _lock:
+        snapshot = _state["snapshot"]
+        version = _file_version()
+        if snapshot is None or _state["reload_requested"] or snapshot.version != version:
+            snapshot = _build_snapshot(version)
+            _state["snapshot"] = snapshot
+            _state["reload_requested"] = False
+            log.info("Configuration snapshot loaded")
+        _state["checked_at"] = time.monotonic()
+        return snapshot
+
+
+def request_reload():
+    """Rebuild the snapshot on the next get_config() call"""
+    _state["reload_requested"] = True
+
+
+def install_sighup_handler():
+    """Reload the snapshot on SIGHUP, chaining any handler that was already installed"""
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        return
+
+    previous_handler = signal.getsignal(signal.SIGHUP)
+
+    def handle_sighup(signum, frame):
+        request_reload()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+
+    signal.signal(signal.SIGHUP, handle_sighup)
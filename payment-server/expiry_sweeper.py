@@ -0,0 +1,102 @@
+# expiry_sweeper.py - moves pending payment codes past their expiry_time to 'expired'
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # No flock on Windows: every process sweeps (the writes are conditional, so this is safe)
+    fcntl = None
+
+from structured_logging import get_logger
+
+log = get_logger("expiry_sweeper")
+
+EXPIRY_SWEEP_ENABLED = os.getenv("EXPIRY_SWEEP_ENABLED", "1") == "1"
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "30"))
+# Records expired per write batch (Firestore allows 500 writes per batch)
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv("EXPIRY_SWEEP_BATCH_SIZE", "400"))
+# Only the process holding an flock on this file sweeps
+EXPIRY_SWEEP_LOCK = os.getenv("EXPIRY_SWEEP_LOCK", "expiry_sweeper.lock")
+
+
+class ExpirySweeper:
+    """Background thread that expires pending payment codes in batches
+
+    Every gunicorn worker can start one, but only the process holding the
+    flock on lock_path sweeps. The others keep trying for the lock, so another
+    worker takes over when the leader exits.
+    """
+
+    def __init__(self, storage, interval=EXPIRY_SWEEP_INTERVAL, batch_size=EXPIRY_SWEEP_BATCH_SIZE,
+                 lock_path=EXPIRY_SWEEP_LOCK):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock_path = lock_path
+
+        self.expired_total = 0
+        self.last_sweep_at = None
+        self._lock_file = None
+        self._lock_pid = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def is_leader(self):
+        return self._lock_pid == os.getpid() and (self._lock_file is not None or fcntl is None)
+
+    def _acquire_leadership(self):
+        if self._lock_pid != os.getpid() and self._lock_file is not None:
+            # Inherited across a fork: the parent still holds the lock through its own descriptor
+            self._lock_file.close()
+            self._lock_file = None
+        self._lock_pid = os.getpid()
+        if fcntl is None or self._lock_file is not None:
+            return True
+
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        log.info("Expiry sweeper leader is pid %s", os.getpid())
+        return True
+
+    def sweep(self, now=None):
+        """Expire everything due at `now` in batches; returns the number expired"""
+        now = now or datetime.now(timezone.utc)
+        expired = 0
+        while True:
+            unique_ids = self.storage.expire_pending_requests(now, self.batch_size)
+            expired += len(unique_ids)
+            if len(unique_ids) < self.batch_size:
+                break
+
+        self.expired_total += expired
+        self.last_sweep_at = time.time()
+        if expired:
+            log.info("Expired %s pending payment codes", expired)
+        return expired
+
+    def start(self):
+        """Start the sweeper thread in this process (again after a fork)"""
+        if self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread_pid == os.getpid():
+                return
+            threading.Thread(target=self._loop, name="expiry-sweeper", daemon=True).start()
+            self._thread_pid = os.getpid()
+
+    def _loop(self):
+        while True:
+            try:
+                if self._acquire_leadership():
+                    self.sweep()
+            except Exception as e:
+                log.warning("Expiry sweep failed: %s", e)
+            time.sleep(self.interval)
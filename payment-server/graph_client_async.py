@@ -0,0 +1,91 @@
+# graph_client_async.py - aiohttp Graph API client for the asyncio payment server
+import asyncio
+import os
+import time
+
+import aiohttp
+
+from config_loader import get_config
+from graph_client import (GRAPH_API_BASE, GRAPH_BACKOFF_FACTOR, GRAPH_CONNECT_TIMEOUT, GRAPH_MAX_RETRIES,
+                          GRAPH_READ_TIMEOUT, RETRY_STATUSES, _record_latency)
+
+# Open connections to the Graph API; unlike the threaded client this bounds concurrent sends, not threads
+GRAPH_ASYNC_POOL_SIZE = int(os.getenv("GRAPH_ASYNC_POOL_SIZE", "200"))
+# Longest Retry-After honored before giving up on a retry
+GRAPH_MAX_RETRY_AFTER = 120.0
+
+
+class AsyncGraphClient:
+    """One aiohttp session per event loop, with the same timeouts, retries and latency stats as graph_client
+
+    Call start() from the running loop before use and close() on shutdown.
+    """
+
+    def __init__(self):
+        self._session = None
+
+    async def start(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=GRAPH_ASYNC_POOL_SIZE),
+                timeout=aiohttp.ClientTimeout(connect=GRAPH_CONNECT_TIMEOUT, sock_read=GRAPH_READ_TIMEOUT),
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _retry_delay(attempt, retry_after):
+        """Backoff like urllib3's Retry: Retry-After when given, else backoff_factor * 2^(attempt - 1)"""
+        if retry_after:
+            try:
+                return min(float(retry_after), GRAPH_MAX_RETRY_AFTER)
+            except ValueError:
+                pass
+        return GRAPH_BACKOFF_FACTOR * (2 ** (attempt - 1)) if attempt > 1 else 0.0
+
+    async def request(self, method, path, operation, **kwargs):
+        """Call the Graph API; returns (status, body text)
+
+        Connection errors, timeouts and RETRY_STATUSES are retried up to
+        GRAPH_MAX_RETRIES times. Raises aiohttp.ClientError or
+        asyncio.TimeoutError once the retries are used up.
+        """
+        await self.start()
+        headers = {"Authorization": f"Bearer {get_config().access_token}", **kwargs.pop("headers", {})}
+
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self._session.request(method, f"{GRAPH_API_BASE}/{path}", headers=headers,
+                                                 **kwargs) as response:
+                    status = response.status
+                    text = await response.text()
+                    retry_after = response.headers.get("Retry-After") if status in (429, 503) else None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt > GRAPH_MAX_RETRIES:
+                    _record_latency(operation, time.perf_counter() - start, error=True)
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt, None))
+                continue
+
+            if status in RETRY_STATUSES and attempt <= GRAPH_MAX_RETRIES:
+                await asyncio.sleep(self._retry_delay(attempt, retry_after))
+                continue
+
+            _record_latency(operation, time.perf_counter() - start, error=status >= 400)
+            return status, text
+
+    async def send_message(self, to_number, message_type, content):
+        """Send a WhatsApp message, e.g. await send_message(to, "text", {"body": "..."})"""
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to_number,
+            "type": message_type,
+            message_type: content
+        }
+        return await self.request("POST", f"{get_config().phone_number_id}/messages", "messages", json=payload)
@@ -0,0 +1,192 @@
+# idempotency.py - replay the first response to retried POSTs, shared across gunicorn workers
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Response, jsonify, make_response, request
+
+from structured_logging import get_logger
+
+log = get_logger("idempotency")
+
+IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB", "idempotency.db")
+# How long a recorded response is replayed
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# A request still 'in progress' after this long belongs to a worker that died
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))
+IDEMPOTENCY_PURGE_INTERVAL = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    state TEXT NOT NULL,
+    status_code INTEGER,
+    content_type TEXT,
+    body BLOB,
+    started_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+"""
+
+
+class IdempotencyStore:
+    """SQLite table of request keys and the response first returned for them
+
+    Several gunicorn workers can share one database file: a key is claimed
+    inside a BEGIN IMMEDIATE transaction, so only one worker runs the request
+    and the others see it as in progress or replay its response.
+    """
+
+    def __init__(self, path=IDEMPOTENCY_DB, ttl=IDEMPOTENCY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self.counts = {"new": 0, "replayed": 0, "in_progress": 0, "mismatch": 0}
+
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _purge(self, conn, now):
+        if now - self._last_purge >= IDEMPOTENCY_PURGE_INTERVAL:
+            self._last_purge = now
+            conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+
+    def begin(self, key, fingerprint=None):
+        """Claim a key before running the request
+
+        Returns ('new', None), ('replay', (status_code, content_type, body)),
+        ('in_progress', None) or ('mismatch', None) when the key was first used
+        with a different request body. A fingerprint of None skips that check.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._purge(conn, now)
+            row = conn.execute(
+                "SELECT fingerprint, state, status_code, content_type, body, started_at FROM idempotency_keys "
+                "WHERE key = ? AND expires_at > ?",
+                (key, now)
+            ).fetchone()
+
+            if row is None or (row[1] == 'in_progress' and now - row[5] >= IDEMPOTENCY_LEASE_SECONDS):
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, state, started_at, expires_at) "
+                    "VALUES (?, ?, 'in_progress', ?, ?)",
+                    (key, fingerprint, now, now + self.ttl)
+                )
+                result = ('new', None)
+            elif fingerprint is not None and row[0] is not None and row[0] != fingerprint:
+                result = ('mismatch', None)
+            elif row[1] == 'in_progress':
+                result = ('in_progress', None)
+            else:
+                result = ('replay', (row[2], row[3], row[4]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self.counts[result[0] if result[0] != 'replay' else 'replayed'] += 1
+        return result
+
+    def complete(self, key, status_code, content_type, body):
+        """Record the response to replay for this key"""
+        self._connect().execute(
+            "UPDATE idempotency_keys SET state = 'done', status_code = ?, content_type = ?, body = ? WHERE key = ?",
+            (status_code, content_type, body, key)
+        )
+
+    def release(self, key):
+        """Forget a key whose request failed, so a retry runs it again"""
+        self._connect().execute("DELETE FROM idempotency_keys WHERE key = ? AND state = 'in_progress'", (key,))
+
+
+IN_PROGRESS_BODY = {'error': 'A request with this idempotency key is still in progress'}
+MISMATCH_BODY = {'error': 'Idempotency-Key was already used with a different request body'}
+
+
+def request_key(scope, header_key, body, json_body, fallback_key=None):
+    """(key, fingerprint) to claim for a request, or None when it runs normally
+
+    The Idempotency-Key header wins and is fingerprinted with the body;
+    without it fallback_key(json_body, body) may derive a key.
+    """
+    if header_key:
+        return f"{scope}:key:{header_key}", hashlib.sha256(body).hexdigest()
+    derived = fallback_key(json_body, body) if fallback_key else None
+    if not derived:
+        return None
+    return f"{scope}:auto:{derived}", None
+
+
+def is_replayable(status_code, header_key):
+    """Fallback keys only record 2xx, so a corrected request after a 4xx runs again"""
+    return status_code < 500 if header_key else 200 <= status_code < 300
+
+
+def idempotent(store, scope, fallback_key=None):
+    """Make a Flask POST view replay its first response to retries
+
+    The key is the Idempotency-Key header; reusing it with a different body
+    is rejected with 422. Without the header, fallback_key(json_body, body)
+    may return a key derived from the payload (e.g. the unique_id), or None to
+    run the request normally. 5xx responses are not recorded, so they can be
+    retried, and on the fallback path only 2xx responses are: a derived key
+    does not cover the whole body, so a corrected request after a 4xx must run
+    again. A retry that arrives while the first request is still running gets
+    409 with Retry-After.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            header_key = request.headers.get('Idempotency-Key')
+            claim = request_key(scope, header_key, request.get_data(),
+                                None if header_key else request.get_json(silent=True), fallback_key)
+            if claim is None:
+                return view(*args, **kwargs)
+            key, fingerprint = claim
+
+            state, stored = store.begin(key, fingerprint)
+            if state == 'replay':
+                status_code, content_type, body = stored
+                log.info("Replaying %s response for %s", scope, key)
+                response = Response(body, status=status_code, content_type=content_type)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if state == 'in_progress':
+                response = jsonify(IN_PROGRESS_BODY)
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            if state == 'mismatch':
+                return jsonify(MISMATCH_BODY), 422
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                store.release(key)
+                raise
+
+            if not is_replayable(response.status_code, header_key) or response.is_streamed:
+                store.release(key)
+            else:
+                store.complete(key, response.status_code, response.content_type, response.get_data())
+            return response
+        return wrapper
+    return decorator
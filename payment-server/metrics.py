@@ -0,0 +1,189 @@
+# metrics.py - Prometheus text-format metrics shared by the payment server and the WhatsApp bot
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a local cache hit up to a slow Graph API call with retries
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative histogram per label set; observe() is one lock and one bisect"""
+
+    def __init__(self, name, help_text, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+
+        for key, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read when /metrics is scraped
+
+    func returns a number, or {label values tuple: number}.
+    """
+
+    def __init__(self, name, help_text, func, metric_type="gauge", labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            return []
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        if isinstance(value, dict):
+            for key, item in sorted(value.items()):
+                if item is not None:
+                    lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(item)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+_registry_lock = threading.Lock()
+_registry = []
+
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def histogram(name, help_text, labelnames, buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, help_text, labelnames, buckets))
+
+
+def gauge(name, help_text, func, labelnames=()):
+    """Register a gauge read from func() at scrape time"""
+    return register(CallbackMetric(name, help_text, func, "gauge", labelnames))
+
+
+def counter(name, help_text, func, labelnames=()):
+    """Register a counter whose running total is read from func() at scrape time"""
+    return register(CallbackMetric(name, help_text, func, "counter", labelnames))
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_DURATION = histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "route", "status"],
+)
+
+DEPENDENCY_CALL_DURATION = histogram(
+    "dependency_call_duration_seconds",
+    "Time spent in calls to storage and the Graph API",
+    ["dependency", "operation", "outcome"],
+)
+
+
+def observe_dependency(dependency, operation, seconds, error=False):
+    DEPENDENCY_CALL_DURATION.observe(seconds, dependency=dependency, operation=operation,
+                                     outcome="error" if error else "ok")
+
+
+def install(app):
+    """Time every request of a Flask app and serve GET /metrics
+
+    Requests are labelled with the route template (e.g.
+    /payment-requests/<unique_id>), so label cardinality stays bounded.
+    Each gunicorn worker keeps its own numbers; a scrape sees the worker that
+    answered it.
+    """
+    if not METRICS_ENABLED:
+        return
+
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, method=request.method,
+                                          route=route, status=str(response.status_code))
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,321 @@
+# outbox.py - durable SQLite outbox for WhatsApp payment confirmations
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from structured_logging import get_logger
+
+log = get_logger("outbox")
+
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+# Sends in flight at once when the outbox is drained from asyncio (payment_server_async)
+OUTBOX_ASYNC_CONCURRENCY = int(os.getenv("OUTBOX_ASYNC_CONCURRENCY", "200"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_BASE_DELAY = float(os.getenv("OUTBOX_BASE_DELAY", "2.0"))
+OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", "300"))
+# A message left in 'sending' longer than this belongs to a worker that died
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_POLL_INTERVAL = 1.0
+# Sent messages are deleted after this many days (failed ones are kept for inspection)
+OUTBOX_RETENTION_DAYS = float(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Seconds between retention prunes in each process; they run when the senders are idle
+OUTBOX_PRUNE_INTERVAL = float(os.getenv("OUTBOX_PRUNE_INTERVAL", "3600"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    unique_id TEXT NOT NULL,
+    to_number TEXT NOT NULL,
+    customer_name TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+"""
+
+
+class ConfirmationOutbox:
+    """Queue of confirmation messages drained by a pool of sender threads
+
+    Messages are committed to SQLite before enqueue() returns, so they survive
+    restarts. Several gunicorn workers can share one database file: a message is
+    claimed with a single UPDATE, so only one process sends it.
+
+    send_func(to_number, customer_name, unique_id) returns True once the
+    message was accepted. status_callback(unique_id, status, attempts, error)
+    is called after every attempt with status 'sent', 'retrying' or 'failed'.
+    With workers=0 no sender threads run and drain_async() sends instead.
+    """
+
+    def __init__(self, send_func, status_callback=None, path=OUTBOX_DB, workers=OUTBOX_WORKERS):
+        self.path = path
+        self.send_func = send_func
+        self.status_callback = status_callback
+        self.workers = workers
+
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._async_wakeup = None
+        self._threads = []
+        self._threads_pid = None
+        self._start_lock = threading.Lock()
+        self._last_prune = None
+
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def start(self):
+        """Start the sender threads in this process (again after a fork)
+
+        Messages left over from a previous run are picked up as soon as the
+        threads are running.
+        """
+        if self._threads_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._threads_pid == os.getpid():
+                return
+            self._threads = [
+                threading.Thread(target=self._worker_loop, name=f"outbox-sender-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._threads_pid = os.getpid()
+
+    def enqueue(self, unique_id, to_number, customer_name):
+        """Durably queue one confirmation and return its outbox ID"""
+        now = time.time()
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT INTO outbox (unique_id, to_number, customer_name, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (unique_id, to_number, customer_name, now, now, now)
+        )
+        self.start()
+        self._wake()
+        return cursor.lastrowid
+
+    def enqueue_many(self, messages):
+        """Durably queue (unique_id, to_number, customer_name) tuples in one transaction
+
+        Returns the outbox IDs in the same order. All sender threads are woken
+        so the messages go out concurrently.
+        """
+        now = time.time()
+        conn = self._connect()
+        message_ids = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for unique_id, to_number, customer_name in messages:
+                cursor = conn.execute(
+                    "INSERT INTO outbox (unique_id, to_number, customer_name, next_attempt_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (unique_id, to_number, customer_name, now, now, now)
+                )
+                message_ids.append(cursor.lastrowid)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self.start()
+        self._wake()
+        return message_ids
+
+    def _wake(self):
+        self._wakeup.set()
+        if self._async_wakeup is not None:
+            loop, event = self._async_wakeup
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop already closed
+                pass
+
+    def depth(self):
+        """Number of messages still waiting to be sent"""
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()
+        return row[0]
+
+    def prune(self, retention_days=OUTBOX_RETENTION_DAYS):
+        """Delete messages sent more than retention_days ago; returns how many were deleted"""
+        cursor = self._connect().execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND updated_at < ?",
+            (time.time() - retention_days * 86400,)
+        )
+        if cursor.rowcount:
+            log.info("Outbox pruned %s sent messages", cursor.rowcount)
+        return cursor.rowcount
+
+    def _maybe_prune(self):
+        """prune() at most every OUTBOX_PRUNE_INTERVAL seconds per process"""
+        now = time.monotonic()
+        if self._last_prune is not None and now - self._last_prune < OUTBOX_PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        try:
+            self.prune()
+        except sqlite3.Error as e:
+            log.warning("Outbox prune failed: %s", e)
+
+    def _claim(self):
+        """Take the next due message, or one abandoned by a dead worker"""
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, unique_id, to_number, customer_name, attempts FROM outbox "
+                "WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "OR (status = 'sending' AND updated_at <= ?) "
+                "ORDER BY next_attempt_at LIMIT 1",
+                (now, now - OUTBOX_LEASE_SECONDS)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (now, row[0])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _finish(self, message_id, status, next_attempt_at=None, error=None):
+        self._connect().execute(
+            "UPDATE outbox SET status = ?, next_attempt_at = COALESCE(?, next_attempt_at), "
+            "last_error = ?, updated_at = ? WHERE id = ?",
+            (status, next_attempt_at, error, time.time(), message_id)
+        )
+
+    def _backoff(self, attempts):
+        """Exponential backoff with jitter"""
+        delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _process(self, row):
+        _, unique_id, to_number, customer_name, _ = row
+
+        error = None
+        try:
+            sent = self.send_func(to_number, customer_name, unique_id)
+            if not sent:
+                error = "WhatsApp API did not accept the message"
+        except Exception as e:
+            sent = False
+            error = str(e)
+
+        self._record_attempt(row, sent, error)
+
+    def _record_attempt(self, row, sent, error):
+        message_id, unique_id, _, _, attempts = row
+        attempts += 1
+
+        if sent:
+            self._finish(message_id, 'sent')
+            status = 'sent'
+        elif attempts >= OUTBOX_MAX_ATTEMPTS:
+            self._finish(message_id, 'failed', error=error)
+            status = 'failed'
+            log.error("Outbox gave up on confirmation for %s after %s attempts", unique_id, attempts)
+        else:
+            self._finish(message_id, 'pending', next_attempt_at=time.time() + self._backoff(attempts), error=error)
+            status = 'retrying'
+
+        if self.status_callback:
+            try:
+                self.status_callback(unique_id, status, attempts, error)
+            except Exception as e:
+                log.warning("Outbox status callback failed for %s: %s", unique_id, e)
+
+    def _worker_loop(self):
+        while True:
+            try:
+                row = self._claim()
+            except sqlite3.Error as e:
+                log.warning("Outbox claim failed: %s", e)
+                row = None
+
+            if row is None:
+                self._maybe_prune()
+                self._wakeup.wait(OUTBOX_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            self._process(row)
+
+    async def drain_async(self, send_coro, concurrency=OUTBOX_ASYNC_CONCURRENCY):
+        """Send queued messages from the running event loop, up to `concurrency` at a time
+
+        send_coro(to_number, customer_name, unique_id) is awaited and returns
+        True once the message was accepted. SQLite claims and status updates run
+        in the default executor. Runs until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self._async_wakeup = (loop, wakeup)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def send(row):
+            _, unique_id, to_number, customer_name, _ = row
+            error = None
+            try:
+                sent = await send_coro(to_number, customer_name, unique_id)
+                if not sent:
+                    error = "WhatsApp API did not accept the message"
+            except Exception as e:
+                sent = False
+                error = str(e)
+            try:
+                await asyncio.to_thread(self._record_attempt, row, sent, error)
+            finally:
+                slots.release()
+
+        tasks = set()
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    row = await asyncio.to_thread(self._claim)
+                except sqlite3.Error as e:
+                    log.warning("Outbox claim failed: %s", e)
+                    row = None
+
+                if row is None:
+                    slots.release()
+                    await asyncio.to_thread(self._maybe_prune)
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    wakeup.clear()
+                    continue
+
+                task = loop.create_task(send(row))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self._async_wakeup = None
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,184 @@
+# payment_cache.py - in-process copy of payment_requests kept warm by a Firestore listener
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from structured_logging import get_logger
+
+log = get_logger("payment_cache")
+
+PAYMENT_CACHE_ENABLED = os.getenv("PAYMENT_CACHE_ENABLED", "1") == "1"
+# Confirmed/expired records beyond this many are evicted, least recently used first
+PAYMENT_CACHE_MAX_TERMINAL = int(os.getenv("PAYMENT_CACHE_MAX_TERMINAL", "20000"))
+
+TERMINAL_STATUSES = ('confirmed', 'expired')
+
+_OLDEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+class PaymentRequestCache:
+    """payment_requests documents keyed by unique_id, fed by on_snapshot
+
+    Non-terminal records are always kept; terminal ones are LRU-evicted past
+    max_terminal. Until something has been evicted the cache holds the whole
+    collection and can answer list queries too (see is_complete()).
+
+    The listener streams the whole collection once when it starts, so each
+    worker process pays one full read of payment_requests at startup.
+    """
+
+    def __init__(self, collection_ref, max_terminal=PAYMENT_CACHE_MAX_TERMINAL):
+        self.collection_ref = collection_ref
+        self.max_terminal = max_terminal
+
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._terminal = OrderedDict()
+        self._sorted_ids = None
+        # doc_id -> index in _sorted_ids, so an `after` cursor is found in O(1)
+        self._positions = None
+        self._evicted = False
+        self._watch = None
+        self._watch_pid = None
+        self._ready = threading.Event()
+        self._last_update = None
+        self.hits = 0
+        self.misses = 0
+
+    # ---- listener ----
+
+    def start(self):
+        """Start the listener in this process (again after a fork)"""
+        if self._watch_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watch_pid == os.getpid():
+                return
+            self._watch = self.collection_ref.on_snapshot(self._on_snapshot)
+            self._watch_pid = os.getpid()
+        log.info("Payment request cache listener started")
+
+    def _on_snapshot(self, collection_snapshot, changes, read_time):
+        with self._lock:
+            # The page order only changes when a document comes or goes or its created_at moves;
+            # status and WhatsApp delivery updates keep the sorted IDs
+            reorder = False
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    reorder |= self._docs.pop(doc_id, None) is not None
+                    self._terminal.pop(doc_id, None)
+                    continue
+
+                data = change.document.to_dict()
+                previous = self._docs.get(doc_id)
+                reorder |= previous is None or previous.get('created_at') != data.get('created_at')
+                self._docs[doc_id] = data
+                if data.get('status') in TERMINAL_STATUSES:
+                    self._terminal[doc_id] = True
+                    self._terminal.move_to_end(doc_id)
+                else:
+                    self._terminal.pop(doc_id, None)
+
+            while len(self._terminal) > self.max_terminal:
+                doc_id, _ = self._terminal.popitem(last=False)
+                self._docs.pop(doc_id, None)
+                self._evicted = True
+                reorder = True
+
+            if reorder:
+                self._sorted_ids = None
+                self._positions = None
+            self._last_update = time.monotonic()
+
+        self._ready.set()
+
+    # ---- state ----
+
+    def is_ready(self):
+        """True once the first snapshot arrived and the listener is still running"""
+        return (self._ready.is_set() and self._watch is not None
+                and self._watch_pid == os.getpid() and getattr(self._watch, 'is_active', True))
+
+    def is_complete(self):
+        """True while the cache holds every document of the collection"""
+        return self.is_ready() and not self._evicted
+
+    def staleness_seconds(self):
+        """Seconds since the listener last delivered a change (None before the first snapshot)
+
+        A quiet collection also makes this grow, so read it next to is_ready().
+        """
+        if self._last_update is None:
+            return None
+        return time.monotonic() - self._last_update
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'ready': self.is_ready(),
+            'complete': self.is_complete(),
+            'size': len(self._docs),
+            'staleness_seconds': self.staleness_seconds(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
+
+    # ---- reads ----
+
+    def get(self, unique_id):
+        """Copy of a cached record, or None when it is not cached"""
+        with self._lock:
+            data = self._docs.get(unique_id)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if unique_id in self._terminal:
+                self._terminal.move_to_end(unique_id)
+            return dict(data)
+
+    def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        """Same page as get_firestore_page, newest first, answered from memory
+
+        Returns ([(doc_id, data)], has_more). Only valid while is_complete().
+        """
+        with self._lock:
+            if self._sorted_ids is None:
+                self._sorted_ids = sorted(
+                    self._docs,
+                    key=lambda doc_id: (self._docs[doc_id].get('created_at') or _OLDEST, doc_id),
+                    reverse=True
+                )
+                self._positions = {doc_id: index for index, doc_id in enumerate(self._sorted_ids)}
+            sorted_ids = self._sorted_ids
+            docs = self._docs
+
+            start = 0
+            if after:
+                if after not in docs:
+                    raise ValueError('Invalid cursor')
+                start = self._positions[after] + 1
+
+            page = []
+            for index in range(start, len(sorted_ids)):
+                doc_id = sorted_ids[index]
+                data = docs[doc_id]
+                created_at = data.get('created_at') or _OLDEST
+                if created_from and created_at < created_from:
+                    # Newest first, so every later record is older still
+                    break
+                if created_to and created_at >= created_to:
+                    continue
+                if status and data.get('status') != status:
+                    continue
+
+                if len(page) == page_size:
+                    return page, True
+                page.append((doc_id, {field: data[field] for field in fields if field in data}
+                             if fields else dict(data)))
+
+            return page, False
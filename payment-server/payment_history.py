@@ -0,0 +1,397 @@
+# payment_history.py - append-only, rotated payment code history journal
+import atexit
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # No flock on Windows: only the threads of one process are serialized
+    fcntl = None
+
+# Journal layout inside PAYMENT_HISTORY_DIR:
+#   segment-000001.jsonl.gz + segment-000001.idx.json   (rotated, compressed, immutable)
+#   segment-000002.jsonl                                 (active, append-only JSON Lines)
+HISTORY_DIR = os.getenv("PAYMENT_HISTORY_DIR", "payment_history")
+SEGMENT_MAX_BYTES = int(os.getenv("PAYMENT_HISTORY_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+FSYNC_BATCH_SIZE = int(os.getenv("PAYMENT_HISTORY_FSYNC_BATCH", "32"))
+FSYNC_INTERVAL = float(os.getenv("PAYMENT_HISTORY_FSYNC_INTERVAL", "1.0"))
+
+# Old single-file history, imported once into an empty journal
+LEGACY_LOG_FILE = "payment_codes_log.json"
+
+_SEGMENT_RE = re.compile(r"^segment-(\d{6})\.jsonl(\.gz)?$")
+_READ_BLOCK_SIZE = 64 * 1024
+
+
+def encode_position(segment, offset):
+    """Position of an entry in the journal, used as the `before` cursor"""
+    return f"{segment}:{offset}"
+
+
+def encode_entry(entry):
+    """One journal line"""
+    return json.dumps(entry, separators=(",", ":"), default=str).encode("utf-8") + b"\n"
+
+
+def decode_position(position):
+    """Parse a `before` cursor, raising ValueError when it is malformed"""
+    try:
+        segment, offset = position.split(":")
+        return int(segment), int(offset)
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid before cursor")
+
+
+class PaymentHistoryJournal:
+    """JSON Lines journal shared by all workers through an flock on `.lock`
+
+    Appends go to the active segment and are fsynced every FSYNC_BATCH_SIZE
+    entries or FSYNC_INTERVAL seconds. When the active segment reaches
+    SEGMENT_MAX_BYTES it is gzipped next to a small index of entry offsets per
+    unique_id, so filtered reads can skip segments that do not mention it.
+    """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(directory, ".lock"), "a")
+        self._file = None
+        self._segment = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._index_cache = {}
+
+    # ---- segment bookkeeping ----
+
+    def _segment_path(self, segment, compressed=False):
+        return os.path.join(self.directory, f"segment-{segment:06d}.jsonl" + (".gz" if compressed else ""))
+
+    def _index_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.idx.json")
+
+    def _list_segments(self):
+        """Return [(segment, compressed)] sorted oldest first
+
+        A plain segment next to its .gz (a rotation interrupted before the
+        unlink) is listed as compressed only: the .gz was complete when it was
+        renamed into place.
+        """
+        segments = {}
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_RE.match(name)
+            if match:
+                segment = int(match.group(1))
+                segments[segment] = segments.get(segment, False) or bool(match.group(2))
+        return sorted(segments.items())
+
+    def _ensure_open(self):
+        """Open the active segment, following rotations done by other workers"""
+        if self._file is not None:
+            try:
+                if os.stat(self._segment_path(self._segment)).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._file.close()
+            self._file = None
+
+        segments = self._list_segments()
+        active = [segment for segment, compressed in segments if not compressed]
+        if active:
+            self._segment = active[-1]
+        else:
+            self._segment = segments[-1][0] + 1 if segments else 1
+            if segments:
+                # Finish a rotation that was interrupted between os.replace and os.unlink
+                self._unlink_plain(segments[-1][0])
+
+        self._file = open(self._segment_path(self._segment), "ab")
+
+    def _rotate(self):
+        """Compress the full active segment and start the next one"""
+        self._sync()
+        self._file.close()
+        self._file = None
+
+        plain_path = self._segment_path(self._segment)
+        unique_ids = {}
+        count = 0
+        temp_path = self._segment_path(self._segment, compressed=True) + ".tmp"
+
+        with open(plain_path, "rb") as source, gzip.open(temp_path, "wb") as target:
+            offset = 0
+            for line in source:
+                try:
+                    unique_id = json.loads(line).get("unique_id")
+                except ValueError:
+                    unique_id = None
+                if unique_id:
+                    unique_ids.setdefault(unique_id, []).append(offset)
+                count += 1
+                offset += len(line)
+                target.write(line)
+
+        with open(self._index_path(self._segment), "w") as f:
+            json.dump({"count": count, "unique_ids": unique_ids}, f)
+        os.replace(temp_path, self._segment_path(self._segment, compressed=True))
+        self._unlink_plain(self._segment)
+
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), "ab")
+
+    def _unlink_plain(self, segment):
+        try:
+            os.unlink(self._segment_path(segment))
+        except FileNotFoundError:
+            pass
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    # ---- writes ----
+
+    def append(self, entry):
+        """Append one entry and return its position"""
+        return self.append_many([entry])[0]
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the journal against the other threads of this process and, through the flock, other workers"""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def append_many(self, entries):
+        """Append entries in a single write and return their positions"""
+        lines = [encode_entry(entry) for entry in entries]
+        with self._exclusive():
+            return self._append_lines(lines)
+
+    def _append_lines(self, lines):
+        """Write encoded lines to the active segment; the caller holds _exclusive()"""
+        self._ensure_open()
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+
+        positions = []
+        for line in lines:
+            positions.append(encode_position(self._segment, offset))
+            offset += len(line)
+
+        self._file.write(b"".join(lines))
+        self._file.flush()
+        self._unsynced += len(lines)
+
+        if offset >= SEGMENT_MAX_BYTES:
+            self._rotate()
+        elif self._unsynced >= FSYNC_BATCH_SIZE or time.monotonic() - self._last_sync >= FSYNC_INTERVAL:
+            self._sync()
+        return positions
+
+    def last_modified(self):
+        """Time of the last append or rotation by any worker (epoch seconds), or None for an empty journal
+
+        Only the newest segment changes, so one stat() answers it.
+        """
+        segments = self._list_segments()
+        if not segments:
+            return None
+        segment, compressed = segments[-1]
+        try:
+            return os.stat(self._segment_path(segment, compressed)).st_mtime
+        except FileNotFoundError:
+            # Rotated by another worker while we were looking
+            return time.time()
+
+    def sync(self):
+        """Flush outstanding appends to disk"""
+        with self._lock:
+            self._sync()
+
+    # ---- reads ----
+
+    def _load_index(self, segment):
+        index = self._index_cache.get(segment)
+        if index is None:
+            try:
+                with open(self._index_path(segment), "r") as f:
+                    index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                index = None
+            if index is not None:
+                self._index_cache[segment] = index
+        return index
+
+    @staticmethod
+    def _parse(line, unique_id):
+        """The entry on a journal line, or None when it is unreadable or about another unique_id"""
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if unique_id and entry.get("unique_id") != unique_id:
+            return None
+        return entry
+
+    def _iter_plain_reverse(self, f, end_offset=None, unique_id=None):
+        """Yield (offset, entry) from end_offset (default: end of file) backwards in fixed-size blocks"""
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            position = size if end_offset is None else min(end_offset, size)
+            # Anything after the last newline is a line another worker is still writing
+            drop_tail = True
+            remainder = b""
+
+            while position > 0:
+                read_size = min(_READ_BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+
+                if drop_tail:
+                    if len(lines) == 1:
+                        remainder = b""
+                        continue
+                    lines[-1] = b""
+                    drop_tail = False
+
+                remainder = lines[0]
+                line_offset = position + len(remainder) + 1
+                complete = []
+                for line in lines[1:]:
+                    complete.append((line_offset, line))
+                    line_offset += len(line) + 1
+                for offset, line in reversed(complete):
+                    entry = self._parse(line, unique_id) if line else None
+                    if entry is not None:
+                        yield offset, entry
+
+            if remainder and not drop_tail:
+                entry = self._parse(remainder, unique_id)
+                if entry is not None:
+                    yield 0, entry
+
+    def _iter_compressed_reverse(self, segment, end_offset, unique_id=None, limit=None):
+        """(offset, entry) from a rotated segment, newest first, at most `limit` of them
+
+        gzip cannot be read backwards, so the segment is decompressed as a
+        stream, keeping only the newest `limit` entries seen. It stops at
+        end_offset, or after the last offset the segment index lists for
+        unique_id.
+        """
+        offsets = None
+        if unique_id:
+            index = self._load_index(segment)
+            if index is not None:
+                offsets = [offset for offset in index["unique_ids"].get(unique_id, [])
+                           if end_offset is None or offset < end_offset]
+                if not offsets:
+                    return []
+                offsets = set(offsets[-limit:] if limit else offsets)
+        # Offset of the first line not needed (exclusive)
+        stop = max(offsets) + 1 if offsets else end_offset
+
+        items = deque(maxlen=limit)
+        with gzip.open(self._segment_path(segment, compressed=True), "rb") as f:
+            offset = 0
+            for line in f:
+                if stop is not None and offset >= stop:
+                    break
+                if offsets is None or offset in offsets:
+                    entry = self._parse(line, unique_id)
+                    if entry is not None:
+                        items.append((offset, entry))
+                offset += len(line)
+        return reversed(items)
+
+    def _segment_entries(self, segment, compressed, end_offset, unique_id, limit):
+        """(offset, entry) from one segment newest first, following a rotation that happens before it is opened"""
+        if not compressed:
+            try:
+                f = open(self._segment_path(segment), "rb")
+            except FileNotFoundError:
+                # Rotated by another worker since the segments were listed
+                pass
+            else:
+                return self._iter_plain_reverse(f, end_offset, unique_id)
+        return self._iter_compressed_reverse(segment, end_offset, unique_id, limit)
+
+    def read_page(self, limit=50, before=None, unique_id=None):
+        """Read up to `limit` entries newest first, strictly before the `before` position
+
+        Segments are read lazily from the newest: reading stops as soon as
+        `limit` entries are found. Returns (entries, next_before); next_before
+        is None once the start of the journal is reached.
+        """
+        before_segment, before_offset = decode_position(before) if before else (None, None)
+        entries = []
+
+        for segment, compressed in reversed(self._list_segments()):
+            if before_segment is not None and segment > before_segment:
+                continue
+            end_offset = before_offset if segment == before_segment else None
+
+            for offset, entry in self._segment_entries(segment, compressed, end_offset, unique_id,
+                                                       limit - len(entries)):
+                entries.append(entry)
+                if len(entries) >= limit:
+                    return entries, encode_position(segment, offset)
+
+        return entries, None
+
+    def import_legacy_log(self, log_file=LEGACY_LOG_FILE):
+        """Copy the old payment_codes_log.json into an empty journal
+
+        The emptiness check and the import happen under the journal lock, so of
+        several workers starting together only the first imports the file.
+        """
+        if not os.path.exists(log_file):
+            return 0
+        with self._exclusive():
+            if self._list_segments():
+                return 0
+            with open(log_file, "r") as f:
+                entries = json.load(f)
+            if entries:
+                self._append_lines([encode_entry(entry) for entry in entries])
+                self._sync()
+        return len(entries)
+
+
+_journal = None
+_journal_pid = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """Per-process journal instance (re-created after a fork)"""
+    global _journal, _journal_pid
+    with _journal_lock:
+        if _journal is None or _journal_pid != os.getpid():
+            _journal = PaymentHistoryJournal()
+            _journal_pid = os.getpid()
+            _journal.import_legacy_log()
+        return _journal
+
+
+@atexit.register
+def _sync_on_exit():
+    if _journal is not None and _journal_pid == os.getpid():
+        _journal.sync()
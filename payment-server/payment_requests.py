@@ -0,0 +1,739 @@
+# payment_requests.py - request parsing, response shaping and metrics shared by the Flask and asyncio payment servers
+import base64
+import csv
+import hashlib
+import io
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import metrics
+from payment_code_store import save_current_payment_code
+from payment_history import HISTORY_DIR, get_journal
+from storage import ALREADY_IN_STATUS, parse_timestamp
+from structured_logging import dropped_records, get_logger, sample
+
+log = get_logger("payment_requests")
+
+# Firestore allows 500 writes per batch: each saved record costs two (record and
+# tombstone removal), plus one for the counters update
+BULK_CHUNK_SIZE = 240
+
+# Pagination defaults for the list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Upper bound on payments confirmed by one /confirm-payments call
+MAX_BULK_CONFIRMATIONS = int(os.getenv('MAX_BULK_CONFIRMATIONS', '1000'))
+
+# Upper bound on payment codes accepted by one /save-payment-codes call
+MAX_BULK_ITEMS = int(os.getenv('MAX_BULK_ITEMS', '5000'))
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Required fields for a payment code, shared by the single and bulk endpoints
+REQUIRED_PAYMENT_FIELDS = ['unique_id', 'first_name', 'last_name', 'email', 'whatsapp']
+
+# Page size limits for /payment-history
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 500
+# Entries returned by /payment-history without limit or before (the old log file kept the last 100)
+LEGACY_HISTORY_ENTRIES = 100
+
+# Firestore field -> legacy CSV column name
+CSV_COLUMNS = [
+    ('unique_id', 'Unique ID'),
+    ('first_name', 'First Name'),
+    ('last_name', 'Last Name'),
+    ('email', 'Email'),
+    ('whatsapp', 'WhatsApp'),
+    ('customer_upi_id', 'Customer UPI ID'),
+    ('timestamp', 'Timestamp'),
+    ('expiry_time', 'Expiry Time'),
+    ('status', 'Status'),
+]
+
+# Firestore page size used while streaming a CSV export
+EXPORT_PAGE_SIZE = 500
+
+
+def build_payment_record(data):
+    """Shape a payment request for the payment_requests collection (timestamps are set by storage)
+
+    expiry_time is stored as a timestamp so expired codes can be found with an
+    indexed query; a value that does not parse is kept as sent.
+    """
+    return {
+        'unique_id': data.get('unique_id', ''),
+        'first_name': data.get('first_name', ''),
+        'last_name': data.get('last_name', ''),
+        'email': data.get('email', ''),
+        'whatsapp': data.get('whatsapp', ''),
+        'customer_upi_id': data.get('customer_upi_id', ''),
+        'timestamp': data.get('timestamp', ''),
+        'expiry_time': parse_timestamp(data.get('expiry_time')) or data.get('expiry_time', ''),
+        'status': data.get('status', 'pending')
+    }
+
+
+def validate_payment_data(payment_data):
+    """Return an error message for invalid payment data, or None when it is valid"""
+    if not isinstance(payment_data, dict) or 'unique_id' not in payment_data:
+        return 'Invalid payment data'
+
+    for field in REQUIRED_PAYMENT_FIELDS:
+        if field not in payment_data or not payment_data[field]:
+            return f'Missing required field: {field}'
+
+    return None
+
+
+def whatsapp_number(payment_data):
+    """WhatsApp number a request is for, used for per-number rate limiting"""
+    return payment_data.get('whatsapp') if isinstance(payment_data, dict) else None
+
+
+def confirm_dedup_key(confirm_data, body=None):
+    """Without an Idempotency-Key a payment is confirmed, and the customer messaged, once per uniqueId"""
+    return confirm_data.get('uniqueId') if isinstance(confirm_data, dict) else None
+
+
+def save_dedup_key(payment_data, body):
+    """Without an Idempotency-Key an identical re-submission is replayed; a changed one is saved again"""
+    if isinstance(payment_data, dict) and payment_data.get('unique_id'):
+        return f"{payment_data['unique_id']}:{hashlib.sha256(body).hexdigest()}"
+    return None
+
+
+def needs_stored_record(confirm_data):
+    """Whether a /confirm-payment body leaves out the WhatsApp number or the customer name"""
+    return bool(confirm_data.get('uniqueId')) and not (
+        confirm_data.get('whatsapp') and (confirm_data.get('firstName') or confirm_data.get('lastName')))
+
+
+def confirmation_details(confirm_data, record=None):
+    """(unique_id, whatsapp, customer_name) of a /confirm-payment body
+
+    What the client left out is filled in from the stored record, when one is given.
+    """
+    unique_id = confirm_data.get('uniqueId')
+    first_name = confirm_data.get('firstName')
+    last_name = confirm_data.get('lastName')
+    whatsapp = confirm_data.get('whatsapp')
+
+    if record:
+        whatsapp = whatsapp or record.get('whatsapp')
+        if not (first_name or last_name):
+            first_name = record.get('first_name', '')
+            last_name = record.get('last_name', '')
+
+    return unique_id, whatsapp, f"{first_name or ''} {last_name or ''}"
+
+
+def confirmation_response(unique_id, customer_name, whatsapp_queued):
+    """The 202 body of /confirm-payment once the status is updated"""
+    return {
+        'message': 'Payment confirmed successfully and WhatsApp message queued'
+                   if whatsapp_queued else 'Payment confirmed but WhatsApp is not enabled',
+        'unique_id': unique_id,
+        'customer_name': customer_name,
+        'whatsapp_queued': whatsapp_queued,
+        'firestore_updated': True
+    }
+
+
+# Nothing was confirmed, so nothing is queued (a retry must not add outbox rows)
+CONFIRMATION_FAILED = {
+    'error': 'Failed to confirm payment',
+    'firestore_updated': False,
+    'whatsapp_queued': False
+}
+
+
+def bulk_list(body, key):
+    """A JSON array body, or the array under key when the body is an object"""
+    return body.get(key) if isinstance(body, dict) else body
+
+
+def bulk_confirmations_error(payments):
+    """(error, status code) for an invalid /confirm-payments list, or None when it is valid"""
+    if not isinstance(payments, list) or not payments:
+        return 'Expected a non-empty JSON array of payments', 400
+    if len(payments) > MAX_BULK_CONFIRMATIONS:
+        return f'Too many payments (max {MAX_BULK_CONFIRMATIONS})', 413
+    return None
+
+
+def plan_confirmations(payments):
+    """(reports, {unique_id: (whatsapp, customer_name, report)}) for a /confirm-payments list
+
+    There is one report per entry; entries without a uniqueId or number, and
+    repeats of a uniqueId, are reported with an error and not confirmed.
+    """
+    reports = []
+    planned = {}
+    for index, confirm_data in enumerate(payments):
+        unique_id = confirm_data.get('uniqueId') if isinstance(confirm_data, dict) else None
+        whatsapp = confirm_data.get('whatsapp') if isinstance(confirm_data, dict) else None
+        report = {'index': index, 'unique_id': unique_id, 'firestore_updated': False, 'whatsapp_queued': False}
+        reports.append(report)
+
+        if not unique_id or not whatsapp:
+            report['error'] = 'Missing required fields: uniqueId or whatsapp'
+        elif unique_id in planned:
+            report['error'] = 'Duplicate uniqueId in request'
+        else:
+            customer_name = f"{confirm_data.get('firstName', '')} {confirm_data.get('lastName', '')}"
+            planned[unique_id] = (whatsapp, customer_name, report)
+    return reports, planned
+
+
+def apply_confirmation_outcome(planned, outcome):
+    """Write the status update outcome into the reports; returns (confirmed, already_confirmed)
+
+    confirmed lists the (unique_id, whatsapp, customer_name) to message.
+    Records that were already confirmed are skipped, so a re-run messages
+    nobody twice.
+    """
+    confirmed = []
+    already_confirmed = 0
+    for unique_id, (whatsapp, customer_name, report) in planned.items():
+        error = outcome.get(unique_id)
+        if error == ALREADY_IN_STATUS:
+            report['already_confirmed'] = True
+            already_confirmed += 1
+            continue
+        if error:
+            report['error'] = error
+            continue
+        report['firestore_updated'] = True
+        confirmed.append((unique_id, whatsapp, customer_name))
+    return confirmed, already_confirmed
+
+
+def confirmations_response(reports, confirmed, already_confirmed):
+    """The 202 body of /confirm-payments"""
+    return {
+        'total_records': len(reports),
+        'confirmed': len(confirmed),
+        'already_confirmed': already_confirmed,
+        'failed': len(reports) - len(confirmed) - already_confirmed,
+        'results': reports
+    }
+
+
+def save_payment_code_response(unique_id, firestore_saved, payment_code_updated):
+    """(body, status code) of /save-payment-code"""
+    if payment_code_updated and firestore_saved:
+        return {
+            'message': 'Payment code saved successfully to both the payment code store and Firestore. Your merchant UPI ID remains unchanged.',
+            'unique_id': unique_id,
+            'note': 'Data saved to Firestore and payment tracking code updated. UPI_CONFIG is preserved.',
+            'firestore_saved': True
+        }, 200
+    if payment_code_updated:
+        return {
+            'message': 'Payment code saved to the payment code store but Firestore save failed.',
+            'unique_id': unique_id,
+            'firestore_saved': False
+        }, 200
+    return {'error': 'Failed to save payment code'}, 500
+
+
+def json_bulk_items(body):
+    """(index, item, None) for each payment code of a JSON array body (or {"payment_codes": [...]})"""
+    items = bulk_list(body, 'payment_codes')
+    if not isinstance(items, list):
+        raise ValueError('Expected a JSON array of payment codes or an NDJSON stream')
+    return [(index, item, None) for index, item in enumerate(items)]
+
+
+class BulkSave:
+    """Validation and per-item results of one /save-payment-codes request
+
+    The servers feed it the parsed items and write each chunk of valid items
+    it hands back, then report the results in request order.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.chunk = []
+        self.seen_ids = set()
+        self.last_valid = None
+
+    def add(self, index, item, parse_error=None):
+        """Validate one item; returns a chunk to write once BULK_CHUNK_SIZE items are waiting, else None"""
+        error = parse_error or validate_payment_data(item)
+        if not error and index >= MAX_BULK_ITEMS:
+            error = f'Over the limit of {MAX_BULK_ITEMS} payment codes per request'
+        if not error and item['unique_id'] in self.seen_ids:
+            error = 'Duplicate unique_id in request'
+        if error:
+            self.results.append({
+                'index': index,
+                'unique_id': item.get('unique_id') if isinstance(item, dict) else None,
+                'saved': False,
+                'error': error
+            })
+            return None
+
+        # Add default status if not provided
+        item.setdefault('status', 'pending')
+        self.seen_ids.add(item['unique_id'])
+        self.chunk.append((index, item))
+        self.last_valid = item
+        return self.take() if len(self.chunk) >= BULK_CHUNK_SIZE else None
+
+    def take(self):
+        """The (index, item) pairs not handed out yet"""
+        chunk, self.chunk = self.chunk, []
+        return chunk
+
+    def record(self, chunk, firestore_saved):
+        for index, item in chunk:
+            self.results.append({
+                'index': index,
+                'unique_id': item['unique_id'],
+                'saved': firestore_saved,
+                'firestore_saved': firestore_saved
+            })
+
+    def response(self, payment_code_updated):
+        """The /save-payment-codes body"""
+        self.results.sort(key=lambda result: result['index'])
+        saved_count = sum(1 for result in self.results if result['saved'])
+        log.info("Bulk save processed %s payment codes (%s saved)", len(self.results), saved_count)
+        return {
+            'total_records': len(self.results),
+            'saved': saved_count,
+            'failed': len(self.results) - saved_count,
+            'current_payment_code_updated': payment_code_updated,
+            'results': self.results
+        }
+
+
+def build_current_payment_code(payment_data):
+    """Shape a payment request as the current payment code read by the WhatsApp bot"""
+    # Prepare payment code data (NO UPI_ID from customer)
+    return {
+        "unique_id": payment_data['unique_id'],
+        "customer_name": f"{payment_data['first_name']} {payment_data['last_name']}",
+        "email": payment_data['email'],
+        "customer_upi_id": payment_data.get('customer_upi_id', ''),  # Customer UPI for reference only
+        "whatsapp": payment_data['whatsapp'],
+        "created_at": payment_data['timestamp'],
+        "expires_at": payment_data['expiry_time'],
+        "status": "pending"
+    }
+
+
+def log_payment_codes(payment_codes):
+    """Append payment codes to the history journal in a single write (blocking)"""
+    try:
+        logged_at = datetime.now().isoformat()
+        get_journal().append_many([
+            {**payment_data, 'logged_at': logged_at}
+            for payment_data in payment_codes
+        ])
+
+        log.debug("%s payment code(s) logged to %s", len(payment_codes), HISTORY_DIR)
+
+    except Exception as e:
+        log.warning("Error logging payment codes: %s", e)
+
+
+def update_current_payment_code(payment_data):
+    """Make this payment the current payment code served to the WhatsApp bot (blocking)"""
+    try:
+        save_current_payment_code(build_current_payment_code(payment_data))
+
+        # Also save to a separate log file for history
+        log_payment_codes([payment_data])
+
+        log.info("Payment code updated: %s", payment_data['unique_id'], extra=sample())
+
+        return True
+
+    except Exception as e:
+        log.error("Error updating current payment code: %s", e)
+        return False
+
+
+def upi_config_response(upi_config):
+    """(body, status code) of /get-upi-config"""
+    if upi_config:
+        return {
+            'upi_config': dict(upi_config),
+            'note': 'This is your merchant UPI configuration - it should never change'
+        }, 200
+    return {'message': 'No UPI configuration found'}, 404
+
+
+def clean_whatsapp_number(to_number):
+    """Strip '+', spaces and dashes, adding the 91 country code to bare 10-digit numbers"""
+    clean_number = to_number.replace('+', '').replace(' ', '').replace('-', '')
+
+    # Ensure the number has country code (assuming +91 for India if not present)
+    if not clean_number.startswith('91') and len(clean_number) == 10:
+        clean_number = '91' + clean_number
+    return clean_number
+
+
+def confirmation_message(customer_name, unique_id):
+    """Text of the WhatsApp payment confirmation"""
+    return f"""🎉 *Payment Confirmed!*
+
+Hello {customer_name}! 👋
+
+✅ Your payment has been successfully confirmed!
+
+📋 *Payment Details:*
+• Transaction ID: {unique_id}
+• Status: CONFIRMED
+• Date: {datetime.now().strftime('%d/%m/%Y %I:%M %p')}
+
+🎁 Thank you for choosing LegionEdge!
+📱 *Access Your Account:*
+👉 https://legionedge.com/dashboard
+Your Password to access the Notes is {unique_id}
+If you have any questions, feel free to reach out to us.
+
+Best regards,
+LegionEdge Team"""
+
+
+def encode_cursor(doc_id):
+    """Turn the last document ID of a page into an opaque cursor"""
+    return base64.urlsafe_b64encode(doc_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn an opaque cursor back into a document ID"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def parse_datetime_arg(value, name):
+    """Parse an ISO 8601 query parameter, returning None when it is not set"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+    # Firestore treats naive datetimes as UTC; make that explicit for in-memory comparisons
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_page_args(args):
+    """Parse page_size, after, fields, status and created_from/created_to query parameters
+
+    Raises ValueError with a client-facing message when a parameter is invalid.
+    """
+    try:
+        page_size = int(args.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('page_size must be an integer')
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f'page_size must be between 1 and {MAX_PAGE_SIZE}')
+
+    after = args.get('after')
+    fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()]
+
+    return {
+        'page_size': page_size,
+        'after': decode_cursor(after) if after else None,
+        'fields': fields or None,
+        'status': args.get('status') or None,
+        'created_from': parse_datetime_arg(args.get('created_from'), 'created_from'),
+        'created_to': parse_datetime_arg(args.get('created_to'), 'created_to'),
+    }
+
+
+def check_since_args(page_args):
+    """since pages through changes, so it cannot be combined with a cursor or filters"""
+    if page_args['after'] or page_args['status'] or page_args['created_from'] or page_args['created_to']:
+        raise ValueError('since cannot be combined with after, status or created_from/created_to')
+
+
+def records_page(page, has_more):
+    """(records, next_cursor) for a storage or cache page of (document ID, data) pairs"""
+    records = [data for _, data in page]
+    next_cursor = encode_cursor(page[-1][0]) if has_more else None
+    return records, next_cursor
+
+
+def changes_page(changes, page_size, since):
+    """(records, deleted_ids, next_since, has_more) for up to page_size + 1 changes read after since"""
+    has_more = len(changes) > page_size
+    changes = changes[:page_size]
+
+    records = [data for _, _, data, deleted in changes if not deleted]
+    deleted_ids = [doc_id for _, doc_id, _, deleted in changes if deleted]
+    next_since = encode_sync_cursor(changes[-1][0], changes[-1][1]) if changes else since
+
+    return records, deleted_ids, next_since, has_more
+
+
+# Bodies of the list endpoints when no storage backend is configured (500)
+FIRESTORE_DISABLED = {
+    'error': 'Storage not enabled',
+    'message': 'Please configure Firebase Admin SDK or set STORAGE_BACKEND=sqlite'
+}
+CSV_DISABLED = {
+    'error': 'Storage not enabled - CSV functionality migrated to Firestore',
+    'message': 'Please use /firestore-data endpoint'
+}
+
+
+def firestore_page_response(records, page_size, next_cursor):
+    return {
+        'firestore_enabled': True,
+        'total_records': len(records),
+        'page_size': page_size,
+        'next_cursor': next_cursor,
+        'data': records
+    }
+
+
+def firestore_changes_response(records, deleted_ids, next_since, has_more, page_size):
+    return {
+        'firestore_enabled': True,
+        'total_records': len(records),
+        'page_size': page_size,
+        'data': records,
+        'deleted': deleted_ids,
+        'next_since': next_since,
+        'has_more': has_more
+    }
+
+
+def csv_page_response(records, columns, page_size, next_cursor):
+    """The legacy /csv-data body: records keyed by CSV column name"""
+    csv_like_data = [{column: value for (_, column), value in zip(columns, csv_row(item, columns))}
+                     for item in records]
+    return {
+        'csv_file': 'Migrated to Firestore',
+        'total_records': len(csv_like_data),
+        'page_size': page_size,
+        'next_cursor': next_cursor,
+        'data': csv_like_data,
+        'note': 'Data is now stored in Firestore instead of CSV'
+    }
+
+
+def payment_not_found(unique_id):
+    return {'error': 'Payment request not found', 'unique_id': unique_id}
+
+
+def parse_history_limit(args):
+    """Parse the /payment-history limit parameter; raises ValueError with a client-facing message"""
+    try:
+        limit = int(args.get('limit', DEFAULT_HISTORY_LIMIT))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if not 1 <= limit <= MAX_HISTORY_LIMIT:
+        raise ValueError(f'limit must be between 1 and {MAX_HISTORY_LIMIT}')
+    return limit
+
+
+def read_history(journal, args):
+    """The /payment-history body for the query args; raises ValueError with a client-facing message
+
+    Without limit or before: the newest LEGACY_HISTORY_ENTRIES entries as a
+    JSON array, oldest first (the original response). Otherwise one page
+    newest first as {total_records, next_before, data}. unique_id filters
+    either form.
+    """
+    unique_id = args.get('unique_id') or None
+    if 'limit' not in args and 'before' not in args:
+        entries, _ = journal.read_page(limit=LEGACY_HISTORY_ENTRIES, unique_id=unique_id)
+        return entries[::-1]
+
+    entries, next_before = journal.read_page(limit=parse_history_limit(args), before=args.get('before') or None,
+                                             unique_id=unique_id)
+    return {
+        'total_records': len(entries),
+        'next_before': next_before,
+        'data': entries
+    }
+
+
+def encode_sync_cursor(updated_at, doc_id):
+    """Turn the (updated_at, document ID) of the last change into an opaque since cursor"""
+    payload = json.dumps({'t': updated_at.isoformat(), 'id': doc_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+    """Turn a since cursor back into (updated_at, document ID); since=0 means from the start"""
+    if cursor == '0':
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        return datetime.fromisoformat(data['t']), data['id']
+    except (ValueError, KeyError, TypeError, UnicodeError):
+        raise ValueError('Invalid since cursor')
+
+
+def csv_columns(fields):
+    """CSV_COLUMNS limited to the requested fields (all of them when fields is empty)"""
+    return [(field, column) for field, column in CSV_COLUMNS if not fields or field in fields]
+
+
+def csv_row(item, columns):
+    """CSV values of a record, timestamps in ISO 8601 (as in the JSON responses)"""
+    row = []
+    for field, _ in columns:
+        value = item.get(field, 'pending' if field == 'status' else '')
+        row.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+    return row
+
+
+def csv_chunk(rows):
+    """CSV rows encoded as UTF-8 bytes, for one chunk of a streamed export"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def http_last_modified(timestamp):
+    """Last-Modified value (aware datetime, whole seconds) for a datetime or epoch seconds
+
+    None when there is no timestamp or it is less than a second old: HTTP dates
+    have one-second resolution, so a second write within that second would
+    otherwise be answered with 304.
+    """
+    if timestamp is None:
+        return None
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.fromtimestamp(timestamp, timezone.utc)
+    if datetime.now(timezone.utc) - timestamp < timedelta(seconds=1):
+        return None
+    return timestamp.replace(microsecond=0)
+
+
+def not_modified_since(if_modified_since, if_none_match, last_modified):
+    """Whether If-Modified-Since allows a 304; ignored when If-None-Match is sent (RFC 9110)"""
+    return (last_modified is not None and if_modified_since is not None and not if_none_match
+            and last_modified <= if_modified_since)
+
+
+def render_status_page(storage_location, backend_name, record_counts, cache_stats, whatsapp_enabled):
+    """HTML status page served at /
+
+    backend_name is None when storage is not configured, record_counts when
+    the counters could not be read and cache_stats when there is no cache.
+    """
+    record_count = record_counts['total'] if record_counts else 0
+    status_breakdown = ", ".join(
+        f"{status}: {count}" for status, count in sorted(record_counts['status_counts'].items())
+    ) if record_counts else ""
+
+    if cache_stats is None:
+        cache_status = "❌ Disabled"
+    elif cache_stats['ready']:
+        cache_status = (f"✅ Ready ({cache_stats['size']} records, last update "
+                        f"{cache_stats['staleness_seconds']:.0f}s ago{'' if cache_stats['complete'] else ', partial'})")
+    else:
+        cache_status = "⏳ Warming up"
+
+    whatsapp_status = "✅ Enabled" if whatsapp_enabled else "❌ Disabled (Check config.py)"
+    firestore_status = "✅ Enabled" if backend_name else "❌ Disabled (Check Firebase config or STORAGE_BACKEND)"
+
+    return f"""
+    <h1>🔧 Payment Server Running (Firestore Edition)</h1>
+    <p><strong>Payment server is running successfully with Firestore integration!</strong></p>
+
+    <h3>📊 Status Overview:</h3>
+    <ul>
+        <li><strong>Database:</strong> {storage_location or 'Not configured'}</li>
+        <li><strong>Storage Status:</strong> {firestore_status}</li>
+        <li><strong>Cache:</strong> {cache_status}</li>
+        <li><strong>Records:</strong> {record_count}{f" ({status_breakdown})" if status_breakdown else ""}</li>
+        <li><strong>WhatsApp:</strong> {whatsapp_status}</li>
+    </ul>
+
+    <h3>🔗 Available Endpoints:</h3>
+    <ul>
+        <li><code>POST /save-payment-code</code> - Save new payment code (+ Firestore; Idempotency-Key supported)</li>
+        <li><code>POST /save-payment-codes</code> - Save many payment codes (JSON array or NDJSON)</li>
+        <li><code>POST /confirm-payment</code> - Confirm payment & queue WhatsApp confirmation (Idempotency-Key supported)</li>
+        <li><code>POST /confirm-payments</code> - Confirm many payments in one batch</li>
+        <li><code>GET /get-current-payment-code</code> - Get current payment code</li>
+        <li><code>GET /get-upi-config</code> - Check merchant UPI configuration</li>
+        <li><code>GET /payment-history</code> - Get payment history (paged: limit, before, unique_id)</li>
+        <li><code>GET /firestore-data</code> - Get Firestore data as JSON (paged: page_size, after, fields, status, created_from, created_to; since for delta sync)</li>
+        <li><code>GET /payment-requests/&lt;unique_id&gt;</code> - Get one payment request</li>
+        <li><code>DELETE /payment-requests/&lt;unique_id&gt;</code> - Delete a payment request</li>
+        <li><code>GET /metrics</code> - Prometheus metrics (request, storage and Graph API latency, queue depth, cache hits)</li>
+        <li><code>GET /csv-data</code> - Legacy endpoint (returns Firestore data, same paging; format=csv streams a text/csv export, gzip=1 compresses it)</li>
+    </ul>
+
+    <h3>🔥 Firestore Configuration:</h3>
+    <ul>
+        <li><strong>Backend:</strong> {backend_name or 'Not configured'} (STORAGE_BACKEND)</li>
+        <li><strong>Collection:</strong> payment_requests</li>
+        <li><strong>Admin SDK:</strong> {"✅ Initialized" if backend_name == 'firestore' else "❌ Not in use"}</li>
+    </ul>
+
+    <h3>⚠️ Important Notes:</h3>
+    <ul>
+        <li><strong>Migration:</strong> CSV functionality has been replaced with Firestore</li>
+        <li><strong>UPI_CONFIG preservation:</strong> This server will NEVER modify your UPI_CONFIG!</li>
+        <li><strong>Firestore tracking:</strong> All user form data is saved to Firestore with status tracking</li>
+        <li><strong>WhatsApp integration:</strong> Confirmation messages are queued and sent automatically with retries</li>
+        <li><strong>Status updates:</strong> Firestore status is updated when payments are confirmed</li>
+        <li><strong>Real-time sync:</strong> Data is synchronized across all clients</li>
+    </ul>
+
+    <h3>🚀 Setup Instructions:</h3>
+    <ol>
+        <li>Install Firebase Admin SDK: <code>pip install firebase-admin</code></li>
+        <li>Download service account key from Firebase Console</li>
+        <li>Place serviceAccountKey.json in project directory</li>
+        <li>Restart the server</li>
+    </ol>
+    """
+
+
+def register_server_metrics(outbox, idempotency_store, get_payment_cache, expiry_sweeper, record_counts_cache):
+    """Queue depths and cache effectiveness of a payment server process, read when /metrics is scraped"""
+    def cache_stat(name):
+        cache = get_payment_cache()
+        return cache.stats()[name] if cache is not None else None
+
+    def cache_lookup_counts():
+        counts = {
+            ('record_counts', 'hit'): record_counts_cache['hits'],
+            ('record_counts', 'miss'): record_counts_cache['misses'],
+        }
+        payment_cache = get_payment_cache()
+        if payment_cache is not None:
+            counts[('payment_requests', 'hit')] = payment_cache.hits
+            counts[('payment_requests', 'miss')] = payment_cache.misses
+        return counts
+
+    metrics.gauge('confirmation_outbox_depth', 'WhatsApp confirmations waiting to be sent', outbox.depth)
+    metrics.gauge('payment_cache_size', 'Payment requests held by the listener cache',
+                  lambda: cache_stat('size'))
+    metrics.gauge('payment_cache_staleness_seconds', 'Seconds since the cache listener last delivered a change',
+                  lambda: get_payment_cache().staleness_seconds() if get_payment_cache() is not None else None)
+    metrics.gauge('payment_cache_hit_ratio', 'Share of single-record lookups answered by the listener cache',
+                  lambda: cache_stat('hit_ratio'))
+    metrics.counter('idempotency_requests_total',
+                    'Idempotent requests by outcome (new, replayed, in_progress, mismatch)',
+                    lambda: {(result,): count for result, count in idempotency_store.counts.items()},
+                    labelnames=['result'])
+    metrics.counter('payment_codes_expired_total', 'Pending payment codes expired by this process\'s sweeper',
+                    lambda: expiry_sweeper.expired_total if expiry_sweeper else None)
+    metrics.gauge('expiry_sweeper_leader', '1 when this process holds the expiry sweeper lock',
+                  lambda: int(expiry_sweeper.is_leader) if expiry_sweeper else None)
+    metrics.counter('log_records_dropped_total', 'Log records dropped because the log writer fell behind',
+                    dropped_records)
+    metrics.counter('cache_lookups_total', 'Lookups per in-process cache and result', cache_lookup_counts,
+                    labelnames=['cache', 'result'])
@@ -1,420 +1,581 @@
 # payment_server.py
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
-import json
+import hashlib
+import io
 import os
-import re
-import requests
-from datetime import datetime
-import firebase_admin
-from config import get_firebase_credentials
-from firebase_admin import credentials, firestore
+import threading
+import time
+from config_loader import get_config, install_sighup_handler
+from payment_code_store import get_current_payment_code as read_current_payment_code, save_current_payment_code
+from payment_history import get_journal
+from outbox import ConfirmationOutbox
+from idempotency import IdempotencyStore, idempotent
+from graph_client import send_message
+from payment_cache import PAYMENT_CACHE_ENABLED, PaymentRequestCache
+from reconcile import build_index, configured_amount, confirm_matches, reconcile
+from expiry_sweeper import EXPIRY_SWEEP_ENABLED, ExpirySweeper
+from storage import lazy_storage, storage_available
+from payment_requests import (BULK_CHUNK_SIZE, CONFIRMATION_FAILED, CSV_DISABLED, DEFAULT_PAGE_SIZE, EXPORT_PAGE_SIZE,
+                              FIRESTORE_DISABLED, NDJSON_CONTENT_TYPES, BulkSave, apply_confirmation_outcome,
+                              build_current_payment_code, build_payment_record, bulk_confirmations_error, bulk_list,
+                              changes_page, check_since_args, clean_whatsapp_number, confirm_dedup_key,
+                              confirmation_details, confirmation_message, confirmation_response,
+                              confirmations_response, csv_chunk, csv_columns, csv_page_response, csv_row,
+                              decode_cursor, decode_sync_cursor, firestore_changes_response, firestore_page_response,
+                              http_last_modified, json_bulk_items, log_payment_codes, needs_stored_record,
+                              not_modified_since, parse_page_args, payment_not_found, plan_confirmations,
+                              read_history, records_page, register_server_metrics, render_status_page,
+                              save_dedup_key, save_payment_code_response, update_current_payment_code,
+                              upi_config_response, validate_payment_data, whatsapp_number)
+import admission
+import clients
+import compression
+import json_provider
+import health
+import metrics
+from structured_logging import get_logger, mask_phone, sample
+
+log = get_logger("payment_server")
 
 app = Flask(__name__)
+json_provider.install(app)  # orjson-backed jsonify and request.get_json when orjson is installed
 CORS(app)  # Enable CORS for cross-origin requests
+metrics.install(app)  # Request latency histograms and GET /metrics
+admission.install(app)  # In-flight cap (503) and shed-load metrics; rate limits are per route below
+compression.install(app)  # gzip/brotli for bodies over COMPRESSION_MIN_SIZE, negotiated from Accept-Encoding
 
-# Initialize Firebase Admin SDK - FIXED VERSION (same as app.py)
-try:
-    if not firebase_admin._apps:
-        # Method 1: Try environment variable first (for production deployment)
-        firebase_creds = get_firebase_credentials()
-        if firebase_creds:
-            cred = credentials.Certificate(firebase_creds)
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase initialized with environment credentials")
-
-        # Method 2: Try service account key file (for local development)
-        elif os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase initialized with service account key")
-
-        # Method 3: Default credentials (fallback)
-        else:
-            firebase_admin.initialize_app()
-            print("✅ Firebase initialized with default credentials")
-
-    db = firestore.client()
-    FIRESTORE_ENABLED = True
-    print("✅ Firestore client initialized successfully")
-except Exception as e:
-    print(f"❌ Firebase/Firestore initialization error: {e}")
-    FIRESTORE_ENABLED = False
-    db = None
-
-# WhatsApp API Configuration - Import from your config
-try:
-    from config import PHONE_NUMBER_ID, ACCESS_TOKEN
+# Reload the config snapshot on SIGHUP (it also reloads when config.py changes)
+install_sighup_handler()
+
+# payment_requests storage (STORAGE_BACKEND: firestore or sqlite). Each process
+# connects on first use or in the gunicorn post_worker_init warm-up (see clients.py)
+STORAGE_ENABLED = storage_available()
+storage = lazy_storage() if STORAGE_ENABLED else None
+
+
+def create_payment_cache():
+    """In-process copy of payment_requests fed by a Firestore listener; None for other backends"""
+    collection = storage.listen_collection() if STORAGE_ENABLED and PAYMENT_CACHE_ENABLED else None
+    if collection is None:
+        return None
+    cache = PaymentRequestCache(collection)
+    cache.start()
+    return cache
+
+
+clients.register("payment_cache", create_payment_cache)
+
+# Moves pending codes past their expiry_time to 'expired' (one gunicorn worker sweeps, chosen by flock)
+expiry_sweeper = ExpirySweeper(storage) if STORAGE_ENABLED and EXPIRY_SWEEP_ENABLED else None
+
+# WhatsApp API Configuration - read from the config snapshot
+if get_config().phone_number_id and get_config().access_token:
     WHATSAPP_ENABLED = True
-    print("✅ WhatsApp configuration loaded successfully")
-except ImportError:
-    print("⚠️ WhatsApp configuration not found. Please ensure config.py has PHONE_NUMBER_ID and ACCESS_TOKEN")
+    log.info("WhatsApp configuration loaded successfully")
+else:
+    log.warning("WhatsApp configuration not found. Please ensure config.py has PHONE_NUMBER_ID and ACCESS_TOKEN")
     WHATSAPP_ENABLED = False
-    PHONE_NUMBER_ID = None
-    ACCESS_TOKEN = None
 
+# /readyz needs storage; the Graph API is only reported, since confirmations wait in the outbox while it is down
+health.register_check("storage", health.check_storage(storage))
+if WHATSAPP_ENABLED:
+    health.register_check("graph_api", health.check_graph, critical=False)
+
+
+# Record counters are maintained by the storage backend next to every write, so
+# the status page never has to scan the collection
+RECORD_COUNTS_TTL = float(os.getenv('RECORD_COUNTS_TTL', '10'))
+
+_record_counts_cache = {'value': None, 'fetched_at': 0.0, 'hits': 0, 'misses': 0}
+_record_counts_lock = threading.Lock()
 
-def save_to_firestore(data):
-    """Save user data to Firestore"""
-    if not FIRESTORE_ENABLED or not db:
-        print("❌ Firestore not available")
+
+def save_to_storage(data):
+    """Save user data to storage"""
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
         return False
 
     try:
-        # Use unique_id as document ID for easy retrieval
-        doc_ref = db.collection('payment_requests').document(data.get('unique_id', ''))
-
-        # Prepare data for Firestore
-        firestore_data = {
-            'unique_id': data.get('unique_id', ''),
-            'first_name': data.get('first_name', ''),
-            'last_name': data.get('last_name', ''),
-            'email': data.get('email', ''),
-            'whatsapp': data.get('whatsapp', ''),
-            'customer_upi_id': data.get('customer_upi_id', ''),
-            'timestamp': data.get('timestamp', ''),
-            'expiry_time': data.get('expiry_time', ''),
-            'status': data.get('status', 'pending'),
-            'created_at': firestore.SERVER_TIMESTAMP
-        }
-
-        # Save to Firestore
-        doc_ref.set(firestore_data)
-        print(f"📝 User data saved to Firestore: {data.get('unique_id', 'Unknown')}")
+        # Save the record and update the record counters together
+        storage.save_request(build_payment_record(data))
+        log.info("User data saved to %s: %s", storage.name, data.get('unique_id', 'Unknown'), extra=sample())
         return True
 
     except Exception as e:
-        print(f"❌ Error saving to Firestore: {e}")
+        log.error("Error saving to storage: %s", e)
         return False
 
 
-def update_firestore_status(unique_id, status):
-    """Update status of a specific record in Firestore"""
-    if not FIRESTORE_ENABLED or not db:
-        print("❌ Firestore not available")
+def update_storage_status(unique_id, status):
+    """Update status of a specific record in storage"""
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
         return False
 
     try:
-        doc_ref = db.collection('payment_requests').document(unique_id)
-        doc_ref.update({
-            'status': status,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
-        print(f"✅ Updated Firestore status for {unique_id}: {status}")
+        if not storage.update_status(unique_id, status):
+            log.error("Error updating status: %s not found", unique_id)
+            return False
+        log.info("Updated %s status for %s: %s", storage.name, unique_id, status, extra=sample())
         return True
 
     except Exception as e:
-        print(f"❌ Error updating Firestore status: {e}")
+        log.error("Error updating status: %s", e)
         return False
 
 
-def get_firestore_data():
-    """Get all payment requests from Firestore"""
-    if not FIRESTORE_ENABLED or not db:
-        print("❌ Firestore not available")
-        return []
+def delete_from_storage(unique_id):
+    """Delete a payment request, leaving a tombstone for delta sync clients"""
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return False
 
     try:
-        # Get all documents from payment_requests collection
-        docs = db.collection('payment_requests').order_by('created_at', direction=firestore.Query.DESCENDING).stream()
+        if not storage.delete_request(unique_id):
+            log.error("Error deleting from storage: %s not found", unique_id)
+            return False
+        log.info("Deleted %s from %s", unique_id, storage.name)
+        return True
 
-        firestore_data = []
-        for doc in docs:
-            data = doc.to_dict()
-            # Convert Firestore timestamp to string for JSON serialization
-            if 'created_at' in data and data['created_at']:
-                data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'],
-                                                                               'isoformat') else str(data['created_at'])
-            if 'updated_at' in data and data['updated_at']:
-                data['updated_at'] = data['updated_at'].isoformat() if hasattr(data['updated_at'],
-                                                                               'isoformat') else str(data['updated_at'])
+    except Exception as e:
+        log.error("Error deleting from storage: %s", e)
+        return False
 
-            firestore_data.append(data)
 
-        return firestore_data
+def save_many_to_storage(items):
+    """Save a chunk of payment requests in one atomic write (a WriteBatch on Firestore)
 
-    except Exception as e:
-        print(f"❌ Error reading from Firestore: {e}")
-        return []
+    The whole chunk is either saved or not. Returns True on success.
+    """
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return False
 
+    try:
+        storage.save_requests([build_payment_record(item) for item in items])
+        log.info("Saved %s payment requests to %s in one batch", len(items), storage.name, extra=sample())
+        return True
 
-def send_whatsapp_confirmation(to_number, customer_name, unique_id):
-    """Send WhatsApp payment confirmation message"""
-    if not WHATSAPP_ENABLED:
-        print("⚠️ WhatsApp not enabled - skipping message")
+    except Exception as e:
+        log.error("Error saving batch to storage: %s", e)
         return False
 
+
+def update_many_statuses(unique_ids, status):
+    """Set the status of many payment requests, BULK_CHUNK_SIZE at a time
+
+    Returns {unique_id: error or None}.
+    """
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return {unique_id: 'Storage not available' for unique_id in unique_ids}
+
+    outcome = {}
+    for start in range(0, len(unique_ids), BULK_CHUNK_SIZE):
+        chunk_ids = unique_ids[start:start + BULK_CHUNK_SIZE]
+        try:
+            chunk_outcome = storage.update_statuses(chunk_ids, status)
+            outcome.update(chunk_outcome)
+            updated_count = sum(1 for error in chunk_outcome.values() if error is None)
+            log.info("Updated %s status for %s records: %s", storage.name, updated_count, status)
+
+        except Exception as e:
+            log.error("Error updating statuses: %s", e)
+            for unique_id in chunk_ids:
+                outcome.setdefault(unique_id, str(e))
+
+    return outcome
+
+
+def get_record_counts():
+    """Get the maintained record counters, cached in-process for RECORD_COUNTS_TTL seconds
+
+    Returns a dict with 'total' and 'status_counts'; never scans payment_requests.
+    """
+    with _record_counts_lock:
+        cached = _record_counts_cache['value']
+        if cached is not None and time.monotonic() - _record_counts_cache['fetched_at'] < RECORD_COUNTS_TTL:
+            _record_counts_cache['hits'] += 1
+            return cached
+
+        _record_counts_cache['misses'] += 1
+        counts = storage.record_counts()
+        _record_counts_cache['value'] = counts
+        _record_counts_cache['fetched_at'] = time.monotonic()
+        return counts
+
+
+def get_storage_page(page_size=DEFAULT_PAGE_SIZE, after=None, fields=None, status=None,
+                     created_from=None, created_to=None):
+    """Get one page of payment requests, newest first
+
+    Filters and the field projection are pushed into the storage query so only
+    the records on the page are read. Returns (records, next_cursor); next_cursor
+    is None on the last page. Timestamps stay datetimes until the JSON provider
+    (or csv_row) writes them as ISO 8601.
+    """
+    page, has_more = storage.page(page_size, after=after, fields=fields, status=status,
+                                  created_from=created_from, created_to=created_to)
+    return records_page(page, has_more)
+
+
+def get_payment_cache():
+    """This process's started payment request cache, or None when it is disabled"""
+    return clients.get("payment_cache")
+
+
+def payment_cache_stats():
+    """Listener cache stats for the status page, or None without a cache (or while storage is down)"""
     try:
-        # Remove any '+' or spaces from phone number
-        clean_number = to_number.replace('+', '').replace(' ', '').replace('-', '')
+        cache = get_payment_cache()
+    except Exception as e:
+        log.warning("Payment request cache unavailable: %s", e)
+        return None
+    return cache.stats() if cache is not None else None
 
-        # Ensure the number has country code (assuming +91 for India if not present)
-        if not clean_number.startswith('91') and len(clean_number) == 10:
-            clean_number = '91' + clean_number
 
-        # Create confirmation message
-        message = f"""🎉 *Payment Confirmed!*
+def get_payment_page(**page_args):
+    """get_storage_page, answered from the listener cache while it holds the whole collection"""
+    cache = get_payment_cache()
+    if cache is None or not cache.is_complete():
+        return get_storage_page(**page_args)
 
-Hello {customer_name}! 👋
+    page, has_more = cache.page(**page_args)
+    return records_page(page, has_more)
 
-✅ Your payment has been successfully confirmed!
 
-📋 *Payment Details:*
-• Transaction ID: {unique_id}
-• Status: CONFIRMED
-• Date: {datetime.now().strftime('%d/%m/%Y %I:%M %p')}
+def get_payment_request(unique_id):
+    """Get one payment request by ID, from the listener cache when possible"""
+    cache = get_payment_cache()
+    if cache is not None and cache.is_ready():
+        data = cache.get(unique_id)
+        if data is not None:
+            return data
 
-🎁 Thank you for choosing LegionEdge!
-📱 *Access Your Account:*
-👉 https://legionedge.com/dashboard
-Your Password to access the Notes is {unique_id}
-If you have any questions, feel free to reach out to us.
+    if not STORAGE_ENABLED:
+        return None
 
-Best regards,
-LegionEdge Team"""
+    return storage.get_request(unique_id)
 
-        # WhatsApp API endpoint
-        url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
 
-        # Request payload
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": clean_number,
-            "type": "text",
-            "text": {"body": message}
-        }
+def get_storage_changes(since, page_size=DEFAULT_PAGE_SIZE, fields=None):
+    """Get payment requests created, updated or deleted after the since cursor
+
+    Returns (records, deleted_ids, next_since, has_more). Records and
+    tombstones are merged in (updated_at, ID) order, so next_since never skips
+    records written in the same batch. Records written before updated_at was
+    set on creation only show up once they are updated.
+    """
+    return changes_page(storage.changes(decode_sync_cursor(since), page_size + 1, fields), page_size, since)
 
-        # Request headers
-        headers = {
-            "Authorization": f"Bearer {ACCESS_TOKEN}",
-            "Content-Type": "application/json"
-        }
 
-        # Send the message
-        response = requests.post(url, json=payload, headers=headers)
+def conditional_json(payload):
+    """JSON response with a strong ETag of the body; an unchanged resource gets an empty 304
+
+    There is no Last-Modified: the newest updated_at on a page does not change
+    when a record is deleted or a new one shifts the page, so only the body
+    tells whether the page is the same.
+    """
+    response = jsonify(payload)
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def send_whatsapp_confirmation(to_number, customer_name, unique_id):
+    """Send WhatsApp payment confirmation message"""
+    if not WHATSAPP_ENABLED:
+        log.warning("WhatsApp not enabled - skipping message")
+        return False
+
+    try:
+        clean_number = clean_whatsapp_number(to_number)
+        message = confirmation_message(customer_name, unique_id)
+
+        # Send the message over the pooled Graph API session
+        response = send_message(clean_number, "text", {"body": message})
 
         if response.status_code == 200:
-            print(f"✅ WhatsApp confirmation sent to {clean_number}")
+            log.info("WhatsApp confirmation sent to %s", mask_phone(clean_number), extra=sample(unique_id=unique_id))
             return True
         else:
-            print(f"❌ Failed to send WhatsApp message: {response.status_code} - {response.text}")
+            log.error("Failed to send WhatsApp message: %s - %s", response.status_code, response.text)
             return False
 
     except Exception as e:
-        print(f"❌ Error sending WhatsApp message: {e}")
+        log.error("Error sending WhatsApp message: %s", e)
         return False
 
 
-def update_config_with_payment_code(payment_data):
-    """Update config.py with new payment code WITHOUT changing UPI_CONFIG"""
-    try:
-        # Read current config.py
-        config_path = 'config.py'
+def update_whatsapp_status_in_storage(unique_id, status, attempts, error):
+    """Record the delivery state of a queued WhatsApp confirmation on the payment request"""
+    if not STORAGE_ENABLED:
+        return
 
-        if os.path.exists(config_path):
-            with open(config_path, 'r') as f:
-                config_content = f.read()
-        else:
-            # Create basic config if it doesn't exist
-            config_content = '''# config.py
-
-VERIFY_TOKEN = "my_secure_token"
-ACCESS_TOKEN = "EAAX6QYQURsoBO2QxrcAVVMBMkud9q5ZA9zhwvDHMXPorZBHQyUAayZC1rT7JVymFcyIItoRhgVFEmyCoC3swxvfwSGg1DIOAdEiCEu3jRJtJdXzppI"
-PHONE_NUMBER_ID = "712084191980784"
-QR_IMAGE_PATH = "static/qr.jpg"
-MEDIA_ID_FILE = "media_id.txt"
-UPI_CONFIG = {
-    "upi_id": "paytmqr281005050101sy8hsntdk0xt@paytm",
-    "name": "LegionEdge",
-    "amount": "1"
-}
-'''
-
-        # Prepare payment code data (NO UPI_ID from customer)
-        payment_code_data = {
-            "unique_id": payment_data['unique_id'],
-            "customer_name": f"{payment_data['first_name']} {payment_data['last_name']}",
-            "email": payment_data['email'],
-            "customer_upi_id": payment_data.get('customer_upi_id', ''),  # Customer UPI for reference only
-            "whatsapp": payment_data['whatsapp'],
-            "created_at": payment_data['timestamp'],
-            "expires_at": payment_data['expiry_time'],
-            "status": "pending"
-        }
-
-        # Check if CURRENT_PAYMENT_CODE section exists
-        if 'CURRENT_PAYMENT_CODE' not in config_content:
-            # Add CURRENT_PAYMENT_CODE section at the end
-            config_content += '\n\n# Current Payment Code - Auto Updated by Payment Server\n'
-            config_content += 'CURRENT_PAYMENT_CODE = {}\n'
-
-        # Use regex to replace only the CURRENT_PAYMENT_CODE section
-        # This ensures we don't accidentally modify UPI_CONFIG
-        payment_code_str = json.dumps(payment_code_data, indent=4)
-
-        # Pattern to match CURRENT_PAYMENT_CODE = {...}
-        pattern = r'(CURRENT_PAYMENT_CODE\s*=\s*){[^}]*}'
-
-        if re.search(pattern, config_content):
-            # Replace existing CURRENT_PAYMENT_CODE
-            config_content = re.sub(
-                pattern,
-                f'\\1{payment_code_str}',
-                config_content,
-                flags=re.DOTALL
-            )
-        else:
-            # Add new CURRENT_PAYMENT_CODE if not found
-            config_content = config_content.rstrip() + f'\n\nCURRENT_PAYMENT_CODE = {payment_code_str}\n'
+    storage.update_fields(unique_id, {
+        'whatsapp_status': status,
+        'whatsapp_attempts': attempts,
+        'whatsapp_error': error
+    })
 
-        # Write back to config.py
-        with open(config_path, 'w') as f:
-            f.write(config_content)
 
-        # Also save to a separate log file for history
-        log_payment_code(payment_data)
+# WhatsApp confirmations are sent by the outbox's sender threads, off the request path
+confirmation_outbox = ConfirmationOutbox(send_whatsapp_confirmation, update_whatsapp_status_in_storage)
 
-        print(f"✅ Payment code updated: {payment_data['unique_id']}")
-        print("✅ Your merchant UPI ID in UPI_CONFIG remains unchanged!")
+# First responses to /save-payment-code and /confirm-payment, replayed to client retries
+idempotency_store = IdempotencyStore()
 
-        return True
-
-    except Exception as e:
-        print(f"❌ Error updating config.py: {e}")
-        return False
 
+def start_background_workers():
+    """Start this process's outbox sender threads and expiry sweeper
 
-def log_payment_code(payment_data):
-    """Log payment codes to a separate file for history"""
-    try:
-        log_file = 'payment_codes_log.json'
+    Runs in each gunicorn worker (warm-up or first request), never in a
+    master that preloaded the app.
+    """
+    confirmation_outbox.start()
+    if expiry_sweeper is not None:
+        expiry_sweeper.start()
+    health.start()
+    return True
 
-        # Load existing log
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                log_data = json.load(f)
-        else:
-            log_data = []
 
-        # Add new payment code
-        log_entry = {
-            **payment_data,
-            'logged_at': datetime.now().isoformat()
-        }
-        log_data.append(log_entry)
+clients.register("background_workers", start_background_workers)
 
-        # Keep only last 100 entries
-        if len(log_data) > 100:
-            log_data = log_data[-100:]
 
-        # Save updated log
-        with open(log_file, 'w') as f:
-            json.dump(log_data, f, indent=2)
+@app.before_request
+def ensure_background_workers():
+    clients.get("background_workers")
 
-        print(f"📝 Payment code logged to {log_file}")
 
-    except Exception as e:
-        print(f"⚠️ Error logging payment code: {e}")
+# Queue depths and cache effectiveness, read when /metrics is scraped
+register_server_metrics(confirmation_outbox, idempotency_store, get_payment_cache, expiry_sweeper,
+                        _record_counts_cache)
 
 
 @app.route('/confirm-payment', methods=['POST'])
+@admission.limited(number=whatsapp_number)
+@idempotent(idempotency_store, 'confirm-payment', fallback_key=confirm_dedup_key)
 def confirm_payment():
-    """API endpoint to confirm payment and send WhatsApp message"""
+    """API endpoint to confirm payment and queue the WhatsApp confirmation
+
+    Returns 202 once the status is updated and the message is in the outbox;
+    delivery progress is written back to the record's whatsapp_status field.
+    Retries (same Idempotency-Key, or same uniqueId) get the first response
+    back and send no second message.
+    """
     try:
         confirm_data = request.json
 
         if not confirm_data:
             return jsonify({'error': 'No data provided'}), 400
 
-        # Extract data
-        unique_id = confirm_data.get('uniqueId')
-        customer_name = f"{confirm_data.get('firstName', '')} {confirm_data.get('lastName', '')}"
-        whatsapp = confirm_data.get('whatsapp')
+        # Fill in what the client left out from the stored record (served from the cache)
+        record = get_payment_request(confirm_data['uniqueId']) if needs_stored_record(confirm_data) else None
+        unique_id, whatsapp, customer_name = confirmation_details(confirm_data, record)
 
         if not unique_id or not whatsapp:
             return jsonify({'error': 'Missing required fields: uniqueId or whatsapp'}), 400
 
-        print(f"🔄 Confirming payment for: {customer_name} ({unique_id})")
-
-        # Update Firestore status
-        firestore_updated = update_firestore_status(unique_id, 'confirmed')
-
-        # Send WhatsApp confirmation
-        whatsapp_sent = send_whatsapp_confirmation(whatsapp, customer_name, unique_id)
-
-        if firestore_updated and whatsapp_sent:
-            return jsonify({
-                'message': 'Payment confirmed successfully and WhatsApp message sent',
-                'unique_id': unique_id,
-                'customer_name': customer_name,
-                'whatsapp_sent': True,
-                'firestore_updated': True
-            }), 200
-        elif firestore_updated:
-            return jsonify({
-                'message': 'Payment confirmed but WhatsApp message failed',
-                'unique_id': unique_id,
-                'customer_name': customer_name,
-                'whatsapp_sent': False,
-                'firestore_updated': True
-            }), 200
+        log.info("Confirming payment %s", unique_id, extra=sample())
+
+        # Update the stored status
+        firestore_updated = update_storage_status(unique_id, 'confirmed')
+
+        if not firestore_updated:
+            return jsonify(CONFIRMATION_FAILED), 500
+
+        # Queue WhatsApp confirmation
+        whatsapp_queued = False
+        if WHATSAPP_ENABLED:
+            confirmation_outbox.enqueue(unique_id, whatsapp, customer_name)
+            whatsapp_queued = True
         else:
-            return jsonify({
-                'error': 'Failed to confirm payment',
-                'firestore_updated': False,
-                'whatsapp_sent': whatsapp_sent
-            }), 500
+            log.warning("WhatsApp not enabled - skipping message")
+
+        return jsonify(confirmation_response(unique_id, customer_name, whatsapp_queued)), 202
 
     except Exception as e:
-        print(f"❌ Error confirming payment: {e}")
+        log.error("Error confirming payment: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/confirm-payments', methods=['POST'])
+@admission.limited()
+def confirm_payments():
+    """API endpoint to confirm many payments at once
+
+    Takes a JSON array (or {"payments": [...]}) of /confirm-payment bodies.
+    Status changes are applied with batched Firestore writes, then the
+    confirmations are queued in one outbox transaction and sent concurrently by
+    the outbox sender threads. Payments that are already confirmed are
+    reported with already_confirmed and get no second message. Returns one
+    report entry per uniqueId.
+    """
+    try:
+        body = bulk_list(request.get_json(silent=True), 'payments')
+        error = bulk_confirmations_error(body)
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+
+        reports, payments = plan_confirmations(body)
+
+        log.info("Confirming %s payments in bulk", len(payments))
+
+        # Apply all status changes with batched writes
+        outcome = update_many_statuses(list(payments), 'confirmed')
+
+        # Fan out confirmations for the payments that were updated
+        confirmed, already_confirmed = apply_confirmation_outcome(payments, outcome)
+
+        if confirmed and WHATSAPP_ENABLED:
+            confirmation_outbox.enqueue_many(confirmed)
+            for unique_id, _, _ in confirmed:
+                payments[unique_id][2]['whatsapp_queued'] = True
+        elif confirmed:
+            log.warning("WhatsApp not enabled - skipping messages")
+
+        return jsonify(confirmations_response(reports, confirmed, already_confirmed)), 202
+
+    except Exception as e:
+        log.error("Error confirming payments: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/reconcile', methods=['POST'])
+@admission.limited()
+def reconcile_statement():
+    """API endpoint to confirm payments from a bank or PSP statement
+
+    The body is the CSV export; it is matched row by row as it is read (see
+    reconcile.py). Query parameters: dry_run=1 to only report, and
+    note_column / amount_column / reference_column to name the columns when
+    auto-detection fails. Confirmations go through the outbox like
+    /confirm-payments.
+    """
+    if not STORAGE_ENABLED:
+        return jsonify({'error': 'Storage not available'}), 503
+
+    try:
+        dry_run = request.args.get('dry_run') == '1'
+        index = build_index(storage, configured_amount())
+        outbox = confirmation_outbox if WHATSAPP_ENABLED else None
+        confirm_batch = None if dry_run else lambda matches: confirm_matches(storage, outbox, matches)
+        statement = io.TextIOWrapper(request.stream, encoding='utf-8-sig', errors='replace', newline='')
+        result = reconcile(statement, index, confirm_batch,
+                           note_column=request.args.get('note_column'),
+                           amount_column=request.args.get('amount_column'),
+                           reference_column=request.args.get('reference_column'))
+        return jsonify(result), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    except Exception as e:
+        log.error("Error reconciling statement: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/save-payment-code', methods=['POST'])
+@admission.limited(number=whatsapp_number)
+@idempotent(idempotency_store, 'save-payment-code', fallback_key=save_dedup_key)
 def save_payment_code():
-    """API endpoint to save payment code to config.py AND Firestore"""
+    """API endpoint to save payment code to the current payment code store AND Firestore
+
+    Retries with the same Idempotency-Key (or the same body) get the first response back.
+    """
     try:
         payment_data = request.json
 
-        if not payment_data or 'unique_id' not in payment_data:
-            return jsonify({'error': 'Invalid payment data'}), 400
-
-        # Validate required fields
-        required_fields = ['unique_id', 'first_name', 'last_name', 'email', 'whatsapp']
-        for field in required_fields:
-            if field not in payment_data or not payment_data[field]:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
+        validation_error = validate_payment_data(payment_data)
+        if validation_error:
+            return jsonify({'error': validation_error}), 400
 
-        print(f"🔄 Processing payment code: {payment_data['unique_id']}")
+        log.debug("Processing payment code: %s", payment_data['unique_id'])
 
         # Add default status if not provided
         if 'status' not in payment_data:
             payment_data['status'] = 'pending'
 
-        # Save to Firestore first
-        firestore_saved = save_to_firestore(payment_data)
-
-        # Update config.py (preserving UPI_CONFIG)
-        config_updated = update_config_with_payment_code(payment_data)
-
-        if config_updated and firestore_saved:
-            return jsonify({
-                'message': 'Payment code saved successfully to both config.py and Firestore. Your merchant UPI ID remains unchanged.',
-                'unique_id': payment_data['unique_id'],
-                'note': 'Data saved to Firestore and payment tracking code updated. UPI_CONFIG is preserved.',
-                'firestore_saved': True
-            }), 200
-        elif config_updated:
-            return jsonify({
-                'message': 'Payment code saved to config.py but Firestore save failed.',
-                'unique_id': payment_data['unique_id'],
-                'firestore_saved': False
-            }), 200
-        else:
-            return jsonify({'error': 'Failed to save payment code'}), 500
+        # Save to storage first
+        firestore_saved = save_to_storage(payment_data)
+
+        # Update the current payment code (UPI_CONFIG is never touched)
+        payment_code_updated = update_current_payment_code(payment_data)
+
+        body, status_code = save_payment_code_response(payment_data['unique_id'], firestore_saved,
+                                                       payment_code_updated)
+        return jsonify(body), status_code
 
     except Exception as e:
-        print(f"❌ API Error: {e}")
+        log.error("API Error: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def iter_bulk_items():
+    """Yield (index, item, parse_error) from a JSON array body or an NDJSON stream
+
+    NDJSON lines are read from the request stream as they arrive, so large
+    uploads are never held in memory as one document.
+    """
+    if request.mimetype in NDJSON_CONTENT_TYPES:
+        index = 0
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield index, json_provider.loads(line), None
+            except ValueError:
+                yield index, None, 'Invalid JSON line'
+            index += 1
+        return
+
+    yield from json_bulk_items(request.get_json(silent=True))
+
+
+def save_payment_code_chunk(chunk, bulk):
+    """Save one chunk of validated payment codes: one batch write and one journal append"""
+    firestore_saved = save_many_to_storage([item for _, item in chunk])
+    log_payment_codes([item for _, item in chunk])
+    bulk.record(chunk, firestore_saved)
+
+
+@app.route('/save-payment-codes', methods=['POST'])
+@admission.limited()
+def save_payment_codes():
+    """API endpoint to save many payment codes at once
+
+    Accepts a JSON array (or {"payment_codes": [...]}) or an NDJSON stream.
+    Each item is validated like /save-payment-code; valid items are written to
+    Firestore in batches of BULK_CHUNK_SIZE. The last valid item becomes the
+    current payment code. Returns one result per item.
+    """
+    try:
+        bulk = BulkSave()
+        for index, item, parse_error in iter_bulk_items():
+            chunk = bulk.add(index, item, parse_error)
+            if chunk:
+                save_payment_code_chunk(chunk, bulk)
+
+        chunk = bulk.take()
+        if chunk:
+            save_payment_code_chunk(chunk, bulk)
+
+        payment_code_updated = False
+        if bulk.last_valid is not None:
+            try:
+                save_current_payment_code(build_current_payment_code(bulk.last_valid))
+                payment_code_updated = True
+            except Exception as e:
+                log.error("Error updating current payment code: %s", e)
+
+        return jsonify(bulk.response(payment_code_updated)), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error("API Error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -422,20 +583,7 @@ def save_payment_code():
 def get_current_payment_code():
     """API endpoint to get current payment code"""
     try:
-        # Import the current config
-        import importlib
-        import sys
-
-        # Remove config from cache to get fresh data
-        if 'config' in sys.modules:
-            del sys.modules['config']
-
-        import config
-
-        if hasattr(config, 'CURRENT_PAYMENT_CODE'):
-            return jsonify(config.CURRENT_PAYMENT_CODE), 200
-        else:
-            return jsonify({'message': 'No current payment code found'}), 404
+        return jsonify(read_current_payment_code()), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -445,22 +593,8 @@ def get_current_payment_code():
 def get_upi_config():
     """API endpoint to check current UPI configuration (merchant info)"""
     try:
-        import importlib
-        import sys
-
-        # Remove config from cache to get fresh data
-        if 'config' in sys.modules:
-            del sys.modules['config']
-
-        import config
-
-        if hasattr(config, 'UPI_CONFIG'):
-            return jsonify({
-                'upi_config': config.UPI_CONFIG,
-                'note': 'This is your merchant UPI configuration - it should never change'
-            }), 200
-        else:
-            return jsonify({'message': 'No UPI configuration found'}), 404
+        body, status_code = upi_config_response(get_config().upi_config)
+        return jsonify(body), status_code
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -468,147 +602,200 @@ def get_upi_config():
 
 @app.route('/payment-history', methods=['GET'])
 def get_payment_history():
-    """API endpoint to get payment history"""
+    """API endpoint to get payment history
+
+    Without limit or before, returns the newest 100 entries as a JSON array,
+    oldest first (the original response). With limit and/or before (cursor
+    from next_before), returns one page newest first as {total_records,
+    next_before, data}. unique_id filters either form. Last-Modified is the
+    journal's last write, so a repeat request with If-Modified-Since gets a 304
+    without reading any entries.
+    """
     try:
-        log_file = 'payment_codes_log.json'
-
-        if os.path.exists(log_file):
-            with open(log_file, 'r') as f:
-                log_data = json.load(f)
-            return jsonify(log_data), 200
-        else:
-            return jsonify([]), 200
-
+        journal = get_journal()
+        last_modified = http_last_modified(journal.last_modified())
+        if not_modified_since(request.if_modified_since, request.headers.get('If-None-Match'), last_modified):
+            response = Response(status=304)
+            response.last_modified = last_modified
+            return response
+
+        response = jsonify(read_history(journal, request.args))
+        response.last_modified = last_modified
+        return response, 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/firestore-data', methods=['GET'])
 def get_firestore_data_endpoint():
-    """API endpoint to get all payment data from Firestore"""
+    """API endpoint to get one page of payment data from Firestore
+
+    Query parameters: page_size, after (cursor from next_cursor), fields
+    (comma-separated projection), status, created_from and created_to.
+
+    With since=<cursor> (since=0 for a first full sync) only records created or
+    updated after the cursor are returned, plus the IDs of deleted records;
+    poll again with next_since. Responses carry a strong ETag, so a repeat
+    request with If-None-Match gets a 304 when nothing changed.
+    """
+    try:
+        if not STORAGE_ENABLED:
+            return jsonify(FIRESTORE_DISABLED), 500
+
+        page_args = parse_page_args(request.args)
+
+        since = request.args.get('since')
+        if since is not None:
+            check_since_args(page_args)
+            changes = get_storage_changes(since, page_size=page_args['page_size'], fields=page_args['fields'])
+            return conditional_json(firestore_changes_response(*changes, page_args['page_size']))
+
+        firestore_data, next_cursor = get_payment_page(**page_args)
+        return conditional_json(firestore_page_response(firestore_data, page_args['page_size'], next_cursor))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.error("Error reading Firestore data: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/payment-requests/<unique_id>', methods=['GET'])
+def get_payment_request_endpoint(unique_id):
+    """API endpoint to get one payment request by ID"""
     try:
-        if not FIRESTORE_ENABLED:
-            return jsonify({
-                'error': 'Firestore not enabled',
-                'message': 'Please configure Firebase Admin SDK'
-            }), 500
+        record = get_payment_request(unique_id)
+        if record is None:
+            return jsonify(payment_not_found(unique_id)), 404
+        return jsonify(record), 200
+
+    except Exception as e:
+        log.error("Error reading payment request: %s", e)
+        return jsonify({'error': str(e)}), 500
 
-        firestore_data = get_firestore_data()
 
-        return jsonify({
-            'firestore_enabled': True,
-            'total_records': len(firestore_data),
-            'data': firestore_data
-        }), 200
+@app.route('/payment-requests/<unique_id>', methods=['DELETE'])
+def delete_payment_request(unique_id):
+    """API endpoint to delete a payment request (delta sync clients receive a tombstone)"""
+    try:
+        if not STORAGE_ENABLED:
+            return jsonify({'error': 'Storage not enabled'}), 500
+
+        if delete_from_storage(unique_id):
+            return jsonify({'message': 'Payment request deleted', 'unique_id': unique_id}), 200
+        return jsonify(payment_not_found(unique_id)), 404
 
     except Exception as e:
-        print(f"❌ Error reading Firestore data: {e}")
+        log.error("Error deleting payment request: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
+def iter_csv_export(columns, page_args):
+    """Yield the CSV export one Firestore page at a time, header row first"""
+    yield csv_chunk([[column for _, column in columns]])
+
+    after = page_args['after']
+    exported = 0
+    try:
+        while True:
+            records, next_cursor = get_payment_page(**{**page_args, 'page_size': EXPORT_PAGE_SIZE, 'after': after})
+            exported += len(records)
+            yield csv_chunk(csv_row(item, columns) for item in records)
+
+            if not next_cursor:
+                break
+            after = decode_cursor(next_cursor)
+    except Exception as e:
+        # Headers are already sent, so the export can only stop early
+        log.error("CSV export stopped after %s records: %s", exported, e)
+        return
+
+    log.info("CSV export finished: %s records", exported)
+
+
 # Legacy CSV endpoint for compatibility
 @app.route('/csv-data', methods=['GET'])
 def get_csv_data():
-    """Legacy endpoint - now returns Firestore data in CSV-like format for compatibility"""
+    """Legacy endpoint - now returns Firestore data in CSV-like format for compatibility
+
+    Accepts the same paging and filter parameters as /firestore-data.
+    With format=csv the whole (filtered) collection is streamed as text/csv,
+    page by page, compressed as Accept-Encoding allows (gzip=1 forces gzip).
+    """
     try:
-        if not FIRESTORE_ENABLED:
-            return jsonify({
-                'error': 'Firestore not enabled - CSV functionality migrated to Firestore',
-                'message': 'Please use /firestore-data endpoint'
-            }), 500
-
-        firestore_data = get_firestore_data()
-
-        # Convert Firestore data to CSV-like format for compatibility
-        csv_like_data = []
-        for item in firestore_data:
-            csv_like_data.append({
-                'Unique ID': item.get('unique_id', ''),
-                'First Name': item.get('first_name', ''),
-                'Last Name': item.get('last_name', ''),
-                'Email': item.get('email', ''),
-                'WhatsApp': item.get('whatsapp', ''),
-                'Customer UPI ID': item.get('customer_upi_id', ''),
-                'Timestamp': item.get('timestamp', ''),
-                'Expiry Time': item.get('expiry_time', ''),
-                'Status': item.get('status', 'pending')
-            })
-
-        return jsonify({
-            'csv_file': 'Migrated to Firestore',
-            'total_records': len(csv_like_data),
-            'data': csv_like_data,
-            'note': 'Data is now stored in Firestore instead of CSV'
-        }), 200
+        if not STORAGE_ENABLED:
+            return jsonify(CSV_DISABLED), 500
 
+        page_args = parse_page_args(request.args)
+
+        # Only read the fields that make up the CSV columns
+        columns = csv_columns(page_args['fields'])
+        page_args['fields'] = [field for field, _ in columns]
+
+        if request.args.get('format') == 'csv':
+            chunks = iter_csv_export(columns, page_args)
+            headers = {'Content-Disposition': 'attachment; filename="payment_requests.csv"'}
+            if request.args.get('gzip') == '1':
+                chunks = compression.compress_stream(chunks, 'gzip')
+                headers['Content-Encoding'] = 'gzip'
+            return Response(chunks, mimetype='text/csv', headers=headers)
+
+        firestore_data, next_cursor = get_payment_page(**page_args)
+        return conditional_json(csv_page_response(firestore_data, columns, page_args['page_size'], next_cursor))
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"❌ Error reading Firestore data: {e}")
+        log.error("Error reading Firestore data: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup():
+    """Create this worker's storage client, listener cache, Graph API session and background threads now
+
+    Point the platform's health check (or a post-deploy hook) here so the
+    first real request does not pay for connecting. 503 when a client could
+    not be created.
+    """
+    report = clients.warm_up()
+    ready = all(client['ready'] for client in report.values())
+    return jsonify({'ready': ready, 'pid': os.getpid(), 'clients': report}), 200 if ready else 503
+
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is serving requests (no I/O)"""
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness from the cached dependency checks in health.py; 503 when a critical one is failing"""
+    ready, checks = health.readiness()
+    return jsonify({'ready': ready, 'pid': os.getpid(), 'checks': checks}), 200 if ready else 503
+
+
 @app.route('/')
 def serve_payment_form():
     """Serve the payment form HTML"""
-    firestore_count = 0
-
-    if FIRESTORE_ENABLED:
+    record_counts = None
+    if STORAGE_ENABLED:
         try:
-            firestore_data = get_firestore_data()
-            firestore_count = len(firestore_data)
-        except:
-            firestore_count = 0
-
-    whatsapp_status = "✅ Enabled" if WHATSAPP_ENABLED else "❌ Disabled (Check config.py)"
-    firestore_status = "✅ Enabled" if FIRESTORE_ENABLED else "❌ Disabled (Check Firebase config)"
-
-    return f"""
-    <h1>🔧 Payment Server Running (Firestore Edition)</h1>
-    <p><strong>Payment server is running successfully with Firestore integration!</strong></p>
-
-    <h3>📊 Status Overview:</h3>
-    <ul>
-        <li><strong>Database:</strong> Firestore (Cloud)</li>
-        <li><strong>Firestore Status:</strong> {firestore_status}</li>
-        <li><strong>Records:</strong> {firestore_count}</li>
-        <li><strong>WhatsApp:</strong> {whatsapp_status}</li>
-    </ul>
-
-    <h3>🔗 Available Endpoints:</h3>
-    <ul>
-        <li><code>POST /save-payment-code</code> - Save new payment code (+ Firestore)</li>
-        <li><code>POST /confirm-payment</code> - Confirm payment & send WhatsApp</li>
-        <li><code>GET /get-current-payment-code</code> - Get current payment code</li>
-        <li><code>GET /get-upi-config</code> - Check merchant UPI configuration</li>
-        <li><code>GET /payment-history</code> - Get payment history</li>
-        <li><code>GET /firestore-data</code> - Get Firestore data as JSON</li>
-        <li><code>GET /csv-data</code> - Legacy endpoint (returns Firestore data)</li>
-    </ul>
-
-    <h3>🔥 Firestore Configuration:</h3>
-    <ul>
-        <li><strong>Project ID:</strong> {FIREBASE_CONFIG.get('projectId', 'Not configured')}</li>
-        <li><strong>Collection:</strong> payment_requests</li>
-        <li><strong>Admin SDK:</strong> {"✅ Initialized" if FIRESTORE_ENABLED else "❌ Not configured"}</li>
-    </ul>
-
-    <h3>⚠️ Important Notes:</h3>
-    <ul>
-        <li><strong>Migration:</strong> CSV functionality has been replaced with Firestore</li>
-        <li><strong>UPI_CONFIG preservation:</strong> This server will NEVER modify your UPI_CONFIG!</li>
-        <li><strong>Firestore tracking:</strong> All user form data is saved to Firestore with status tracking</li>
-        <li><strong>WhatsApp integration:</strong> Confirmation messages are sent automatically</li>
-        <li><strong>Status updates:</strong> Firestore status is updated when payments are confirmed</li>
-        <li><strong>Real-time sync:</strong> Data is synchronized across all clients</li>
-    </ul>
-
-    <h3>🚀 Setup Instructions:</h3>
-    <ol>
-        <li>Install Firebase Admin SDK: <code>pip install firebase-admin</code></li>
-        <li>Download service account key from Firebase Console</li>
-        <li>Place serviceAccountKey.json in project directory</li>
-        <li>Restart the server</li>
-    </ol>
-    """
+            record_counts = get_record_counts()
+        except Exception as e:
+            log.warning("Error reading record counters: %s", e)
+
+    return render_status_page(
+        storage.describe() if STORAGE_ENABLED else None,
+        storage.name if STORAGE_ENABLED else None,
+        record_counts,
+        payment_cache_stats(),
+        WHATSAPP_ENABLED
+    )
 
 
 if __name__ == '__main__':
@@ -619,7 +806,7 @@ if __name__ == '__main__':
     print("   - CORS: Enabled")
     print("   - Database: Firestore")
     print("   - WhatsApp: " + ("Enabled" if WHATSAPP_ENABLED else "Disabled"))
-    print("   - Firestore: " + ("Enabled" if FIRESTORE_ENABLED else "Disabled"))
+    print("   - Storage: " + (storage.describe() if STORAGE_ENABLED else "Disabled"))
     print()
 
     print("✅ Features:")
@@ -634,8 +821,8 @@ if __name__ == '__main__':
     print("   - Scalable and reliable data storage")
     print()
 
-    if not FIRESTORE_ENABLED:
-        print("⚠️ FIRESTORE SETUP REQUIRED:")
+    if not STORAGE_ENABLED:
+        print("⚠️ FIRESTORE SETUP REQUIRED (or run locally with STORAGE_BACKEND=sqlite):")
         print("   1. Install: pip install firebase-admin")
         print("   2. Download service account key from Firebase Console")
         print("   3. Place serviceAccountKey.json in project directory")
@@ -0,0 +1,902 @@
+# payment_server_async.py - asyncio variant of the payment server (aiohttp)
+#
+#     gunicorn payment_server_async:app --worker-class aiohttp.GunicornWebWorker
+#     python payment_server_async.py
+#
+# Same routes and JSON contracts as payment_server.py. Storage calls are awaited
+# on Firestore's AsyncClient (other backends run in the default executor) and
+# WhatsApp confirmations are sent with aiohttp by asyncio tasks, so one process
+# keeps up to OUTBOX_ASYNC_CONCURRENCY confirmations in flight instead of one
+# per sender thread.
+import asyncio
+import functools
+import hashlib
+import io
+import os
+import re
+import tempfile
+import time
+
+from aiohttp import web
+
+import admission
+import clients
+import compression
+import json_provider
+import health
+import metrics
+from async_storage import get_async_storage
+from config_loader import get_config, install_sighup_handler
+from expiry_sweeper import EXPIRY_SWEEP_ENABLED, ExpirySweeper
+from graph_client_async import AsyncGraphClient
+from idempotency import IN_PROGRESS_BODY, MISMATCH_BODY, IdempotencyStore, is_replayable, request_key
+from outbox import ConfirmationOutbox
+from payment_cache import PAYMENT_CACHE_ENABLED, PaymentRequestCache
+from payment_code_store import get_current_payment_code as read_current_payment_code, save_current_payment_code
+from payment_history import get_journal
+from payment_requests import (BULK_CHUNK_SIZE, CONFIRMATION_FAILED, CSV_DISABLED, DEFAULT_PAGE_SIZE, EXPORT_PAGE_SIZE,
+                              FIRESTORE_DISABLED, NDJSON_CONTENT_TYPES, BulkSave, apply_confirmation_outcome,
+                              build_current_payment_code, build_payment_record, bulk_confirmations_error, bulk_list,
+                              changes_page, check_since_args, clean_whatsapp_number, confirm_dedup_key,
+                              confirmation_details, confirmation_message, confirmation_response,
+                              confirmations_response, csv_chunk, csv_columns, csv_page_response, csv_row,
+                              decode_cursor, decode_sync_cursor, firestore_changes_response, firestore_page_response,
+                              http_last_modified, json_bulk_items, log_payment_codes, needs_stored_record,
+                              not_modified_since, parse_page_args, payment_not_found, plan_confirmations,
+                              read_history, records_page, register_server_metrics, render_status_page,
+                              save_dedup_key, save_payment_code_response, update_current_payment_code,
+                              upi_config_response, validate_payment_data, whatsapp_number)
+from reconcile import build_index, configured_amount, confirm_matches, reconcile
+from storage import get_storage, lazy_storage, storage_available
+from structured_logging import get_logger, mask_phone, sample
+
+log = get_logger("payment_server_async")
+
+# Reload the config snapshot on SIGHUP (it also reloads when config.py changes)
+install_sighup_handler()
+
+# payment_requests storage (STORAGE_BACKEND: firestore or sqlite), connected per process on first use.
+# The AsyncClient is left out of the warm-up: it has to be created on the worker's event loop
+STORAGE_ENABLED = storage_available()
+storage = lazy_storage() if STORAGE_ENABLED else None
+clients.register("async_storage", lambda: get_async_storage(get_storage()), warm=False)
+async_storage = clients.LazyClient("async_storage") if STORAGE_ENABLED else None
+
+
+def create_payment_cache():
+    """In-process copy of payment_requests fed by a Firestore listener; None for other backends"""
+    collection = storage.listen_collection() if STORAGE_ENABLED and PAYMENT_CACHE_ENABLED else None
+    if collection is None:
+        return None
+    cache = PaymentRequestCache(collection)
+    cache.start()
+    return cache
+
+
+clients.register("payment_cache", create_payment_cache)
+
+# Moves pending codes past their expiry_time to 'expired' (one gunicorn worker sweeps, chosen by flock)
+expiry_sweeper = ExpirySweeper(storage) if STORAGE_ENABLED and EXPIRY_SWEEP_ENABLED else None
+
+if get_config().phone_number_id and get_config().access_token:
+    WHATSAPP_ENABLED = True
+    log.info("WhatsApp configuration loaded successfully")
+else:
+    log.warning("WhatsApp configuration not found. Please ensure config.py has PHONE_NUMBER_ID and ACCESS_TOKEN")
+    WHATSAPP_ENABLED = False
+
+# Same readiness checks as payment_server.py
+health.register_check("storage", health.check_storage(storage))
+if WHATSAPP_ENABLED:
+    health.register_check("graph_api", health.check_graph, critical=False)
+
+graph = AsyncGraphClient()
+
+# Record counters, cached in-process for RECORD_COUNTS_TTL seconds (see payment_server.py)
+RECORD_COUNTS_TTL = float(os.getenv('RECORD_COUNTS_TTL', '10'))
+_record_counts_cache = {'value': None, 'fetched_at': 0.0, 'hits': 0, 'misses': 0}
+
+
+def json_response(payload, status=200, headers=None):
+    """JSON from the same encoder as the Flask apps' jsonify (json_provider), so ETags match the sync server"""
+    body = json_provider.dumps_bytes(payload) + b'\n'
+    return web.Response(body=body, status=status, content_type='application/json', charset='utf-8',
+                        headers=headers)
+
+
+def conditional_json(request, payload):
+    """JSON response with a strong ETag of the body; an unchanged resource gets an empty 304
+
+    If-None-Match is compared weakly (compressed responses carry W/ ETags).
+    No Last-Modified, for the reason given in payment_server.conditional_json.
+    """
+    response = json_response(payload)
+    etag = f'"{hashlib.sha256(response.body).hexdigest()}"'
+    response.headers['ETag'] = etag
+    if_none_match = request.headers.get('If-None-Match', '')
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    if etag in tags or if_none_match.strip() == '*':
+        return web.Response(status=304, headers={'ETag': etag})
+    return response
+
+
+async def read_json(request):
+    """Request body as JSON, or None when it is missing or invalid"""
+    try:
+        return await request.json(loads=json_provider.loads)
+    except ValueError:
+        return None
+
+
+# ---- storage helpers ----
+
+async def save_to_storage(data):
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return False
+    try:
+        await async_storage.save_request(build_payment_record(data))
+        log.info("User data saved to %s: %s", storage.name, data.get('unique_id', 'Unknown'), extra=sample())
+        return True
+    except Exception as e:
+        log.error("Error saving to storage: %s", e)
+        return False
+
+
+async def update_storage_status(unique_id, status):
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return False
+    try:
+        if not await async_storage.update_status(unique_id, status):
+            log.error("Error updating status: %s not found", unique_id)
+            return False
+        log.info("Updated %s status for %s: %s", storage.name, unique_id, status, extra=sample())
+        return True
+    except Exception as e:
+        log.error("Error updating status: %s", e)
+        return False
+
+
+async def save_many_to_storage(items):
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return False
+    try:
+        await async_storage.save_requests([build_payment_record(item) for item in items])
+        log.info("Saved %s payment requests to %s in one batch", len(items), storage.name, extra=sample())
+        return True
+    except Exception as e:
+        log.error("Error saving batch to storage: %s", e)
+        return False
+
+
+async def update_many_statuses(unique_ids, status):
+    """Set the status of many payment requests, BULK_CHUNK_SIZE at a time, chunks concurrently"""
+    if not STORAGE_ENABLED:
+        log.error("Storage not available")
+        return {unique_id: 'Storage not available' for unique_id in unique_ids}
+
+    chunks = [unique_ids[start:start + BULK_CHUNK_SIZE] for start in range(0, len(unique_ids), BULK_CHUNK_SIZE)]
+    results = await asyncio.gather(*(async_storage.update_statuses(chunk, status) for chunk in chunks),
+                                   return_exceptions=True)
+    outcome = {}
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            log.error("Error updating statuses: %s", result)
+            outcome.update({unique_id: str(result) for unique_id in chunk})
+        else:
+            outcome.update(result)
+    return outcome
+
+
+async def get_record_counts():
+    cached = _record_counts_cache['value']
+    if cached is not None and time.monotonic() - _record_counts_cache['fetched_at'] < RECORD_COUNTS_TTL:
+        _record_counts_cache['hits'] += 1
+        return cached
+
+    _record_counts_cache['misses'] += 1
+    counts = await async_storage.record_counts()
+    _record_counts_cache['value'] = counts
+    _record_counts_cache['fetched_at'] = time.monotonic()
+    return counts
+
+
+def get_payment_cache():
+    """The listener cache once start_payment_cache has built it, else None (never built on the event loop)"""
+    return clients.peek("payment_cache")
+
+
+def payment_cache_stats():
+    cache = get_payment_cache()
+    return cache.stats() if cache is not None else None
+
+
+async def get_payment_page(**page_args):
+    """One page of payment requests, from the listener cache while it holds the whole collection"""
+    cache = get_payment_cache()
+    if cache is not None and cache.is_complete():
+        # page() takes the cache lock and may sort the whole cache
+        page, has_more = await asyncio.to_thread(cache.page, **page_args)
+    else:
+        page, has_more = await async_storage.page(**page_args)
+    return records_page(page, has_more)
+
+
+async def get_payment_request(unique_id):
+    cache = get_payment_cache()
+    if cache is not None and cache.is_ready():
+        data = cache.get(unique_id)
+        if data is not None:
+            return data
+
+    if not STORAGE_ENABLED:
+        return None
+
+    return await async_storage.get_request(unique_id)
+
+
+async def get_storage_changes(since, page_size=DEFAULT_PAGE_SIZE, fields=None):
+    changes = await async_storage.changes(decode_sync_cursor(since), page_size + 1, fields)
+    return changes_page(changes, page_size, since)
+
+
+# ---- WhatsApp confirmations ----
+
+async def send_whatsapp_confirmation(to_number, customer_name, unique_id):
+    """Send the WhatsApp payment confirmation over the aiohttp session"""
+    if not WHATSAPP_ENABLED:
+        log.warning("WhatsApp not enabled - skipping message")
+        return False
+
+    try:
+        clean_number = clean_whatsapp_number(to_number)
+        status, text = await graph.send_message(clean_number, "text",
+                                                {"body": confirmation_message(customer_name, unique_id)})
+        if status == 200:
+            log.info("WhatsApp confirmation sent to %s", mask_phone(clean_number), extra=sample(unique_id=unique_id))
+            return True
+        log.error("Failed to send WhatsApp message: %s - %s", status, text)
+        return False
+
+    except Exception as e:
+        log.error("Error sending WhatsApp message: %s", e)
+        return False
+
+
+def update_whatsapp_status_in_storage(unique_id, status, attempts, error):
+    """Record the delivery state of a queued confirmation (runs in the default executor)"""
+    if not STORAGE_ENABLED:
+        return
+
+    storage.update_fields(unique_id, {
+        'whatsapp_status': status,
+        'whatsapp_attempts': attempts,
+        'whatsapp_error': error
+    })
+
+
+# Same durable outbox as the sync server; drained by asyncio tasks instead of sender threads
+confirmation_outbox = ConfirmationOutbox(None, update_whatsapp_status_in_storage, workers=0)
+
+# First responses to /save-payment-code and /confirm-payment, replayed to client retries
+idempotency_store = IdempotencyStore()
+
+admission.register_metrics()
+register_server_metrics(confirmation_outbox, idempotency_store, get_payment_cache, expiry_sweeper,
+                        _record_counts_cache)
+
+
+# ---- middlewares and decorators ----
+
+def route_label(request):
+    """Route template in Flask syntax (/payment-requests/<unique_id>), so metrics match the sync server"""
+    if request.match_info.route.resource is None:
+        return "unmatched"
+    return re.sub(r'\{(\w+)\}', r'<\1>', request.match_info.route.resource.canonical)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Allow any origin, like flask_cors.CORS(app)"""
+    if request.method == 'OPTIONS' and 'Access-Control-Request-Method' in request.headers:
+        response = web.Response(status=200)
+        response.headers['Access-Control-Allow-Methods'] = request.headers['Access-Control-Request-Method']
+        if 'Access-Control-Request-Headers' in request.headers:
+            response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if metrics.METRICS_ENABLED:
+            metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, method=request.method,
+                                                  route=route_label(request), status=str(status))
+
+
+def shed(request, status, reason, retry_after):
+    admission.record_shed(request.method, route_label(request), reason)
+    return json_response(admission.rejection_body(status, retry_after), status=status,
+                         headers={'Retry-After': str(retry_after)})
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """gzip/brotli for bodies over COMPRESSION_MIN_SIZE (see compression.install); streams compress themselves"""
+    response = await handler(request)
+    if (not compression.COMPRESSION_ENABLED or not isinstance(response, web.Response) or response.status != 200
+            or request.method == 'HEAD' or 'Content-Encoding' in response.headers
+            or not compression.is_compressible(response.content_type)):
+        return response
+
+    response.headers.add('Vary', 'Accept-Encoding')
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None or response.body is None or len(response.body) < compression.COMPRESSION_MIN_SIZE:
+        return response
+
+    body = response.body
+    if len(body) > 256 * 1024:
+        body = await asyncio.to_thread(compression.compress, body, encoding)
+    else:
+        body = compression.compress(body, encoding)
+    response.body = body
+    response.headers['Content-Encoding'] = encoding
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = f'W/{etag}'
+    return response
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Cap in-flight requests (503 + Retry-After); /metrics and health probes are never shed"""
+    if not admission.ADMISSION_ENABLED or request.path in admission.EXEMPT_PATHS:
+        return await handler(request)
+    if not admission.in_flight_limiter.try_acquire():
+        return shed(request, 503, 'in_flight', 1)
+    try:
+        return await handler(request)
+    finally:
+        admission.in_flight_limiter.release()
+
+
+def limited(per_ip=True, number=None):
+    """Rate limit a handler per client IP and/or per WhatsApp number (see admission.limited)"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            if admission.ADMISSION_ENABLED:
+                rejected = admission.check_rate(
+                    admission.client_ip(request.headers, request.remote) if per_ip else None,
+                    number(await read_json(request)) if number else None
+                )
+                if rejected:
+                    return shed(request, 429, *rejected)
+            return await handler(request)
+        return wrapper
+    return decorator
+
+
+def idempotent(scope, fallback_key=None):
+    """Replay the first response to retries (see idempotency.idempotent)"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            body = await request.read()
+            header_key = request.headers.get('Idempotency-Key')
+            claim = request_key(scope, header_key, body, None if header_key else await read_json(request),
+                                fallback_key)
+            if claim is None:
+                return await handler(request)
+            key, fingerprint = claim
+
+            state, stored = await asyncio.to_thread(idempotency_store.begin, key, fingerprint)
+            if state == 'replay':
+                status_code, content_type, stored_body = stored
+                log.info("Replaying %s response for %s", scope, key)
+                response = web.Response(body=stored_body, status=status_code)
+                response.headers['Content-Type'] = content_type
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            if state == 'in_progress':
+                return json_response(IN_PROGRESS_BODY, status=409, headers={'Retry-After': '1'})
+            if state == 'mismatch':
+                return json_response(MISMATCH_BODY, status=422)
+
+            try:
+                response = await handler(request)
+            except BaseException:
+                await asyncio.to_thread(idempotency_store.release, key)
+                raise
+
+            if not is_replayable(response.status, header_key) or not isinstance(response, web.Response):
+                await asyncio.to_thread(idempotency_store.release, key)
+            else:
+                await asyncio.to_thread(idempotency_store.complete, key, response.status,
+                                        response.headers.get('Content-Type'), response.body)
+            return response
+        return wrapper
+    return decorator
+
+
+routes = web.RouteTableDef()
+
+
+# ---- routes ----
+
+@routes.post('/confirm-payment')
+@limited(number=whatsapp_number)
+@idempotent('confirm-payment', fallback_key=confirm_dedup_key)
+async def confirm_payment(request):
+    """Confirm a payment and queue the WhatsApp confirmation (202)"""
+    try:
+        confirm_data = await read_json(request)
+
+        if not confirm_data:
+            return json_response({'error': 'No data provided'}, status=400)
+
+        # Fill in what the client left out from the stored record (served from the cache)
+        record = await get_payment_request(confirm_data['uniqueId']) if needs_stored_record(confirm_data) else None
+        unique_id, whatsapp, customer_name = confirmation_details(confirm_data, record)
+
+        if not unique_id or not whatsapp:
+            return json_response({'error': 'Missing required fields: uniqueId or whatsapp'}, status=400)
+
+        log.info("Confirming payment %s", unique_id, extra=sample())
+
+        firestore_updated = await update_storage_status(unique_id, 'confirmed')
+
+        if not firestore_updated:
+            return json_response(CONFIRMATION_FAILED, status=500)
+
+        whatsapp_queued = False
+        if WHATSAPP_ENABLED:
+            await asyncio.to_thread(confirmation_outbox.enqueue, unique_id, whatsapp, customer_name)
+            whatsapp_queued = True
+        else:
+            log.warning("WhatsApp not enabled - skipping message")
+
+        return json_response(confirmation_response(unique_id, customer_name, whatsapp_queued), status=202)
+
+    except Exception as e:
+        log.error("Error confirming payment: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.post('/confirm-payments')
+@limited()
+async def confirm_payments(request):
+    """Confirm many payments at once (see payment_server.confirm_payments)"""
+    try:
+        body = bulk_list(await read_json(request), 'payments')
+        error = bulk_confirmations_error(body)
+        if error:
+            return json_response({'error': error[0]}, status=error[1])
+
+        reports, payments = plan_confirmations(body)
+        log.info("Confirming %s payments in bulk", len(payments))
+
+        outcome = await update_many_statuses(list(payments), 'confirmed')
+        confirmed, already_confirmed = apply_confirmation_outcome(payments, outcome)
+
+        if confirmed and WHATSAPP_ENABLED:
+            await asyncio.to_thread(confirmation_outbox.enqueue_many, confirmed)
+            for unique_id, _, _ in confirmed:
+                payments[unique_id][2]['whatsapp_queued'] = True
+        elif confirmed:
+            log.warning("WhatsApp not enabled - skipping messages")
+
+        return json_response(confirmations_response(reports, confirmed, already_confirmed), status=202)
+
+    except Exception as e:
+        log.error("Error confirming payments: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.post('/reconcile')
+@limited()
+async def reconcile_statement(request):
+    """Confirm payments from a bank or PSP statement (see payment_server.reconcile_statement)
+
+    The body is spooled to a temporary file (in memory up to 8 MB) and matched
+    in a worker thread, so the event loop keeps serving while a large export
+    is reconciled.
+    """
+    if not STORAGE_ENABLED:
+        return json_response({'error': 'Storage not available'}, status=503)
+
+    try:
+        spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            spool.write(chunk)
+        spool.seek(0)
+
+        outbox = confirmation_outbox if WHATSAPP_ENABLED else None
+
+        def run():
+            index = build_index(storage, configured_amount())
+            confirm_batch = None
+            if request.query.get('dry_run') != '1':
+                confirm_batch = lambda matches: confirm_matches(storage, outbox, matches)  # noqa: E731
+            with io.TextIOWrapper(spool, encoding='utf-8-sig', errors='replace', newline='') as statement:
+                return reconcile(statement, index, confirm_batch,
+                                 note_column=request.query.get('note_column'),
+                                 amount_column=request.query.get('amount_column'),
+                                 reference_column=request.query.get('reference_column'))
+
+        return json_response(await asyncio.to_thread(run))
+
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+
+    except Exception as e:
+        log.error("Error reconciling statement: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.post('/save-payment-code')
+@limited(number=whatsapp_number)
+@idempotent('save-payment-code', fallback_key=save_dedup_key)
+async def save_payment_code(request):
+    """Save a payment code to storage and make it the current payment code"""
+    try:
+        payment_data = await read_json(request)
+
+        validation_error = validate_payment_data(payment_data)
+        if validation_error:
+            return json_response({'error': validation_error}, status=400)
+
+        log.debug("Processing payment code: %s", payment_data['unique_id'])
+
+        if 'status' not in payment_data:
+            payment_data['status'] = 'pending'
+
+        firestore_saved = await save_to_storage(payment_data)
+        payment_code_updated = await asyncio.to_thread(update_current_payment_code, payment_data)
+
+        body, status_code = save_payment_code_response(payment_data['unique_id'], firestore_saved,
+                                                       payment_code_updated)
+        return json_response(body, status=status_code)
+
+    except Exception as e:
+        log.error("API Error: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+async def iter_bulk_items(request):
+    """Yield (index, item, parse_error) from a JSON array body or an NDJSON stream"""
+    if request.content_type in NDJSON_CONTENT_TYPES:
+        index = 0
+        async for line in request.content:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield index, json_provider.loads(line), None
+            except ValueError:
+                yield index, None, 'Invalid JSON line'
+            index += 1
+        return
+
+    for entry in json_bulk_items(await read_json(request)):
+        yield entry
+
+
+async def save_payment_code_chunk(chunk, bulk):
+    firestore_saved = await save_many_to_storage([item for _, item in chunk])
+    await asyncio.to_thread(log_payment_codes, [item for _, item in chunk])
+    bulk.record(chunk, firestore_saved)
+
+
+@routes.post('/save-payment-codes')
+@limited()
+async def save_payment_codes(request):
+    """Save many payment codes at once (see payment_server.save_payment_codes)"""
+    try:
+        bulk = BulkSave()
+        async for index, item, parse_error in iter_bulk_items(request):
+            chunk = bulk.add(index, item, parse_error)
+            if chunk:
+                await save_payment_code_chunk(chunk, bulk)
+
+        chunk = bulk.take()
+        if chunk:
+            await save_payment_code_chunk(chunk, bulk)
+
+        payment_code_updated = False
+        if bulk.last_valid is not None:
+            try:
+                await asyncio.to_thread(save_current_payment_code, build_current_payment_code(bulk.last_valid))
+                payment_code_updated = True
+            except Exception as e:
+                log.error("Error updating current payment code: %s", e)
+
+        return json_response(bulk.response(payment_code_updated))
+
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        log.error("API Error: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/get-current-payment-code')
+async def get_current_payment_code(request):
+    try:
+        return json_response(await asyncio.to_thread(read_current_payment_code))
+    except Exception as e:
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/get-upi-config')
+async def get_upi_config(request):
+    try:
+        body, status_code = upi_config_response(get_config().upi_config)
+        return json_response(body, status=status_code)
+    except Exception as e:
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/payment-history')
+async def get_payment_history(request):
+    """The newest 100 entries as an array oldest first, or one page newest first with limit/before (see payment_server)"""
+    try:
+        journal = get_journal()
+        last_modified = http_last_modified(await asyncio.to_thread(journal.last_modified))
+        if not_modified_since(request.if_modified_since, request.headers.get('If-None-Match'), last_modified):
+            response = web.Response(status=304)
+            response.last_modified = last_modified
+            return response
+
+        response = json_response(await asyncio.to_thread(read_history, journal, request.query))
+        response.last_modified = last_modified
+        return response
+
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/firestore-data')
+async def get_firestore_data_endpoint(request):
+    """One page of payment data, or the changes since a cursor (see payment_server)"""
+    try:
+        if not STORAGE_ENABLED:
+            return json_response(FIRESTORE_DISABLED, status=500)
+
+        page_args = parse_page_args(request.query)
+
+        since = request.query.get('since')
+        if since is not None:
+            check_since_args(page_args)
+            changes = await get_storage_changes(since, page_size=page_args['page_size'], fields=page_args['fields'])
+            return conditional_json(request, firestore_changes_response(*changes, page_args['page_size']))
+
+        firestore_data, next_cursor = await get_payment_page(**page_args)
+        return conditional_json(request, firestore_page_response(firestore_data, page_args['page_size'],
+                                                                 next_cursor))
+
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        log.error("Error reading Firestore data: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/payment-requests/{unique_id}')
+async def get_payment_request_endpoint(request):
+    unique_id = request.match_info['unique_id']
+    try:
+        record = await get_payment_request(unique_id)
+        if record is None:
+            return json_response(payment_not_found(unique_id), status=404)
+        return json_response(record)
+    except Exception as e:
+        log.error("Error reading payment request: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.delete('/payment-requests/{unique_id}')
+async def delete_payment_request(request):
+    unique_id = request.match_info['unique_id']
+    try:
+        if not STORAGE_ENABLED:
+            return json_response({'error': 'Storage not enabled'}, status=500)
+
+        if await async_storage.delete_request(unique_id):
+            log.info("Deleted %s from %s", unique_id, storage.name)
+            return json_response({'message': 'Payment request deleted', 'unique_id': unique_id})
+        return json_response(payment_not_found(unique_id), status=404)
+
+    except Exception as e:
+        log.error("Error deleting payment request: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+async def stream_csv_export(request, columns, page_args, gzip_output):
+    """Write the CSV export one storage page at a time, header row first
+
+    Compressed as Accept-Encoding allows; gzip_output forces gzip.
+    """
+    encoding = 'gzip' if gzip_output else None
+    if encoding is None and compression.COMPRESSION_ENABLED:
+        encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/csv; charset=utf-8',
+        'Content-Disposition': 'attachment; filename="payment_requests.csv"',
+        'Vary': 'Accept-Encoding',
+        **({'Content-Encoding': encoding} if encoding else {}),
+    })
+    await response.prepare(request)
+
+    compressor = compression.StreamCompressor(encoding) if encoding else None
+
+    async def write(data):
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            await response.write(data)
+
+    await write(csv_chunk([[column for _, column in columns]]))
+
+    after = page_args['after']
+    exported = 0
+    try:
+        while True:
+            records, next_cursor = await get_payment_page(**{**page_args, 'page_size': EXPORT_PAGE_SIZE,
+                                                             'after': after})
+            exported += len(records)
+            await write(csv_chunk(csv_row(item, columns) for item in records))
+
+            if not next_cursor:
+                break
+            after = decode_cursor(next_cursor)
+        log.info("CSV export finished: %s records", exported)
+    except Exception as e:
+        # Headers are already sent, so the export can only stop early
+        log.error("CSV export stopped after %s records: %s", exported, e)
+
+    if compressor is not None:
+        await response.write(compressor.finish())
+    await response.write_eof()
+    return response
+
+
+@routes.get('/csv-data')
+async def get_csv_data(request):
+    """Legacy endpoint - payment data in a CSV-like format, or a streamed text/csv export with format=csv"""
+    try:
+        if not STORAGE_ENABLED:
+            return json_response(CSV_DISABLED, status=500)
+
+        page_args = parse_page_args(request.query)
+        columns = csv_columns(page_args['fields'])
+        page_args['fields'] = [field for field, _ in columns]
+
+        if request.query.get('format') == 'csv':
+            return await stream_csv_export(request, columns, page_args, request.query.get('gzip') == '1')
+
+        firestore_data, next_cursor = await get_payment_page(**page_args)
+        return conditional_json(request, csv_page_response(firestore_data, columns, page_args['page_size'],
+                                                           next_cursor))
+
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        log.error("Error reading Firestore data: %s", e)
+        return json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/')
+async def serve_payment_form(request):
+    record_counts = None
+    if STORAGE_ENABLED:
+        try:
+            record_counts = await get_record_counts()
+        except Exception as e:
+            log.warning("Error reading record counters: %s", e)
+
+    html = render_status_page(
+        async_storage.describe() if STORAGE_ENABLED else None,
+        storage.name if STORAGE_ENABLED else None,
+        record_counts,
+        payment_cache_stats(),
+        WHATSAPP_ENABLED
+    )
+    return web.Response(text=html, content_type='text/html')
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@routes.route('*', '/warmup')
+async def warmup(request):
+    """Create this worker's clients now (see payment_server.warmup); 503 when one could not be created"""
+    report = await asyncio.to_thread(clients.warm_up)
+    if STORAGE_ENABLED:
+        # On the loop itself, like its first use
+        report.update(clients.warm_up(["async_storage"]))
+    ready = all(client['ready'] for client in report.values())
+    return json_response({'ready': ready, 'pid': os.getpid(), 'clients': report}, status=200 if ready else 503)
+
+
+@routes.get('/healthz')
+async def healthz(request):
+    """Liveness: the event loop is serving requests (no I/O)"""
+    return json_response({'status': 'ok', 'pid': os.getpid()})
+
+
+@routes.get('/readyz')
+async def readyz(request):
+    """Readiness from the cached dependency checks in health.py; 503 when a critical one is failing"""
+    # Off the loop: the first call in a process waits for the prober's first round
+    ready, checks = await asyncio.to_thread(health.readiness)
+    return json_response({'ready': ready, 'pid': os.getpid(), 'checks': checks}, status=200 if ready else 503)
+
+
+# ---- application ----
+
+async def start_payment_cache(app):
+    """Build the listener cache (sync Firestore client, backfills, listener) in a thread, off the event loop"""
+    if not (STORAGE_ENABLED and PAYMENT_CACHE_ENABLED):
+        return
+    try:
+        await asyncio.to_thread(clients.get, "payment_cache")
+    except Exception as e:
+        log.warning("Payment request cache unavailable, reading storage instead: %s", e)
+
+
+async def start_background_tasks(app):
+    if expiry_sweeper is not None:
+        expiry_sweeper.start()
+    health.start()
+    await graph.start()
+    app['outbox_drain'] = asyncio.create_task(confirmation_outbox.drain_async(send_whatsapp_confirmation))
+    yield
+    app['outbox_drain'].cancel()
+    try:
+        await app['outbox_drain']
+    except asyncio.CancelledError:
+        pass
+    await graph.close()
+
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware, admission_middleware,
+                                       compression_middleware])
+    app.add_routes(routes)
+    if metrics.METRICS_ENABLED:
+        app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(start_payment_cache)
+    app.cleanup_ctx.append(start_background_tasks)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    print("🚀 Starting asyncio Payment Server...")
+    print("   - Port: 5000")
+    print("   - WhatsApp: " + ("Enabled" if WHATSAPP_ENABLED else "Disabled"))
+    print("   - Storage: " + (async_storage.describe() if STORAGE_ENABLED else "Disabled"))
+    print("=" * 50)
+
+    web.run_app(app, host='0.0.0.0', port=5000)
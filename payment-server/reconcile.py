@@ -0,0 +1,343 @@
+# reconcile.py - confirm payments by matching a bank or PSP statement against open payment codes
+#
+#     python reconcile.py statement.csv              # confirm matches, queue WhatsApp confirmations
+#     python reconcile.py statement.csv --dry-run    # report only
+#     cat statement.csv | python reconcile.py -
+#
+# The bot puts the payment code in the UPI tn field (create_upi_url), and banks
+# copy it into the narration/remarks of the credit. The statement is read row
+# by row, so exports of any size stream through in constant memory; every
+# narration token is looked up in a hash index of the pending and qr_generated
+# codes. The same engine backs POST /reconcile on the payment server.
+# XLSX exports have to be saved as CSV first.
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+
+from config_loader import get_config
+from payment_requests import BULK_CHUNK_SIZE, EXPORT_PAGE_SIZE
+from structured_logging import get_logger
+
+log = get_logger("reconcile")
+
+# Codes a statement row can confirm
+OPEN_STATUSES = ('pending', 'qr_generated')
+# Matches confirmed per batched status update (one Firestore batch)
+RECONCILE_BATCH_SIZE = BULK_CHUNK_SIZE
+# Problem rows listed in the report; the counters are always complete
+RECONCILE_MAX_REPORT_ROWS = int(os.getenv('RECONCILE_MAX_REPORT_ROWS', '1000'))
+# Rows searched for the header (bank exports often start with account details)
+HEADER_SCAN_ROWS = 50
+
+# Header names seen in Indian bank and PSP exports, after normalize_header(), most specific first
+NOTE_COLUMNS = ('transaction note', 'payment note', 'tn', 'remarks', 'transaction remarks', 'narration',
+                'description', 'particulars', 'transaction details', 'details', 'purpose')
+AMOUNT_COLUMNS = ('credit', 'credit amount', 'credit amt', 'cr amount', 'deposit', 'deposits', 'deposit amount',
+                  'deposit amt', 'amount inr', 'transaction amount', 'amount', 'amt')
+REFERENCE_COLUMNS = ('utr', 'utr number', 'utr no', 'rrn', 'reference', 'reference number', 'ref no',
+                     'chq ref no', 'transaction id', 'txn id')
+TYPE_COLUMNS = ('type', 'dr cr', 'cr dr', 'transaction type', 'debit credit')
+# Values of the type column that mark a debit (compared upper-cased, without spaces or dots); anything else is kept
+DEBIT_TYPES = {'D', 'DR', 'DB', 'DEBIT', 'WITHDRAWAL'}
+
+_TOKEN_SPLIT = re.compile(r'[^A-Z0-9_-]+')
+_NON_ALNUM = re.compile(r'[^A-Z0-9]')
+
+
+def normalize_header(name):
+    return re.sub(r'[^a-z0-9]+', ' ', name.lower()).strip()
+
+
+def parse_amount(value):
+    """Amount of a statement cell as a positive Decimal, or None for blanks, debits and non-numbers
+
+    Accepts currency symbols, thousands separators, a trailing CR/DR and
+    accounting-style negatives ("(100.00)").
+    """
+    text = value.strip().upper()
+    if not text or 'DR' in text or text.startswith('-') or text.startswith('('):
+        return None
+    text = re.sub(r'[^0-9.]', '', text)
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        return None
+    return amount.quantize(Decimal('0.01')) if amount > 0 else None
+
+
+class PaymentIndex:
+    """Open payment codes keyed by their upper-cased unique_id, plus an alphanumerics-only
+    variant for banks that strip '-' and '_' from the note"""
+
+    def __init__(self, default_amount=None):
+        self.default_amount = default_amount
+        self.records = {}
+        self._by_code = {}
+        self._by_compact = {}
+
+    def add(self, record):
+        unique_id = record.get('unique_id')
+        if not unique_id:
+            return
+        code = str(unique_id).upper()
+        self.records[unique_id] = record
+        self._by_code[code] = unique_id
+        self._by_compact.setdefault(_NON_ALNUM.sub('', code), set()).add(unique_id)
+
+    def __len__(self):
+        return len(self.records)
+
+    def expected_amount(self, unique_id):
+        amount = self.records[unique_id].get('amount')
+        return parse_amount(str(amount)) if amount not in (None, '') else self.default_amount
+
+    def lookup(self, text):
+        """unique_ids of the open codes that appear as a token of text"""
+        found = set()
+        for token in _TOKEN_SPLIT.split(text.upper()):
+            if not token:
+                continue
+            unique_id = self._by_code.get(token)
+            if unique_id is not None:
+                found.add(unique_id)
+            elif not found:
+                found.update(self._by_compact.get(_NON_ALNUM.sub('', token), ()))
+        return found
+
+
+def build_index(storage, default_amount=None):
+    """PaymentIndex of every pending and qr_generated payment request, read page by page"""
+    index = PaymentIndex(default_amount)
+    fields = ['unique_id', 'status', 'amount', 'whatsapp', 'first_name', 'last_name']
+    for status in OPEN_STATUSES:
+        after = None
+        while True:
+            page, has_more = storage.page(EXPORT_PAGE_SIZE, after=after, fields=fields, status=status)
+            for _, record in page:
+                index.add(record)
+            if not has_more or not page:
+                break
+            after = page[-1][0]
+    return index
+
+
+def configured_amount():
+    """The merchant UPI amount every QR code asks for, unless a record has its own amount"""
+    upi_config = get_config().upi_config or {}
+    return parse_amount(str(upi_config.get('amount', '')))
+
+
+def find_columns(header, note_column=None, amount_column=None, reference_column=None):
+    """Indexes of the note, amount, reference and debit/credit type columns of a header row
+
+    Explicit column names win over the built-in aliases. Returns None when the
+    row has no amount column (so it is not the header).
+    """
+    normalized = [normalize_header(name) for name in header]
+
+    def pick(explicit, aliases):
+        candidates = [normalize_header(explicit)] if explicit else aliases
+        for candidate in candidates:
+            if candidate in normalized:
+                return normalized.index(candidate)
+        return None
+
+    columns = {
+        'note': pick(note_column, NOTE_COLUMNS),
+        'amount': pick(amount_column, AMOUNT_COLUMNS),
+        'reference': pick(reference_column, REFERENCE_COLUMNS),
+        'type': pick(None, TYPE_COLUMNS),
+    }
+    return columns if columns['amount'] is not None else None
+
+
+def confirm_matches(storage, outbox, matches):
+    """Confirm matched codes with one batched status update and queue their WhatsApp confirmations
+
+    matches is a list of (unique_id, record); outbox may be None to send no
+    messages. Returns {unique_id: error or None}.
+    """
+    unique_ids = [unique_id for unique_id, _ in matches]
+    try:
+        outcome = storage.update_statuses(unique_ids, 'confirmed')
+    except Exception as e:
+        log.error("Error confirming reconciled payments: %s", e)
+        return {unique_id: str(e) for unique_id in unique_ids}
+
+    messages = [
+        (unique_id, record['whatsapp'], f"{record.get('first_name', '')} {record.get('last_name', '')}")
+        for unique_id, record in matches
+        if outcome.get(unique_id) is None and record.get('whatsapp')
+    ]
+    if outbox is not None and messages:
+        outbox.enqueue_many(messages)
+    log.info("Reconciliation confirmed %s payments", sum(1 for error in outcome.values() if error is None))
+    return outcome
+
+
+def reconcile(lines, index, confirm_batch=None, note_column=None, amount_column=None, reference_column=None):
+    """Match statement rows to the open codes in index
+
+    lines is any iterable of CSV text lines (a file, or a request stream).
+    Each credit whose note holds exactly one open code with the expected
+    amount is a match; matches are handed to confirm_batch(matches) every
+    RECONCILE_BATCH_SIZE rows, or only reported when confirm_batch is None.
+    Rows with several codes, a different amount or an already matched code
+    are listed in the report. The summary's unique_ids are the confirmed codes
+    (the would-be confirmed ones in a dry run). Raises ValueError when no
+    header row is found.
+    """
+    start = time.perf_counter()
+    summary = {
+        'rows': 0, 'credits': 0, 'matched': 0, 'confirmed': 0, 'failed': 0, 'unmatched': 0,
+        'ambiguous': 0, 'amount_mismatch': 0, 'duplicate': 0,
+    }
+    report = []
+    confirmed_ids = []
+    matched = {}
+    pending = []
+
+    def problem(reason, line_number, row, unique_ids, amount, **extra):
+        summary[reason] += 1
+        if len(report) < RECONCILE_MAX_REPORT_ROWS:
+            report.append({
+                'line': line_number,
+                'reason': reason,
+                'unique_ids': sorted(unique_ids),
+                'amount': str(amount),
+                'reference': row[columns['reference']]
+                if columns['reference'] is not None and len(row) > columns['reference'] else None,
+                'note': text[:200],
+                **extra
+            })
+
+    def flush():
+        if not pending:
+            return
+        if confirm_batch is None:
+            confirmed_ids.extend(unique_id for unique_id, _ in pending)
+        else:
+            outcome = confirm_batch(list(pending))
+            for unique_id, _ in pending:
+                error = outcome.get(unique_id)
+                if error is None:
+                    confirmed_ids.append(unique_id)
+                else:
+                    summary['failed'] += 1
+                    if len(report) < RECONCILE_MAX_REPORT_ROWS:
+                        report.append({'line': matched[unique_id], 'reason': 'confirm_failed',
+                                       'unique_ids': [unique_id], 'error': error})
+        pending.clear()
+
+    reader = csv.reader(lines)
+    columns = None
+    for row in reader:
+        if columns is None:
+            if reader.line_num > HEADER_SCAN_ROWS:
+                break
+            columns = find_columns(row, note_column, amount_column, reference_column)
+            continue
+
+        summary['rows'] += 1
+        if len(row) <= columns['amount']:
+            continue
+        if columns['type'] is not None and len(row) > columns['type'] \
+                and _NON_ALNUM.sub('', row[columns['type']].upper()) in DEBIT_TYPES:
+            continue
+        amount = parse_amount(row[columns['amount']])
+        if amount is None:
+            continue
+        summary['credits'] += 1
+
+        text = row[columns['note']] if columns['note'] is not None and len(row) > columns['note'] else ' '.join(row)
+        unique_ids = index.lookup(text)
+        if not unique_ids:
+            summary['unmatched'] += 1
+            continue
+        if len(unique_ids) > 1:
+            problem('ambiguous', reader.line_num, row, unique_ids, amount)
+            continue
+
+        unique_id = next(iter(unique_ids))
+        if unique_id in matched:
+            problem('duplicate', reader.line_num, row, unique_ids, amount, first_line=matched[unique_id])
+            continue
+        expected = index.expected_amount(unique_id)
+        if expected is not None and amount != expected:
+            problem('amount_mismatch', reader.line_num, row, unique_ids, amount, expected_amount=str(expected))
+            continue
+
+        matched[unique_id] = reader.line_num
+        summary['matched'] += 1
+        pending.append((unique_id, index.records[unique_id]))
+        if len(pending) >= RECONCILE_BATCH_SIZE:
+            flush()
+
+    if columns is None:
+        raise ValueError('No header row with an amount/credit column in the first '
+                         f'{HEADER_SCAN_ROWS} lines; name the columns explicitly')
+    flush()
+
+    problems = sum(summary[key] for key in ('ambiguous', 'amount_mismatch', 'duplicate', 'failed'))
+    summary.update({
+        'confirmed': len(confirmed_ids) if confirm_batch is not None else 0,
+        'dry_run': confirm_batch is None,
+        'open_codes': len(index),
+        'seconds': round(time.perf_counter() - start, 3),
+        'unique_ids': confirmed_ids,
+        'report': report,
+        'report_truncated': problems > len(report),
+    })
+    log.info("Reconciled %s statement rows in %.3f s: %s matched, %s unmatched, %s in the report",
+             summary['rows'], summary['seconds'], summary['matched'], summary['unmatched'], len(report))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confirm payments from a bank or PSP statement (CSV)")
+    parser.add_argument("statement", help="CSV statement export, or - for stdin")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be confirmed")
+    parser.add_argument("--note-column", help="column holding the UPI note (default: auto-detect)")
+    parser.add_argument("--amount-column", help="column holding the credited amount (default: auto-detect)")
+    parser.add_argument("--reference-column", help="column holding the UTR/reference (default: auto-detect)")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    args = parser.parse_args()
+
+    from outbox import ConfirmationOutbox
+    from storage import get_storage
+
+    storage = get_storage()
+    index = build_index(storage, configured_amount())
+    confirm_batch = None
+    if not args.dry_run:
+        # Messages go into the shared outbox; the running payment server's senders deliver them
+        whatsapp_enabled = bool(get_config().phone_number_id and get_config().access_token)
+        outbox = ConfirmationOutbox(None, workers=0) if whatsapp_enabled else None
+        confirm_batch = lambda matches: confirm_matches(storage, outbox, matches)  # noqa: E731
+
+    statement = sys.stdin if args.statement == '-' else open(args.statement, newline='', encoding='utf-8-sig',
+                                                              errors='replace')
+    try:
+        result = reconcile(statement, index, confirm_batch, args.note_column, args.amount_column,
+                           args.reference_column)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        if statement is not sys.stdin:
+            statement.close()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,913 @@
+# storage.py - payment_requests storage backends (Firestore or a local SQLite file), shared by both services
+import importlib
+import importlib.util
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import clients
+from config_loader import get_config
+from metrics import observe_dependency
+from structured_logging import get_logger
+
+log = get_logger("storage")
+
+# "firestore", "sqlite" or the dotted path of a PaymentStorage subclass ("package.module.ClassName")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")
+SQLITE_STORAGE_PATH = os.getenv("SQLITE_STORAGE_PATH", "payments.db")
+
+REQUESTS_COLLECTION = "payment_requests"
+# Deleted payment requests leave a tombstone here so delta sync clients see the delete
+TOMBSTONES_COLLECTION = "payment_request_tombstones"
+
+# firebase-admin (and the gRPC stack under it) is imported by the first
+# FirestoreStorage, so importing this module stays cheap
+firebase_admin = None
+firestore = None
+NotFound = None
+
+
+def import_firebase():
+    """Import firebase-admin on first use; raises RuntimeError when it is not installed
+
+    Returns (firebase_admin, firestore, NotFound), NotFound being the
+    google.api_core error raised when an updated document does not exist.
+    """
+    global firebase_admin, firestore, NotFound
+    if firestore is None:
+        try:
+            import firebase_admin as admin
+            from firebase_admin import firestore as admin_firestore
+            from google.api_core.exceptions import NotFound as api_not_found
+        except ImportError:  # SQLite deployments do not need firebase-admin
+            raise RuntimeError("firebase-admin is not installed")
+        firebase_admin, firestore, NotFound = admin, admin_firestore, api_not_found
+    return firebase_admin, firestore, NotFound
+
+
+def firestore_client_args():
+    """Credentials and project of the initialized Firebase app, for a Firestore client of this process
+
+    firestore.client() caches one client per Firebase app, which a forked
+    worker would share with its parent; callers build their own instead.
+    """
+    app = firebase_admin.get_app()
+    return {'credentials': app.credential.get_credential(), 'project': app.project_id}
+
+# Statuses counted when the Firestore counters are seeded
+KNOWN_STATUSES = ['pending', 'qr_generated', 'confirmed', 'expired']
+# update_statuses outcome of a record that already had the status (nothing is written)
+ALREADY_IN_STATUS = 'Already in that status'
+# Documents read and rewritten per WriteBatch by the one-time Firestore backfills
+BACKFILL_BATCH_SIZE = 400
+
+
+def parse_timestamp(value):
+    """A datetime or ISO 8601 string as a timezone-aware datetime (naive means UTC), or None"""
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    else:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class PaymentStorage:
+    """Operations both services need on payment_requests
+
+    Records are plain dicts with the payment_requests document shape.
+    created_at and updated_at are set by the backend and read back as
+    timezone-aware datetimes, as is expiry_time when it was saved as a
+    datetime. Fields named in timestamp_fields are set to the backend's
+    current time.
+    """
+
+    name = None
+
+    def describe(self):
+        """Short description of where the data lives, for status pages"""
+        raise NotImplementedError
+
+    def save_request(self, record):
+        """Create or replace one record"""
+        raise NotImplementedError
+
+    def save_requests(self, records):
+        """Create or replace many records atomically"""
+        raise NotImplementedError
+
+    def update_status(self, unique_id, status, timestamp_fields=()):
+        """Set the status of one record; returns False when it does not exist"""
+        raise NotImplementedError
+
+    def update_statuses(self, unique_ids, status):
+        """Set the status of many records; returns {unique_id: error or None}
+
+        Records that already have the status are left untouched and reported
+        as ALREADY_IN_STATUS, so callers act only on the ones that changed.
+        """
+        raise NotImplementedError
+
+    def update_fields(self, unique_id, fields, timestamp_fields=()):
+        """Merge non-status fields into one record; returns False when it does not exist"""
+        raise NotImplementedError
+
+    def delete_request(self, unique_id):
+        """Delete one record, leaving a tombstone; returns False when it does not exist"""
+        raise NotImplementedError
+
+    def get_request(self, unique_id):
+        """One record, or None"""
+        raise NotImplementedError
+
+    def record_counts(self):
+        """{'total': int, 'status_counts': {status: count}} without scanning the records"""
+        raise NotImplementedError
+
+    def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        """Records newest first (created_at, then ID, descending), after the record with ID `after`
+
+        Returns ([(unique_id, record)], has_more). Raises ValueError when
+        `after` does not exist.
+        """
+        raise NotImplementedError
+
+    def changes(self, position, limit, fields=None):
+        """Records and tombstones written after position ((updated_at, ID) or None)
+
+        Returns up to `limit` (updated_at, unique_id, record, deleted) tuples in
+        (updated_at, ID) order; record is None for tombstones.
+        """
+        raise NotImplementedError
+
+    def current_pending_request(self, now):
+        """(unique_id, record) of the pending record expiring last, if its expiry_time is after now, else None"""
+        raise NotImplementedError
+
+    def expire_pending_requests(self, now, limit):
+        """Set up to `limit` pending records whose expiry_time is not after now to 'expired'
+
+        Returns the expired IDs; fewer than `limit` means none are left.
+        """
+        raise NotImplementedError
+
+    def listen_collection(self):
+        """Collection the in-process cache can attach an on_snapshot listener to, or None"""
+        return None
+
+
+class FirestoreStorage(PaymentStorage):
+    """payment_requests in Cloud Firestore
+
+    Per-status counters live in payment_stats/payment_requests and are updated
+    in the same transaction or batch as every write.
+    """
+
+    name = "firestore"
+
+    def __init__(self):
+        import_firebase()
+        from firebase_admin import credentials
+        from google.cloud.firestore import Client
+
+        if not firebase_admin._apps:
+            # Method 1: Try environment variable first (for production deployment)
+            firebase_creds = get_config().firebase_credentials
+            if firebase_creds:
+                cred = credentials.Certificate(dict(firebase_creds))
+                firebase_admin.initialize_app(cred)
+                log.info("Firebase initialized with environment credentials")
+
+            # Method 2: Try service account key file (for local development)
+            elif os.path.exists("serviceAccountKey.json"):
+                cred = credentials.Certificate("serviceAccountKey.json")
+                firebase_admin.initialize_app(cred)
+                log.info("Firebase initialized with service account key")
+
+            # Method 3: Default credentials (fallback)
+            else:
+                firebase_admin.initialize_app()
+                log.info("Firebase initialized with default credentials")
+
+        self.db = Client(**firestore_client_args())
+        self.collection = self.db.collection(REQUESTS_COLLECTION)
+        log.info("Firestore client initialized successfully")
+        self._migrate()
+
+    def describe(self):
+        return f"Firestore (project {firebase_admin.get_app().project_id or 'default'})"
+
+    def listen_collection(self):
+        return self.collection
+
+    # ---- one-time backfills ----
+
+    def _migrate(self):
+        """Backfill documents written before a field was queried on
+
+        Each backfill runs until it completes once; the stats document records
+        that, so later processes only read that one document. A failed backfill
+        is logged and retried by the next process.
+        """
+        snapshot = self._stats_ref().get()
+        stats = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        backfills = [
+            # Without updated_at a document never appears in changes(), not even a full sync from since=0
+            ('updated_at_backfilled_at', ['updated_at'], self._missing_updated_at),
+            # String expiry_time values never match the typed range queries of the expiry sweep
+            ('expiry_time_converted_at', ['expiry_time'], self._string_expiry_time),
+        ]
+        for marker, fields, updates_for in backfills:
+            if marker in stats:
+                continue
+            try:
+                self._backfill(marker, fields, updates_for)
+            except Exception as e:
+                log.warning("Firestore backfill %s failed, retrying on next start: %s", marker, e)
+
+    @staticmethod
+    def _missing_updated_at(record):
+        # The backfill is a write: delta sync clients that are already past created_at get the record too
+        return None if record.get('updated_at') else {'updated_at': firestore.SERVER_TIMESTAMP}
+
+    @staticmethod
+    def _string_expiry_time(record):
+        expiry_time = record.get('expiry_time')
+        if not isinstance(expiry_time, str):
+            return None
+        parsed = parse_timestamp(expiry_time)
+        if parsed is None:
+            log.warning("Leaving unparseable expiry_time %r as it is", expiry_time)
+            return None
+        return {'expiry_time': parsed}
+
+    def _backfill(self, marker, fields, updates_for):
+        """Apply updates_for(record) to every document it returns updates for, then set `marker`
+
+        Streams the collection in ID order, reading only `fields`. Each update
+        is conditional on the document being unchanged since it was read, so a
+        concurrent write is never overwritten; the batch then fails as a whole.
+        """
+        updated = 0
+        last = None
+        while True:
+            query = self.collection.order_by('__name__').select(fields).limit(BACKFILL_BATCH_SIZE)
+            if last is not None:
+                query = query.start_after(last)
+            snapshots = list(query.stream())
+
+            batch = self.db.batch()
+            writes = 0
+            for snapshot in snapshots:
+                updates = updates_for(snapshot.to_dict())
+                if updates:
+                    batch.update(snapshot.reference, updates,
+                                 option=self.db.write_option(last_update_time=snapshot.update_time))
+                    writes += 1
+            if writes:
+                batch.commit()
+                updated += writes
+
+            if len(snapshots) < BACKFILL_BATCH_SIZE:
+                break
+            last = snapshots[-1]
+
+        self._stats_ref().set({marker: firestore.SERVER_TIMESTAMP}, merge=True)
+        log.info("Firestore backfill %s done: %s documents updated", marker, updated)
+
+    # ---- counters ----
+
+    def _stats_ref(self):
+        return self.db.collection('payment_stats').document(REQUESTS_COLLECTION)
+
+    def _tombstone_ref(self, unique_id):
+        return self.db.collection(TOMBSTONES_COLLECTION).document(unique_id)
+
+    @staticmethod
+    def _counter_changes(total_delta, status_deltas):
+        """Increment updates for the counters document (empty if nothing changes)"""
+        changes = {}
+        if total_delta:
+            changes['total'] = firestore.Increment(total_delta)
+        status_counts = {status: firestore.Increment(delta) for status, delta in status_deltas.items() if delta}
+        if status_counts:
+            changes['status_counts'] = status_counts
+        return changes
+
+    @staticmethod
+    def _add_transition(status_deltas, previous_status, new_status):
+        if previous_status != new_status:
+            if previous_status:
+                status_deltas[previous_status] = status_deltas.get(previous_status, 0) - 1
+            if new_status:
+                status_deltas[new_status] = status_deltas.get(new_status, 0) + 1
+
+    def _with_timestamps(self, fields, timestamp_fields):
+        return {**fields, **{field: firestore.SERVER_TIMESTAMP for field in timestamp_fields},
+                'updated_at': firestore.SERVER_TIMESTAMP}
+
+    # ---- writes ----
+
+    def _set_in_transaction(self, transaction, doc_ref, record):
+        snapshot = doc_ref.get(transaction=transaction)
+        previous_status = (snapshot.to_dict() or {}).get('status') if snapshot.exists else None
+
+        transaction.set(doc_ref, record)
+        # A re-created record is no longer deleted
+        transaction.delete(self._tombstone_ref(doc_ref.id))
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, record['status'])
+        changes = self._counter_changes(0 if snapshot.exists else 1, status_deltas)
+        if changes:
+            transaction.set(self._stats_ref(), changes, merge=True)
+
+    def save_request(self, record):
+        record = self._with_timestamps(record, ['created_at'])
+        doc_ref = self.collection.document(record['unique_id'])
+        firestore.transactional(self._set_in_transaction)(self.db.transaction(), doc_ref, record)
+
+    def save_requests(self, records):
+        """Save up to ~240 records with one WriteBatch
+
+        Existing statuses are read with a single get_all so the counters stay
+        right when a unique_id is saved again.
+        """
+        doc_refs = [self.collection.document(record['unique_id']) for record in records]
+        previous_statuses = {
+            snapshot.id: (snapshot.to_dict() or {}).get('status')
+            for snapshot in self.db.get_all(doc_refs, field_paths=['status'])
+            if snapshot.exists
+        }
+
+        batch = self.db.batch()
+        total_delta = 0
+        status_deltas = {}
+        for doc_ref, record in zip(doc_refs, records):
+            batch.set(doc_ref, self._with_timestamps(record, ['created_at']))
+            batch.delete(self._tombstone_ref(doc_ref.id))
+
+            if doc_ref.id not in previous_statuses:
+                total_delta += 1
+            self._add_transition(status_deltas, previous_statuses.get(doc_ref.id), record['status'])
+
+        changes = self._counter_changes(total_delta, status_deltas)
+        if changes:
+            batch.set(self._stats_ref(), changes, merge=True)
+        batch.commit()
+
+    def _update_status_in_transaction(self, transaction, doc_ref, status, timestamp_fields):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return False
+
+        previous_status = (snapshot.to_dict() or {}).get('status')
+        transaction.update(doc_ref, self._with_timestamps({'status': status}, timestamp_fields))
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, status)
+        changes = self._counter_changes(0, status_deltas)
+        if changes:
+            transaction.set(self._stats_ref(), changes, merge=True)
+        return True
+
+    def update_status(self, unique_id, status, timestamp_fields=()):
+        doc_ref = self.collection.document(unique_id)
+        return firestore.transactional(self._update_status_in_transaction)(
+            self.db.transaction(), doc_ref, status, timestamp_fields)
+
+    def update_statuses(self, unique_ids, status):
+        """One get_all (to skip missing and unchanged documents and keep the counters right) and one WriteBatch
+
+        Each update is conditional on the document not having changed since
+        get_all read it, so of two concurrent calls only one reports a record
+        as changed; the other's batch fails as a whole.
+        """
+        doc_refs = [self.collection.document(unique_id) for unique_id in unique_ids]
+        snapshots = {snapshot.id: snapshot for snapshot in self.db.get_all(doc_refs, field_paths=['status'])}
+
+        batch = self.db.batch()
+        status_deltas = {}
+        outcome = {}
+        for doc_ref in doc_refs:
+            snapshot = snapshots.get(doc_ref.id)
+            if snapshot is None or not snapshot.exists:
+                outcome[doc_ref.id] = 'Payment request not found'
+                continue
+            previous_status = (snapshot.to_dict() or {}).get('status')
+            if previous_status == status:
+                outcome[doc_ref.id] = ALREADY_IN_STATUS
+                continue
+
+            batch.update(doc_ref, self._with_timestamps({'status': status}, ()),
+                         option=self.db.write_option(last_update_time=snapshot.update_time))
+            outcome[doc_ref.id] = None
+            self._add_transition(status_deltas, previous_status, status)
+
+        changes = self._counter_changes(0, status_deltas)
+        if changes:
+            batch.set(self._stats_ref(), changes, merge=True)
+        if any(error is None for error in outcome.values()):
+            batch.commit()
+        return outcome
+
+    def update_fields(self, unique_id, fields, timestamp_fields=()):
+        try:
+            self.collection.document(unique_id).update(self._with_timestamps(fields, timestamp_fields))
+        except NotFound:
+            return False
+        return True
+
+    def _delete_in_transaction(self, transaction, doc_ref):
+        snapshot = doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return False
+        previous_status = (snapshot.to_dict() or {}).get('status')
+
+        transaction.delete(doc_ref)
+        transaction.set(self._tombstone_ref(doc_ref.id), {
+            'unique_id': doc_ref.id,
+            'deleted_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+
+        status_deltas = {}
+        self._add_transition(status_deltas, previous_status, None)
+        transaction.set(self._stats_ref(), self._counter_changes(-1, status_deltas), merge=True)
+        return True
+
+    def delete_request(self, unique_id):
+        doc_ref = self.collection.document(unique_id)
+        return firestore.transactional(self._delete_in_transaction)(self.db.transaction(), doc_ref)
+
+    # ---- reads ----
+
+    def get_request(self, unique_id):
+        snapshot = self.collection.document(unique_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def _seed_record_counts(self):
+        """Backfill the counters document with aggregation count queries
+
+        Only runs once, when the counters have never been seeded (for example on
+        a collection that predates them). Aggregation queries count server side,
+        so this does not stream the documents.
+        """
+        counts = {
+            'total': self.collection.count().get()[0][0].value,
+            'status_counts': {
+                status: self.collection.where('status', '==', status).count().get()[0][0].value
+                for status in KNOWN_STATUSES
+            },
+            'seeded_at': firestore.SERVER_TIMESTAMP
+        }
+        self._stats_ref().set(counts, merge=True)
+        log.info("Record counters seeded: %s records", counts['total'])
+        return counts
+
+    def record_counts(self):
+        snapshot = self._stats_ref().get()
+        stats = snapshot.to_dict() if snapshot.exists else None
+        if not stats or 'seeded_at' not in stats:
+            stats = self._seed_record_counts()
+        return {
+            'total': stats.get('total', 0),
+            'status_counts': {status: count for status, count in stats.get('status_counts', {}).items() if count}
+        }
+
+    def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        """Filters and the field projection are pushed into the query, so only the page is read"""
+        query = self.collection
+        if status:
+            query = query.where('status', '==', status)
+        if created_from:
+            query = query.where('created_at', '>=', created_from)
+        if created_to:
+            query = query.where('created_at', '<', created_to)
+
+        query = query.order_by('created_at', direction=firestore.Query.DESCENDING)
+
+        if fields:
+            query = query.select(fields)
+
+        if after:
+            cursor_snapshot = self.collection.document(after).get()
+            if not cursor_snapshot.exists:
+                raise ValueError('Invalid cursor')
+            query = query.start_after(cursor_snapshot)
+
+        # Read one extra document to find out whether there is a next page
+        docs = list(query.limit(page_size + 1).stream())
+        return [(doc.id, doc.to_dict()) for doc in docs[:page_size]], len(docs) > page_size
+
+    def current_pending_request(self, now):
+        """One indexed query (composite index: status ASC, expiry_time DESC)
+
+        Codes share one validity window, so the one expiring last is the newest.
+        """
+        docs = list(self.collection.where('status', '==', 'pending').where('expiry_time', '>', now)
+                    .order_by('expiry_time', direction=firestore.Query.DESCENDING).limit(1).stream())
+        return (docs[0].id, docs[0].to_dict()) if docs else None
+
+    def expire_pending_requests(self, now, limit):
+        """One indexed query (composite index: status ASC, expiry_time ASC) and one WriteBatch
+
+        Each update is conditional on the document not having changed since the
+        query read it, so a code confirmed in between is never expired; the
+        batch then fails as a whole and the next sweep retries. Keep `limit`
+        below 500 (Firestore's batch size, minus the counters write).
+        """
+        snapshots = list(self.collection.where('status', '==', 'pending').where('expiry_time', '<=', now)
+                         .order_by('expiry_time').select(['status']).limit(limit).stream())
+        if not snapshots:
+            return []
+
+        batch = self.db.batch()
+        for snapshot in snapshots:
+            batch.update(snapshot.reference, self._with_timestamps({'status': 'expired'}, ['expired_at']),
+                         option=self.db.write_option(last_update_time=snapshot.update_time))
+        batch.set(self._stats_ref(),
+                  self._counter_changes(0, {'pending': -len(snapshots), 'expired': len(snapshots)}), merge=True)
+        batch.commit()
+        return [snapshot.id for snapshot in snapshots]
+
+    def _changes_query(self, collection_name, position, limit, fields=None):
+        query = self.db.collection(collection_name).order_by('updated_at').order_by('__name__')
+        if fields:
+            query = query.select(fields)
+        if position:
+            query = query.start_after({'updated_at': position[0], '__name__': position[1]})
+        return query.limit(limit)
+
+    def changes(self, position, limit, fields=None):
+        if fields and 'updated_at' not in fields:
+            fields = fields + ['updated_at']
+
+        changes = [
+            (doc.get('updated_at'), doc.id, doc.to_dict(), False)
+            for doc in self._changes_query(REQUESTS_COLLECTION, position, limit, fields).stream()
+        ]
+        changes += [
+            (doc.get('updated_at'), doc.id, None, True)
+            for doc in self._changes_query(TOMBSTONES_COLLECTION, position, limit, ['updated_at']).stream()
+        ]
+        changes.sort(key=lambda change: (change[0], change[1]))
+        return changes[:limit]
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_requests (
+    unique_id TEXT PRIMARY KEY,
+    status TEXT,
+    whatsapp TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    expiry_time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_requests_status ON payment_requests (status, created_at);
+CREATE INDEX IF NOT EXISTS idx_payment_requests_created_at ON payment_requests (created_at, unique_id);
+CREATE INDEX IF NOT EXISTS idx_payment_requests_whatsapp ON payment_requests (whatsapp);
+CREATE INDEX IF NOT EXISTS idx_payment_requests_updated_at ON payment_requests (updated_at, unique_id);
+CREATE TABLE IF NOT EXISTS payment_request_tombstones (
+    unique_id TEXT PRIMARY KEY,
+    deleted_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_request_tombstones_updated_at
+    ON payment_request_tombstones (updated_at, unique_id);
+"""
+
+# Created after the expiry_time column is known to exist (see SQLiteStorage._migrate)
+_SQLITE_EXPIRY_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_payment_requests_expiry ON payment_requests (status, expiry_time)
+"""
+
+
+def _to_text(value):
+    """Fixed-width UTC ISO 8601 text, so timestamps sort correctly as strings"""
+    return value.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+
+def _now_text():
+    return _to_text(datetime.now(timezone.utc))
+
+
+class SQLiteStorage(PaymentStorage):
+    """payment_requests in a local SQLite database in WAL mode
+
+    Each record is stored as its JSON document, with status, whatsapp and the
+    timestamps (including expiry_time when it is a datetime) kept in indexed
+    columns. Several gunicorn workers can share
+    one file; writes take the database lock with BEGIN IMMEDIATE. Counters are
+    COUNT(*) queries answered from the status index.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_STORAGE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(_SQLITE_SCHEMA)
+        self._migrate()
+        log.info("SQLite storage ready at %s", path)
+
+    def describe(self):
+        return f"SQLite ({os.path.abspath(self.path)})"
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction that takes the database lock up front"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _migrate(self):
+        """Add the expiry_time column to databases created before it existed"""
+        conn = self._connect()
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(payment_requests)")}
+        if 'expiry_time' not in columns:
+            with self._transaction() as conn:
+                conn.execute("ALTER TABLE payment_requests ADD COLUMN expiry_time TEXT")
+                for unique_id, created_at, updated_at, data in conn.execute(
+                        "SELECT unique_id, created_at, updated_at, data FROM payment_requests").fetchall():
+                    record = json.loads(data)
+                    record['expiry_time'] = parse_timestamp(record.get('expiry_time')) or record.get('expiry_time')
+                    self._write(conn, record, created_at, updated_at)
+            log.info("Added expiry_time column to %s", self.path)
+        conn.execute(_SQLITE_EXPIRY_INDEX)
+
+    @staticmethod
+    def _row_to_record(row, fields=None):
+        created_at, updated_at, expiry_time, data = row
+        record = json.loads(data)
+        record['created_at'] = datetime.fromisoformat(created_at)
+        record['updated_at'] = datetime.fromisoformat(updated_at)
+        if expiry_time:
+            record['expiry_time'] = datetime.fromisoformat(expiry_time)
+        if fields:
+            record = {field: record[field] for field in fields if field in record}
+        return record
+
+    # ---- writes ----
+
+    def _write(self, conn, record, created_at, updated_at):
+        expiry_time = record.get('expiry_time')
+        expiry_time = _to_text(expiry_time) if isinstance(expiry_time, datetime) else None
+        data = {key: value for key, value in record.items()
+                if key not in ('created_at', 'updated_at') and not (key == 'expiry_time' and expiry_time)}
+        conn.execute(
+            "INSERT OR REPLACE INTO payment_requests "
+            "(unique_id, status, whatsapp, created_at, updated_at, expiry_time, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record['unique_id'], record.get('status'), record.get('whatsapp'), created_at, updated_at,
+             expiry_time, json.dumps(data, default=str))
+        )
+
+    def save_request(self, record):
+        self.save_requests([record])
+
+    def save_requests(self, records):
+        now = _now_text()
+        with self._transaction() as conn:
+            for record in records:
+                self._write(conn, record, now, now)
+                conn.execute("DELETE FROM payment_request_tombstones WHERE unique_id = ?", (record['unique_id'],))
+
+    def _update(self, conn, unique_id, fields, timestamp_fields):
+        row = conn.execute(
+            "SELECT created_at, updated_at, expiry_time, data FROM payment_requests WHERE unique_id = ?", (unique_id,)
+        ).fetchone()
+        if row is None:
+            return False
+
+        now = _now_text()
+        record = {**self._row_to_record(row), **fields, **{field: now for field in timestamp_fields}}
+        self._write(conn, record, row[0], now)
+        return True
+
+    def update_status(self, unique_id, status, timestamp_fields=()):
+        with self._transaction() as conn:
+            return self._update(conn, unique_id, {'status': status}, timestamp_fields)
+
+    def update_statuses(self, unique_ids, status):
+        outcome = {}
+        with self._transaction() as conn:
+            for unique_id in unique_ids:
+                row = conn.execute("SELECT status FROM payment_requests WHERE unique_id = ?", (unique_id,)).fetchone()
+                if row is None:
+                    outcome[unique_id] = 'Payment request not found'
+                elif row[0] == status:
+                    outcome[unique_id] = ALREADY_IN_STATUS
+                else:
+                    self._update(conn, unique_id, {'status': status}, ())
+                    outcome[unique_id] = None
+        return outcome
+
+    def update_fields(self, unique_id, fields, timestamp_fields=()):
+        with self._transaction() as conn:
+            return self._update(conn, unique_id, fields, timestamp_fields)
+
+    def delete_request(self, unique_id):
+        now = _now_text()
+        with self._transaction() as conn:
+            deleted = conn.execute("DELETE FROM payment_requests WHERE unique_id = ?", (unique_id,)).rowcount
+            if deleted:
+                conn.execute(
+                    "INSERT OR REPLACE INTO payment_request_tombstones (unique_id, deleted_at, updated_at) "
+                    "VALUES (?, ?, ?)",
+                    (unique_id, now, now)
+                )
+        return bool(deleted)
+
+    # ---- reads ----
+
+    def get_request(self, unique_id):
+        row = self._connect().execute(
+            "SELECT created_at, updated_at, expiry_time, data FROM payment_requests WHERE unique_id = ?", (unique_id,)
+        ).fetchone()
+        return self._row_to_record(row) if row else None
+
+    def record_counts(self):
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM payment_requests GROUP BY status"
+        ).fetchall()
+        return {
+            'total': sum(count for _, count in rows),
+            'status_counts': {status: count for status, count in rows if status}
+        }
+
+    def page(self, page_size, after=None, fields=None, status=None, created_from=None, created_to=None):
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if created_from:
+            conditions.append("created_at >= ?")
+            params.append(_to_text(created_from))
+        if created_to:
+            conditions.append("created_at < ?")
+            params.append(_to_text(created_to))
+
+        conn = self._connect()
+        if after:
+            cursor_row = conn.execute(
+                "SELECT created_at FROM payment_requests WHERE unique_id = ?", (after,)
+            ).fetchone()
+            if cursor_row is None:
+                raise ValueError('Invalid cursor')
+            conditions.append("(created_at < ? OR (created_at = ? AND unique_id < ?))")
+            params.extend([cursor_row[0], cursor_row[0], after])
+
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        rows = conn.execute(
+            "SELECT unique_id, created_at, updated_at, expiry_time, data FROM payment_requests "
+            f"{where}ORDER BY created_at DESC, unique_id DESC LIMIT ?",
+            params + [page_size + 1]
+        ).fetchall()
+
+        page = [(row[0], self._row_to_record(row[1:], fields)) for row in rows[:page_size]]
+        return page, len(rows) > page_size
+
+    def changes(self, position, limit, fields=None):
+        condition = ""
+        params = []
+        if position:
+            updated_at = _to_text(position[0])
+            condition = "WHERE updated_at > ? OR (updated_at = ? AND unique_id > ?) "
+            params = [updated_at, updated_at, position[1]]
+
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT unique_id, created_at, updated_at, expiry_time, data FROM payment_requests "
+            f"{condition}ORDER BY updated_at, unique_id LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        tombstones = conn.execute(
+            "SELECT unique_id, updated_at FROM payment_request_tombstones "
+            f"{condition}ORDER BY updated_at, unique_id LIMIT ?",
+            params + [limit]
+        ).fetchall()
+
+        changes = []
+        for row in rows:
+            record = self._row_to_record(row[1:])
+            if fields:
+                record = {field: record[field] for field in fields + ['updated_at'] if field in record}
+            changes.append((datetime.fromisoformat(row[2]), row[0], record, False))
+        changes += [(datetime.fromisoformat(updated_at), unique_id, None, True) for unique_id, updated_at in tombstones]
+        changes.sort(key=lambda change: (change[0], change[1]))
+        return changes[:limit]
+
+    def current_pending_request(self, now):
+        row = self._connect().execute(
+            "SELECT unique_id, created_at, updated_at, expiry_time, data FROM payment_requests "
+            "WHERE status = 'pending' AND expiry_time > ? ORDER BY expiry_time DESC LIMIT 1",
+            (_to_text(now),)
+        ).fetchone()
+        return (row[0], self._row_to_record(row[1:])) if row else None
+
+    def expire_pending_requests(self, now, limit):
+        with self._transaction() as conn:
+            unique_ids = [row[0] for row in conn.execute(
+                "SELECT unique_id FROM payment_requests WHERE status = 'pending' AND expiry_time <= ? "
+                "ORDER BY expiry_time LIMIT ?",
+                (_to_text(now), limit)
+            )]
+            for unique_id in unique_ids:
+                self._update(conn, unique_id, {'status': 'expired'}, ['expired_at'])
+        return unique_ids
+
+
+class TimedStorage:
+    """Wraps a backend so every storage call is timed in dependency_call_duration_seconds"""
+
+    TIMED_OPERATIONS = ('save_request', 'save_requests', 'update_status', 'update_statuses', 'update_fields',
+                        'delete_request', 'get_request', 'record_counts', 'page', 'changes',
+                        'current_pending_request', 'expire_pending_requests')
+
+    def __init__(self, backend):
+        self.backend = backend
+        for operation in self.TIMED_OPERATIONS:
+            setattr(self, operation, self._timed(backend.name, operation, getattr(backend, operation)))
+
+    @staticmethod
+    def _timed(dependency, operation, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                observe_dependency(dependency, operation, time.perf_counter() - start, error=True)
+                raise
+            observe_dependency(dependency, operation, time.perf_counter() - start)
+            return result
+        return timed
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+BACKENDS = {
+    "firestore": FirestoreStorage,
+    "sqlite": SQLiteStorage,
+}
+
+def _load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, class_name = name.rpartition(".")
+    if not module_name:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def storage_available():
+    """Whether STORAGE_BACKEND can be used here, checked without connecting
+
+    Connection or credential errors only show up on first use (or GET /warmup).
+    """
+    if STORAGE_BACKEND == "firestore" and importlib.util.find_spec("firebase_admin") is None:
+        log.error("Storage initialization error: firebase-admin is not installed")
+        return False
+    return True
+
+
+# One storage per process, created on first use (or by clients.warm_up())
+clients.register("storage", lambda: TimedStorage(_load_backend(STORAGE_BACKEND)()))
+
+
+def get_storage():
+    """The STORAGE_BACKEND storage of this process (with timed calls), created on first use
+
+    Raises when the backend cannot be initialized (e.g. missing Firebase credentials).
+    """
+    return clients.get("storage")
+
+
+def lazy_storage():
+    """Handle to get_storage() for module globals: it connects on first use, in each process"""
+    return clients.LazyClient("storage")
@@ -0,0 +1,45 @@
+# test_reconcile.py - statement matching in reconcile.reconcile (python -m pytest from payment-server)
+from decimal import Decimal
+
+from reconcile import PaymentIndex, reconcile
+
+
+def make_index(*unique_ids, amount='100.00'):
+    index = PaymentIndex(default_amount=Decimal(amount))
+    for unique_id in unique_ids:
+        index.add({'unique_id': unique_id, 'status': 'pending', 'whatsapp': '919800000000'})
+    return index
+
+
+def test_short_rows_are_reported_without_a_reference():
+    lines = [
+        'Date,Amount,Narration,Ref No',
+        '2026-10-16,100.00,UPI/PAY-000001,UTR1',
+        '2026-10-16,100.00,UPI/PAY-000001',            # duplicate, no Ref No column
+        '2026-10-16,100.00,PAY-000002 PAY-000003',     # ambiguous, no Ref No column
+        '2026-10-16,55.00,PAY-000004',                 # amount mismatch, no Ref No column
+    ]
+    confirmed = []
+
+    def confirm_batch(matches):
+        confirmed.extend(unique_id for unique_id, _ in matches)
+        return {unique_id: None for unique_id, _ in matches}
+
+    summary = reconcile(lines, make_index('PAY-000001', 'PAY-000002', 'PAY-000003', 'PAY-000004'), confirm_batch)
+
+    assert confirmed == ['PAY-000001']
+    assert (summary['duplicate'], summary['ambiguous'], summary['amount_mismatch']) == (1, 1, 1)
+    assert [(problem['reason'], problem['reference']) for problem in summary['report']] == [
+        ('duplicate', None), ('ambiguous', None), ('amount_mismatch', None)]
+
+
+def test_deposit_rows_are_credits():
+    lines = [
+        'Date,Type,Amount,Narration',
+        '2026-10-16,Deposit,100.00,PAY-000001',
+        '2026-10-16,DR,100.00,PAY-000002',
+        '2026-10-16,Dr.,100.00,PAY-000003',
+    ]
+    summary = reconcile(lines, make_index('PAY-000001', 'PAY-000002', 'PAY-000003'))
+
+    assert summary['unique_ids'] == ['PAY-000001']
@@ -1,92 +1,84 @@
 # app.py
-from flask import Flask, request
-import qrcode
+from flask import Flask, jsonify, request
+import importlib
 import io
 import os
 import json
 import threading
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import random
 import string
-from PIL import Image, ImageDraw, ImageFont
 import tempfile
-import importlib
-import sys
-from config import get_firebase_credentials
-# Firebase imports for Firestore integration
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-# Your existing imports (only keeping what's needed)
-from config import PHONE_NUMBER_ID, ACCESS_TOKEN, UPI_CONFIG, VERIFY_TOKEN
+from config_loader import get_config, install_sighup_handler
+from payment_code_store import get_current_payment_code as read_current_payment_code
+from graph_client import get_phone_number, send_message, upload_media
+from storage import lazy_storage, storage_available
+import admission
+import clients
+import health
+import json_provider
+import metrics
+from structured_logging import dropped_records, get_logger, mask_phone, sample
+log = get_logger("whatsapp_bot")
 
 app = Flask(__name__)
+json_provider.install(app)  # orjson-backed webhook parsing and jsonify when orjson is installed
+metrics.install(app)  # Request latency histograms and GET /metrics
+admission.install(app)  # In-flight cap (503) and shed-load metrics
+
+# Tokens and UPI_CONFIG are read from the config snapshot, which reloads when
+# config.py changes or on SIGHUP
+install_sighup_handler()
 
 processed_messages = set()
 
-# Initialize Firebase Admin SDK for Firestore
-# Initialize Firebase Admin SDK for Firestore
-try:
-    if not firebase_admin._apps:
-        # Method 1: Try environment variable first (for production deployment)
-        firebase_creds = get_firebase_credentials()
-        if firebase_creds:
-            cred = credentials.Certificate(firebase_creds)
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase initialized with environment credentials")
-
-        # Method 2: Try service account key file (for local development)
-        elif os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-            print("✅ Firebase initialized with service account key")
-
-        # Method 3: Default credentials (fallback)
-        else:
-            firebase_admin.initialize_app()
-            print("✅ Firebase initialized with default credentials")
+# QR codes are generated on background threads with this name
+QR_THREAD_NAME = "qr-generator"
 
-    db = firestore.client()
-    FIRESTORE_ENABLED = True
-    print("✅ Firestore client initialized successfully")
-except Exception as e:
-    print(f"❌ Firebase/Firestore initialization error: {e}")
-    FIRESTORE_ENABLED = False
-    db = None
+metrics.gauge('qr_jobs_in_flight', 'QR codes being generated and sent',
+              lambda: sum(1 for thread in threading.enumerate() if thread.name == QR_THREAD_NAME))
+metrics.counter('log_records_dropped_total', 'Log records dropped because the log writer fell behind',
+                dropped_records)
+metrics.gauge('processed_messages_size', 'Message IDs remembered for webhook deduplication',
+              lambda: len(processed_messages))
 
+# payment_requests storage (STORAGE_BACKEND: firestore or sqlite, same as the payment server).
+# Each process connects on first use or in the gunicorn post_worker_init warm-up (see clients.py)
+STORAGE_ENABLED = storage_available()
+storage = lazy_storage() if STORAGE_ENABLED else None
 
-def get_current_payment_code_from_firestore():
-    """Get the most recent pending payment code from Firestore"""
-    if not FIRESTORE_ENABLED or not db:
-        print("[❌] Firestore not available, falling back to config method")
-        return get_current_payment_code_from_config()
+# /readyz needs storage (payment codes) and the Graph API (replies); the prober starts with the warm-up
+health.register_check("storage", health.check_storage(storage))
+health.register_check("graph_api", health.check_graph)
+clients.register("health_prober", health.start)
 
-    try:
-        # Get the most recent pending payment request
-        docs = db.collection('payment_requests').where('status', '==', 'pending').order_by('created_at',
-                                                                                           direction=firestore.Query.DESCENDING).limit(
-            1).stream()
 
-        for doc in docs:
-            payment_data = doc.to_dict()
+def import_qr_modules():
+    """Pillow and qrcode are imported by the QR helpers on first use; the warm-up imports them ahead of the first QR"""
+    for module in ("qrcode", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFont"):
+        importlib.import_module(module)
+    return True
+
+
+clients.register("qr_modules", import_qr_modules)
 
-            # Check if payment code is still valid (not expired)
-            expiry_time = payment_data.get('expiry_time')
-            if expiry_time:
-                try:
-                    if isinstance(expiry_time, str):
-                        expiry_datetime = datetime.fromisoformat(expiry_time.replace('Z', '+00:00'))
-                    else:
-                        expiry_datetime = expiry_time
 
-                    if datetime.now(expiry_datetime.tzinfo) > expiry_datetime:
-                        print(f"[⚠️] Payment code {payment_data.get('unique_id')} has expired")
-                        continue
-                except Exception as e:
-                    print(f"[⚠️] Error parsing expiry time: {e}")
+def get_current_payment_code_from_storage():
+    """Get the newest pending payment code that has not expired from storage"""
+    if not STORAGE_ENABLED:
+        log.error("Storage not available, falling back to payment code store")
+        return get_current_payment_code_from_store()
 
-            print(f"[📋] Found active payment code from Firestore: {payment_data.get('unique_id')}")
+    try:
+        # One indexed query that only matches codes whose expiry_time is still ahead
+        found = storage.current_pending_request(datetime.now(timezone.utc))
+
+        if found:
+            _, payment_data = found
+            expiry_time = payment_data.get('expiry_time', '')
+            log.info("Found active payment code from %s: %s", storage.name, payment_data.get('unique_id'),
+                     extra=sample())
             return {
                 'unique_id': payment_data.get('unique_id', ''),
                 'customer_name': f"{payment_data.get('first_name', '')} {payment_data.get('last_name', '')}".strip(),
@@ -94,69 +86,61 @@ def get_current_payment_code_from_firestore():
                 'customer_upi_id': payment_data.get('customer_upi_id', ''),
                 'whatsapp': payment_data.get('whatsapp', ''),
                 'created_at': payment_data.get('timestamp', ''),
-                'expires_at': payment_data.get('expiry_time', ''),
+                'expires_at': expiry_time.isoformat() if isinstance(expiry_time, datetime) else expiry_time,
                 'status': payment_data.get('status', 'pending')
             }
 
-        print("[⚠️] No active payment codes found in Firestore")
+        log.warning("No active payment codes found in %s", storage.name)
         return None
 
     except Exception as e:
-        print(f"[❌] Error getting payment code from Firestore: {e}")
-        # Fallback to config method
-        return get_current_payment_code_from_config()
+        log.error("Error getting payment code from storage: %s", e)
+        # Fallback to payment code store
+        return get_current_payment_code_from_store()
 
 
-def get_current_payment_code_from_config():
-    """Fallback method: Get current payment code from config.py"""
+def get_current_payment_code_from_store():
+    """Fallback method: Get current payment code saved by the payment server"""
     try:
-        # Remove config from cache to get fresh data
-        if 'config' in sys.modules:
-            del sys.modules['config']
-
-        # Re-import config to get latest data
-        import config
+        payment_code = read_current_payment_code()
 
-        if hasattr(config, 'CURRENT_PAYMENT_CODE') and config.CURRENT_PAYMENT_CODE:
-            print(f"[📋] Found payment code from config: {config.CURRENT_PAYMENT_CODE.get('unique_id', 'No ID')}")
-            return config.CURRENT_PAYMENT_CODE
+        if payment_code:
+            log.info("Found payment code from store: %s", payment_code.get('unique_id', 'No ID'), extra=sample())
+            return payment_code
         else:
-            print("[⚠️] No CURRENT_PAYMENT_CODE found in config.py or it's empty")
+            log.warning("No current payment code found in the payment code store")
             return None
     except Exception as e:
-        print(f"[❌] Error getting current payment code from config: {e}")
+        log.error("Error getting current payment code from store: %s", e)
         return None
 
 
 def get_current_payment_code():
-    """Main function to get current payment code - tries Firestore first, then config"""
-    # Try Firestore first
-    payment_code = get_current_payment_code_from_firestore()
+    """Main function to get current payment code - tries storage first, then the payment code store"""
+    # Try storage first
+    payment_code = get_current_payment_code_from_storage()
 
     if payment_code:
         return payment_code
 
-    # Fallback to config method
-    print("[⚠️] Falling back to config.py method")
-    return get_current_payment_code_from_config()
+    # Fallback to payment code store
+    log.warning("Falling back to payment code store")
+    return get_current_payment_code_from_store()
 
 
-def update_payment_status_in_firestore(unique_id, status):
-    """Update payment status in Firestore when QR is generated"""
-    if not FIRESTORE_ENABLED or not db:
-        print("[⚠️] Firestore not available, skipping status update")
+def update_payment_status_in_storage(unique_id, status):
+    """Update payment status in storage when QR is generated (keeps the payment server's counters in step)"""
+    if not STORAGE_ENABLED:
+        log.warning("Storage not available, skipping status update")
         return
 
     try:
-        doc_ref = db.collection('payment_requests').document(unique_id)
-        doc_ref.update({
-            'status': status,
-            'qr_generated_at': firestore.SERVER_TIMESTAMP,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
-        print(f"[✅] Updated Firestore status for {unique_id}: {status}")
+        if not storage.update_status(unique_id, status, timestamp_fields=['qr_generated_at']):
+            log.error("Error updating status: %s not found", unique_id)
+            return
+        log.info("Updated %s status for %s: %s", storage.name, unique_id, status, extra=sample())
     except Exception as e:
-        print(f"[❌] Error updating Firestore status: {e}")
+        log.error("Error updating status: %s", e)
 
 
 def generate_transaction_note():
@@ -165,14 +149,14 @@ def generate_transaction_note():
 
     if payment_code and payment_code.get('unique_id'):
         # Use the unique_id from payment server as transaction note
-        print(f"[✅] Using payment code as TXN: {payment_code['unique_id']}")
+        log.debug("Using payment code as TXN: %s", payment_code['unique_id'])
         return payment_code['unique_id']
     else:
         # Fallback to random generation
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         random_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
         fallback_txn = f"TXN-{timestamp}-{random_code}"
-        print(f"[⚠️] No payment code found, using fallback TXN: {fallback_txn}")
+        log.warning("No payment code found, using fallback TXN: %s", fallback_txn)
         return fallback_txn
 
 
@@ -182,8 +166,9 @@ def create_upi_url(transaction_note):
 
     # Always use merchant UPI from config (never use customer UPI for payment)
     # Customer UPI is only for reference/tracking
-    upi_id = UPI_CONFIG['upi_id']
-    name = UPI_CONFIG['name']
+    upi_config = get_config().upi_config
+    upi_id = upi_config['upi_id']
+    name = upi_config['name']
 
     # Use customer name in transaction note if available
     if payment_code and payment_code.get('customer_name'):
@@ -191,7 +176,7 @@ def create_upi_url(transaction_note):
     else:
         display_name = name
 
-    return f"upi://pay?pa={upi_id}&pn={display_name}&am={UPI_CONFIG['amount']}&tn={transaction_note}"
+    return f"upi://pay?pa={upi_id}&pn={display_name}&am={upi_config['amount']}&tn={transaction_note}"
 
 
 def load_company_logo(logo_path, size=(120, 80)):
@@ -199,6 +184,7 @@ def load_company_logo(logo_path, size=(120, 80)):
     Helper function to load and resize company logo
     Returns None if logo doesn't exist or fails to load
     """
+    from PIL import Image
     try:
         if os.path.exists(logo_path):
             logo = Image.open(logo_path)
@@ -208,7 +194,7 @@ def load_company_logo(logo_path, size=(120, 80)):
             logo = logo.resize(size, Image.Resampling.LANCZOS)
             return logo
     except Exception as e:
-        print(f"Failed to load logo {logo_path}: {e}")
+        log.warning("Failed to load logo %s: %s", logo_path, e)
     return None
 
 
@@ -221,6 +207,8 @@ def create_styled_qr_image(upi_url, transaction_note, company_logo_path="logo.pn
         transaction_note: Transaction reference
         company_logo_path: Path to your company logo file
     """
+    import qrcode
+    from PIL import Image
 
     # Generate QR code with higher error correction
     qr = qrcode.QRCode(
@@ -262,6 +250,7 @@ def add_company_logo_top(canvas, canvas_width, logo_path):
     """
     Add company logo at the top of the QR code
     """
+    from PIL import Image
     try:
         # Try to load company logo
         company_logo = load_company_logo(logo_path, size=(100, 100))
@@ -281,13 +270,13 @@ def add_company_logo_top(canvas, canvas_width, logo_path):
 
             # Paste the logo
             canvas.paste(company_logo, (logo_x, logo_y), company_logo)
-            print(f"[✅] Company logo added from: {logo_path}")
+            log.debug("Company logo added from: %s", logo_path)
         else:
             # Fallback: Add company name as text
             add_company_text_fallback(canvas, canvas_width)
 
     except Exception as e:
-        print(f"[⚠️] Error adding company logo: {e}")
+        log.warning("Error adding company logo: %s", e)
         # Fallback to text
         add_company_text_fallback(canvas, canvas_width)
 
@@ -296,6 +285,7 @@ def add_company_text_fallback(canvas, canvas_width):
     """
     Fallback function to add company name as text if logo fails
     """
+    from PIL import ImageDraw, ImageFont
     try:
         draw = ImageDraw.Draw(canvas)
         try:
@@ -311,10 +301,10 @@ def add_company_text_fallback(canvas, canvas_width):
         name_x = (canvas_width - name_width) // 2
         draw.text((name_x, 30), company_name, font=title_font, fill="black")
 
-        print("[⚠️] Using text fallback for company branding")
+        log.warning("Using text fallback for company branding")
 
     except Exception as e:
-        print(f"[❌] Error in text fallback: {e}")
+        log.error("Error in text fallback: %s", e)
 
 
 def add_upi_brand_logos(canvas, canvas_width, start_y):
@@ -322,6 +312,7 @@ def add_upi_brand_logos(canvas, canvas_width, start_y):
     Add UPI brand logos at the bottom of the QR code
     Uses actual logo images from the same folder
     """
+    from PIL import Image, ImageDraw, ImageFont
     draw = ImageDraw.Draw(canvas)
     try:
         small_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 9)
@@ -385,7 +376,7 @@ def add_upi_brand_logos(canvas, canvas_width, start_y):
             text_y = y + (logo_height - text_height) // 2
 
             draw.text((text_x, text_y), upi_name, font=medium_font, fill="#333")
-            print(f"[⚠️] Logo not found: {logo_path}, using placeholder")
+            log.warning("Logo not found: %s, using placeholder", logo_path)
 
     except Exception as e:
         # Error handling: draw placeholder if image loading fails
@@ -400,18 +391,13 @@ def add_upi_brand_logos(canvas, canvas_width, start_y):
         text_y = y + (logo_height - text_height) // 2
 
         draw.text((text_x, text_y), upi_name, font=medium_font, fill="#333")
-        print(f"[❌] Error loading logo {upi_logo['logo_file']}: {e}")
+        log.error("Error loading logo %s: %s", upi_logo['logo_file'], e)
 
-    print("[✅] UPI brand logo added")
+    log.debug("UPI brand logo added")
 
 
 def upload_image_to_whatsapp(image_path):
     """Fixed version with proper MIME type handling"""
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/media"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-
     # Determine MIME type properly
     if image_path.lower().endswith('.png'):
         mime_type = "image/png"
@@ -422,82 +408,58 @@ def upload_image_to_whatsapp(image_path):
 
     try:
         with open(image_path, 'rb') as image_file:
-            files = {
-                'file': (os.path.basename(image_path), image_file, mime_type)
-            }
-            data = {
-                "messaging_product": "whatsapp"
-            }
-
-            response = requests.post(url, headers=headers, files=files, data=data)
+            response = upload_media(os.path.basename(image_path), image_file, mime_type)
 
         if response.status_code == 200:
             media_id = response.json().get("id")
-            print(f"[✅] Uploaded image with media ID: {media_id}")
+            log.info("Uploaded image with media ID: %s", media_id, extra=sample())
             return media_id
         else:
-            print(f"[❌] Failed to upload image: {response.text}")
+            log.error("Failed to upload image: %s", response.text)
             return None
     except Exception as e:
-        print(f"[❌] Exception during image upload: {e}")
+        log.error("Exception during image upload: %s", e)
         return None
 
 
 def test_access_token():
     """Test if access token has required permissions"""
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
+    try:
+        response = get_phone_number()
+    except requests.RequestException as e:
+        log.error("Access token check failed: %s", e)
+        return False
 
-    response = requests.get(url, headers=headers)
     if response.status_code == 200:
-        print("✅ Access token is valid and has permissions")
+        log.info("Access token is valid and has permissions")
         return True
     else:
-        print(f"❌ Access token issue: {response.text}")
+        log.error("Access token issue: %s", response.text)
         return False
 
 
 def send_whatsapp_text(phone_id, message):
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": phone_id,
-        "type": "text",
-        "text": {"body": message}
-    }
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+    try:
+        response = send_message(phone_id, "text", {"body": message})
+    except requests.RequestException as e:
+        log.error("Failed to send text message: %s", e)
+        return None
 
-    response = requests.post(url, json=payload, headers=headers)
     if response.status_code != 200:
-        print(f"❌ Failed to send text message: {response.text}")
+        log.error("Failed to send text message: %s", response.text)
     else:
-        print("✅ Text message sent successfully")
+        log.info("Text message sent successfully", extra=sample())
 
     return response
 
 
 def send_whatsapp_image_with_media_id(to_number, media_id, caption):
     """Send image using already uploaded media ID"""
-    message_url = f'https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages'
-    message_headers = {
-        'Authorization': f'Bearer {ACCESS_TOKEN}',
-        'Content-Type': 'application/json'
-    }
-    message_data = {
-        "messaging_product": "whatsapp",
-        "to": to_number,
-        "type": "image",
-        "image": {
-            "id": media_id,
-            "caption": caption
-        }
-    }
-
-    message_response = requests.post(message_url, headers=message_headers, json=message_data)
+    message_response = send_message(to_number, "image", {"id": media_id, "caption": caption})
     if message_response.status_code != 200:
-        print(f"[❌] Failed to send message: {message_response.text}")
+        log.error("Failed to send message: %s", message_response.text)
     else:
-        print("[✅] Image message sent successfully.")
+        log.info("Image message sent successfully.", extra=sample())
 
 
 def send_whatsapp_image(to_number, image_path, caption):
@@ -507,16 +469,16 @@ def send_whatsapp_image(to_number, image_path, caption):
         media_id = upload_image_to_whatsapp(image_path)
 
         if not media_id:
-            print("[❌] Failed to upload image, cannot send message")
+            log.error("Failed to upload image, cannot send message")
             send_whatsapp_text(to_number, "❌ Failed to generate QR code. Please try again.")
             return
 
         # Then send the message with the media ID
         send_whatsapp_image_with_media_id(to_number, media_id, caption)
-        print(f"[📤] Image sent to {to_number}")
+        log.info("Image sent to %s", mask_phone(to_number), extra=sample())
 
     except Exception as e:
-        print(f"[❌] Error in send_whatsapp_image: {e}")
+        log.error("Error in send_whatsapp_image: %s", e)
         send_whatsapp_text(to_number, "❌ Failed to send QR code. Please try again.")
 
 
@@ -531,13 +493,14 @@ def generate_and_upload_qr(sender_id):
         # Create UPI URL (always uses merchant UPI from config)
         upi_url = create_upi_url(transaction_note)
 
-        print(f"[🔍] Payment Code: {payment_code}")
-        print(f"[🏷️] Transaction Note: {transaction_note}")
-        print(f"[🔗] UPI URL: {upi_url}")
+        # Only the ID: the payment code also holds the customer's name, email and number
+        log.debug("Payment code: %s", payment_code.get('unique_id') if payment_code else None)
+        log.debug("Transaction Note: %s", transaction_note)
+        log.debug("UPI URL: %s", upi_url)
 
         # Update payment status in Firestore to indicate QR was generated
         if payment_code and payment_code.get('unique_id'):
-            update_payment_status_in_firestore(payment_code['unique_id'], 'qr_generated')
+            update_payment_status_in_storage(payment_code['unique_id'], 'qr_generated')
 
         # Create QR code with company logo on top and UPI brands at bottom
         # Make sure you have a logo.png file in your project directory
@@ -550,9 +513,10 @@ def generate_and_upload_qr(sender_id):
 
         # Save the QR image
         qr_img.save(temp_file.name, 'PNG')
-        print(f"[📁] QR image saved to: {temp_file.name}")
+        log.debug("QR image saved to: %s", temp_file.name)
 
         # Create caption with payment code info from Firestore
+        upi_config = get_config().upi_config
         if payment_code:
             # Calculate time remaining
             expires_at = payment_code.get('expires_at', '')
@@ -578,19 +542,19 @@ def generate_and_upload_qr(sender_id):
                 f"*🔥 LegionEdge Payment*\n"
                 f"👤 Customer: {payment_code.get('customer_name', 'N/A')}\n"
                 f"📧 Email: {payment_code.get('email', 'N/A')}\n"
-                f"💰 Amount: ₹{UPI_CONFIG['amount']}\n"
+                f"💰 Amount: ₹{upi_config['amount']}\n"
                 f"⏰ Valid till: {expires_at}{time_remaining}\n"
                 f"🆔 Payment ID: {payment_code.get('unique_id', 'N/A')}\n\n"
                 f"📱 Scan & pay via any UPI app\n"
-                f"💳 Payment to: {UPI_CONFIG['name']}\n"
+                f"💳 Payment to: {upi_config['name']}\n"
                 f"✅ Payment will be verified automatically.\n\n"
                 f"🔥 *Powered by Firestore Database*"
             )
         else:
             caption = (
                 f"*🔥 LegionEdge Payment*\n"
-                f"💰 Amount: ₹{UPI_CONFIG['amount']}\n"
-                f"👤 Payee: {UPI_CONFIG['name']}\n"
+                f"💰 Amount: ₹{upi_config['amount']}\n"
+                f"👤 Payee: {upi_config['name']}\n"
                 f"🔖 TXN: {transaction_note}\n\n"
                 f"📱 Scan & pay via any UPI app\n"
                 f"✅ Payment will be verified automatically.\n\n"
@@ -603,12 +567,12 @@ def generate_and_upload_qr(sender_id):
         # Clean up temporary file
         try:
             os.unlink(temp_file.name)
-            print(f"[🗑️] Cleaned up temp file: {temp_file.name}")
+            log.debug("Cleaned up temp file: %s", temp_file.name)
         except Exception as cleanup_error:
-            print(f"[⚠️] Could not clean up temp file: {cleanup_error}")
+            log.warning("Could not clean up temp file: %s", cleanup_error)
 
     except Exception as e:
-        print(f"[❌] Error in generate_and_upload_qr: {e}")
+        log.error("Error in generate_and_upload_qr: %s", e)
         send_whatsapp_text(sender_id, "❌ Failed to generate QR code. Please try again.")
 
 
@@ -639,25 +603,36 @@ def webhook_logic(data):
             else:
                 send_whatsapp_text(sender_id, "🔄 Generating QR code... (no active payment found)")
 
-            threading.Thread(target=generate_and_upload_qr, args=(sender_id,)).start()
+            threading.Thread(target=generate_and_upload_qr, args=(sender_id,), name=QR_THREAD_NAME).start()
         else:
             send_whatsapp_text(sender_id, "👋 Send 'pay' to get payment QR code.")
 
     return 'EVENT_RECEIVED', 200
 
 
+def webhook_sender(data):
+    """WhatsApp number that sent the first message of a webhook call, if any"""
+    try:
+        return data["entry"][0]["changes"][0]["value"]["messages"][0]["from"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+# Webhook calls all come from Meta's servers, so they are limited per sender rather than per IP;
+# Meta redelivers events that get a 429 or 503
 @app.route('/webhook', methods=['GET', 'POST'])
+@admission.limited(per_ip=False, number=webhook_sender)
 def webhook():
     if request.method == 'GET':
         mode = request.args.get("hub.mode")
         token = request.args.get("hub.verify_token")
         challenge = request.args.get("hub.challenge")
 
-        if mode == "subscribe" and token == VERIFY_TOKEN:
-            print("✅ Webhook verified.")
+        if mode == "subscribe" and token == get_config().verify_token:
+            log.info("Webhook verified.")
             return challenge, 200
         else:
-            print("❌ Webhook verification failed.")
+            log.error("Webhook verification failed.")
             return "Verification failed", 403
 
     elif request.method == 'POST':
@@ -665,10 +640,34 @@ def webhook():
         try:
             return webhook_logic(data)
         except Exception as e:
-            print(f"❌ Error processing webhook: {e}")
+            log.error("Error processing webhook: %s", e)
             return "ERROR", 500
 
 
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup():
+    """Create this worker's storage client and Graph API session and import the QR libraries now
+
+    503 when something could not be set up.
+    """
+    report = clients.warm_up()
+    ready = all(client['ready'] for client in report.values())
+    return jsonify({'ready': ready, 'pid': os.getpid(), 'clients': report}), 200 if ready else 503
+
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is serving requests (no I/O)"""
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+
+@app.route('/readyz')
+def readyz():
+    """Readiness from the cached dependency checks in health.py; 503 when a critical one is failing"""
+    ready, checks = health.readiness()
+    return jsonify({'ready': ready, 'pid': os.getpid(), 'checks': checks}), 200 if ready else 503
+
+
 @app.route('/')
 def home():
     return "🤖 LegionEdge WhatsApp Bot is running with Firestore integration! 🔥"
@@ -693,31 +692,30 @@ def status():
         return """
         <h2>⚠️ WhatsApp Bot Status</h2>
         <p>No active payment code found in Firestore</p>
-        <p><strong>Database:</strong> 🔥 Firestore (Connected: """ + str(FIRESTORE_ENABLED) + ")</p>"
+        <p><strong>Database:</strong> 🔥 """ + (storage.describe() if STORAGE_ENABLED else "Not connected") + "</p>"
 
 
 @app.route('/firestore-test')
 def firestore_test():
     """Test Firestore connection"""
-    if not FIRESTORE_ENABLED:
-        return "❌ Firestore not enabled. Please configure Firebase Admin SDK."
+    if not STORAGE_ENABLED:
+        return "❌ Storage not enabled. Please configure Firebase Admin SDK or set STORAGE_BACKEND=sqlite."
 
     try:
         # Try to read from payment_requests collection
-        docs = db.collection('payment_requests').limit(5).stream()
-        count = 0
-        for doc in docs:
-            count += 1
+        docs, _ = storage.page(5)
+        count = len(docs)
 
-        return f"✅ Firestore connection successful! Found {count} payment requests."
+        return f"✅ {storage.describe()} connection successful! Found {count} payment requests."
     except Exception as e:
-        return f"❌ Firestore connection error: {e}"
+        return f"❌ Storage connection error: {e}"
 
 
 if __name__ == '__main__':
     print("🚀 WhatsApp Bot running with Firestore integration:")
-    print(f"💳 UPI: {UPI_CONFIG['upi_id']}, Name: {UPI_CONFIG['name']}, Amount: ₹{UPI_CONFIG['amount']}")
-    print(f"🔥 Firestore: {'✅ Enabled' if FIRESTORE_ENABLED else '❌ Disabled'}")
+    upi_config = get_config().upi_config
+    print(f"💳 UPI: {upi_config['upi_id']}, Name: {upi_config['name']}, Amount: ₹{upi_config['amount']}")
+    print(f"🔥 Storage: {'✅ ' + storage.describe() if STORAGE_ENABLED else '❌ Disabled'}")
 
     # Test access token before starting
     if test_access_token():
@@ -732,12 +730,12 @@ if __name__ == '__main__':
         print(f"📧 Email: {payment_code.get('email', 'N/A')}")
         print(f"📱 WhatsApp: {payment_code.get('whatsapp', 'N/A')}")
         print(f"⏰ Expires: {payment_code.get('expires_at', 'N/A')}")
-        print(f"🔥 Source: Firestore Database")
+        print(f"🔥 Source: {storage.name if STORAGE_ENABLED else 'payment code store'}")
     else:
         print("⚠️ No active payment code found in Firestore - using default settings")
 
-    if not FIRESTORE_ENABLED:
-        print("\n⚠️ FIRESTORE SETUP REQUIRED:")
+    if not STORAGE_ENABLED:
+        print("\n⚠️ FIRESTORE SETUP REQUIRED (or run locally with STORAGE_BACKEND=sqlite):")
         print("   1. Install: pip install firebase-admin")
         print("   2. Download service account key from Firebase Console")
         print("   3. Set GOOGLE_APPLICATION_CREDENTIALS environment variable")
@@ -748,6 +746,10 @@ if __name__ == '__main__':
     print("   - http://localhost:5001/ - Home page")
     print("   - http://localhost:5001/status - Current payment status")
     print("   - http://localhost:5001/firestore-test - Test Firestore connection")
+    print("   - http://localhost:5001/metrics - Prometheus metrics")
+    print("   - http://localhost:5001/warmup - Create clients ahead of the first message")
+    print("   - http://localhost:5001/healthz - Liveness probe")
+    print("   - http://localhost:5001/readyz - Readiness of storage and the Graph API (cached)")
     print("=" * 60)
 
     app.run(debug=True, port=5001)  # Changed to port 5001
\ No newline at end of file
@@ -0,0 +1,106 @@
+# clients.py - per-process registry of lazily created clients, shared by the payment server and the WhatsApp bot
+#
+# Modules register a factory at import time instead of connecting. Each client
+# is created on its first get() in a process, or up front by warm_up() (called
+# from gunicorn's post_worker_init hook and GET /warmup). Nothing created before
+# a fork is handed to the child: gunicorn workers forked from a preloaded app
+# start with an empty registry and create their own gRPC channels and sessions.
+import os
+import threading
+import time
+
+import metrics
+from structured_logging import get_logger
+
+log = get_logger("clients")
+
+_factories = {}
+_warm = []
+_clients = {}
+_locks = {}
+_init_seconds = {}
+_registry_lock = threading.Lock()
+
+
+def register(name, factory, warm=True):
+    """Register how to create a client; factory() runs on the first get(name) in each process
+
+    warm=False keeps the client out of warm_up(), e.g. when it has to be
+    created on a running event loop.
+    """
+    with _registry_lock:
+        _factories[name] = factory
+        _locks.setdefault(name, threading.Lock())
+        if warm and name not in _warm:
+            _warm.append(name)
+
+
+def get(name):
+    """The named client of this process, created on first use
+
+    Raises whatever the factory raises; the next call tries again.
+    """
+    try:
+        return _clients[name]
+    except KeyError:
+        pass
+
+    with _locks[name]:
+        if name not in _clients:
+            start = time.perf_counter()
+            _clients[name] = _factories[name]()
+            _init_seconds[name] = time.perf_counter() - start
+            log.info("Created %s client in %.3f s", name, _init_seconds[name])
+        return _clients[name]
+
+
+def peek(name):
+    """The named client if this process has already created it, else None; never creates it
+
+    For event loop code, which must not run a blocking factory.
+    """
+    return _clients.get(name)
+
+
+def warm_up(names=None):
+    """Create the registered clients now instead of on the first request
+
+    Returns {name: {'ready': bool, 'init_seconds': float or None[, 'error': str]}}.
+    """
+    report = {}
+    for name in names or list(_warm):
+        try:
+            get(name)
+            report[name] = {'ready': True, 'init_seconds': round(_init_seconds[name], 4)}
+        except Exception as e:
+            log.warning("Warm-up of %s failed: %s", name, e)
+            report[name] = {'ready': False, 'init_seconds': None, 'error': str(e)}
+    return report
+
+
+def reset():
+    """Forget every client of this process (called in a forked child; clients are not closed)"""
+    global _registry_lock
+    _clients.clear()
+    _init_seconds.clear()
+    _registry_lock = threading.Lock()
+    for name in _locks:
+        _locks[name] = threading.Lock()
+
+
+class LazyClient:
+    """Stand-in for a registered client: attribute access goes to this process's instance"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(get(self._name), attr)
+
+
+# A parent's gRPC channels, sockets and held locks must never be used by a forked child
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
+
+metrics.gauge('client_init_seconds', 'Seconds this process took to create each lazily initialized client',
+              lambda: {(name,): seconds for name, seconds in _init_seconds.items()}, labelnames=['client'])
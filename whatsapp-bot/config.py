@@ -32,8 +32,8 @@ def get_firebase_credentials():
             return None
     return None
 
-# Current Payment Code - Auto Updated by Payment Server
-CURRENT_PAYMENT_CODE = {}
+# The current payment code lives in payment_code_store.py (PAYMENT_CODE_FILE),
+# not in this file
 
 # 📝 IMPORTANT:
 # The real values are set as ENVIRONMENT VARIABLES in Railway/Render dashboard
@@ -0,0 +1,165 @@
+# graph_client.py - pooled keep-alive Graph API client shared by the payment server and the WhatsApp bot
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+import clients
+from config_loader import get_config
+from metrics import observe_dependency
+
+GRAPH_API_BASE = os.getenv("GRAPH_API_BASE", "https://graph.facebook.com/v19.0")
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "20"))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "3.05"))
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", "10"))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "3"))
+GRAPH_BACKOFF_FACTOR = float(os.getenv("GRAPH_BACKOFF_FACTOR", "0.5"))
+
+# Rate limiting and server errors are retried; Retry-After is honored for 429 and 503
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# POST (e.g. /messages) is not idempotent: it is only retried when the request
+# was never sent (connect errors) or was rejected unprocessed (429), never after
+# a read timeout or a 5xx, which may follow a message that was delivered
+POST_RETRY_STATUSES = (429,)
+# Longest Retry-After honored; a longer one is shortened to this
+GRAPH_MAX_RETRY_AFTER = float(os.getenv("GRAPH_MAX_RETRY_AFTER", "5"))
+# Seconds spent on backoff and further attempts after the first one fails. With
+# the timeouts above a send then finishes well within the outbox lease
+# (OUTBOX_LEASE_SECONDS, 60 s), so no second sender claims it meanwhile.
+GRAPH_RETRY_BUDGET = float(os.getenv("GRAPH_RETRY_BUDGET", "40"))
+
+_latency_lock = threading.Lock()
+_latency = {}
+
+
+class GraphRetry(Retry):
+    """Retry that keeps POST retries safe and gives up once GRAPH_RETRY_BUDGET is spent"""
+
+    deadline = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.deadline = self.deadline
+        return retry
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == "POST":
+            return bool(self.total) and status_code in POST_RETRY_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, GRAPH_MAX_RETRY_AFTER)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        now = time.monotonic()
+        if retry.deadline is None:
+            retry.deadline = now + GRAPH_RETRY_BUDGET
+        wait = retry.get_backoff_time()
+        if response is not None:
+            wait = max(wait, retry.get_retry_after(response) or 0)
+        if now + wait + GRAPH_CONNECT_TIMEOUT + GRAPH_READ_TIMEOUT > retry.deadline:
+            raise MaxRetryError(_pool, url, error or ResponseError("Graph API retry budget exhausted"))
+        return retry
+
+
+def _create_session():
+    retry = GraphRetry(
+        total=GRAPH_MAX_RETRIES,
+        status_forcelist=RETRY_STATUSES,
+        # Only GET is retried after a read error or a 5xx; see POST_RETRY_STATUSES
+        allowed_methods=frozenset(["GET"]),
+        backoff_factor=GRAPH_BACKOFF_FACTOR,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=GRAPH_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+clients.register("graph_session", _create_session)
+
+
+def get_session():
+    """Per-process Session with a sized keep-alive pool (re-created after a fork)"""
+    return clients.get("graph_session")
+
+
+def _record_latency(operation, seconds, error):
+    observe_dependency("graph", operation, seconds, error)
+    with _latency_lock:
+        stats = _latency.get(operation)
+        if stats is None:
+            stats = _latency[operation] = {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        if error:
+            stats["errors"] += 1
+
+
+def get_latency_stats():
+    """Per-operation call count, error count, mean and max latency for this process"""
+    with _latency_lock:
+        return {
+            operation: {
+                **stats,
+                "mean_seconds": stats["total_seconds"] / stats["count"] if stats["count"] else 0.0,
+            }
+            for operation, stats in _latency.items()
+        }
+
+
+def graph_request(method, path, operation, **kwargs):
+    """Call the Graph API with the shared session, default timeouts and latency tracking
+
+    `path` is relative to GRAPH_API_BASE and `operation` labels the latency
+    stats. Raises requests.RequestException on connection errors and timeouts.
+    """
+    headers = {"Authorization": f"Bearer {get_config().access_token}", **kwargs.pop("headers", {})}
+    kwargs.setdefault("timeout", (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT))
+
+    start = time.perf_counter()
+    try:
+        response = get_session().request(method, f"{GRAPH_API_BASE}/{path}", headers=headers, **kwargs)
+    except requests.RequestException:
+        _record_latency(operation, time.perf_counter() - start, error=True)
+        raise
+
+    _record_latency(operation, time.perf_counter() - start, error=response.status_code >= 400)
+    return response
+
+
+def send_message(to_number, message_type, content):
+    """Send a WhatsApp message, e.g. send_message(to, "text", {"body": "..."})"""
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to_number,
+        "type": message_type,
+        message_type: content
+    }
+    return graph_request("POST", f"{get_config().phone_number_id}/messages", "messages", json=payload)
+
+
+def upload_media(filename, file_obj, mime_type):
+    """Upload media for later use in a message"""
+    return graph_request(
+        "POST",
+        f"{get_config().phone_number_id}/media",
+        "media",
+        files={"file": (filename, file_obj, mime_type)},
+        data={"messaging_product": "whatsapp"}
+    )
+
+
+def get_phone_number():
+    """Fetch the configured phone number; used to check the access token"""
+    return graph_request("GET", get_config().phone_number_id, "phone_number")
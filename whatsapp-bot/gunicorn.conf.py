@@ -0,0 +1,37 @@
+# gunicorn.conf.py - read automatically when gunicorn starts in this directory
+#
+#     gunicorn app:app
+#
+# The app is imported once in the master and workers are forked from it, so
+# they share the imported code copy-on-write. That is safe because clients
+# (Firestore, Graph API session) and background threads are created per
+# process: the registry in clients.py is emptied in every forked worker and
+# post_worker_init creates the worker's clients before it accepts requests.
+import os
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+# Create clients in post_worker_init instead of on the first request
+warm_up_workers = os.getenv("WARM_UP_WORKERS", "1") == "1"
+
+
+def post_fork(server, worker):
+    # Also done by the fork handler in clients.py; explicit so a preloaded master's clients are never reused
+    clients = sys.modules.get("clients")
+    if clients is not None:
+        clients.reset()
+
+
+def post_worker_init(worker):
+    if not warm_up_workers:
+        return
+    import clients
+    for name, client in clients.warm_up().items():
+        if client['ready']:
+            worker.log.info("Worker %s: %s ready in %.3f s", worker.pid, name, client['init_seconds'])
+        else:
+            worker.log.warning("Worker %s: %s could not be created: %s", worker.pid, name, client['error'])
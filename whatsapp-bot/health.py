@@ -0,0 +1,161 @@
+# health.py - liveness and cached dependency readiness, shared by the payment server and the WhatsApp bot
+#
+# GET /healthz only proves the process is serving. GET /readyz reports the
+# last result of each dependency check. Background threads in each process run
+# the checks every HEALTH_PROBE_INTERVAL seconds, so a load balancer can probe
+# as often as it likes without touching Firestore or the Graph API, and an
+# outage shows up within one interval.
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import metrics
+from structured_logging import get_logger
+
+log = get_logger("health")
+
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "10"))
+# A result older than this counts as failed (the prober is stuck or dead)
+HEALTH_PROBE_TTL = float(os.getenv("HEALTH_PROBE_TTL", str(HEALTH_PROBE_INTERVAL * 3)))
+# How long the first /readyz of a process waits for every check to report once
+HEALTH_FIRST_PROBE_WAIT = float(os.getenv("HEALTH_FIRST_PROBE_WAIT", "5"))
+# Document read by the storage check; it does not have to exist
+HEALTH_PROBE_ID = "__readyz__"
+
+_checks = {}
+_results = {}
+_lock = threading.Lock()
+_start_lock = threading.Lock()
+_first_round = threading.Event()
+_thread_pid = None
+
+
+def register_check(name, check, critical=True):
+    """Probe a dependency with check(), which raises or returns False when it is unavailable
+
+    A failing critical check makes /readyz return 503; other checks are only reported.
+    """
+    _checks[name] = (check, critical)
+
+
+def check_storage(storage):
+    """A storage check: one point read by document ID (storage None: storage is not available)"""
+    def check():
+        if storage is None:
+            raise RuntimeError("Storage not available")
+        storage.get_request(HEALTH_PROBE_ID)
+    return check
+
+
+def check_graph():
+    """Graph API check: fetch the configured phone number, which also proves the access token works"""
+    from graph_client import get_phone_number
+
+    response = get_phone_number()
+    if response.status_code != 200:
+        raise RuntimeError(f"Graph API returned HTTP {response.status_code}")
+
+
+def probe(name):
+    """Run one check and cache its result"""
+    check, _ = _checks[name]
+    started = time.perf_counter()
+    try:
+        error = None if check() is not False else "check failed"
+    except Exception as e:
+        error = str(e) or type(e).__name__
+    result = {'ok': error is None, 'latency_seconds': round(time.perf_counter() - started, 4),
+              'checked_at': time.time()}
+    if error is not None:
+        result['error'] = error
+
+    with _lock:
+        previous = _results.get(name)
+        _results[name] = result
+        if len(_results) >= len(_checks):
+            _first_round.set()
+    if previous is None or previous['ok'] != result['ok']:
+        if error is None:
+            log.info("Dependency %s is available", name)
+        else:
+            log.warning("Dependency %s is unavailable: %s", name, error)
+
+
+def start():
+    """Start one prober thread per check in this process (again after a fork)
+
+    Separate threads keep a dependency that hangs until its timeout from
+    delaying the results of the others.
+    """
+    global _thread_pid
+    if _thread_pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread_pid == os.getpid():
+            return
+        for name in list(_checks):
+            threading.Thread(target=_loop, args=(name,), name=f"health-prober-{name}", daemon=True).start()
+        _thread_pid = os.getpid()
+
+
+def _loop(name):
+    while True:
+        try:
+            probe(name)
+        except Exception as e:
+            log.warning("Health probe of %s failed: %s", name, e)
+        time.sleep(HEALTH_PROBE_INTERVAL)
+
+
+def readiness():
+    """(ready, {name: cached result}) without doing any I/O once the first probe has finished
+
+    The first call in a process starts the probers and waits up to
+    HEALTH_FIRST_PROBE_WAIT seconds for every check to report once.
+    """
+    start()
+    _first_round.wait(HEALTH_FIRST_PROBE_WAIT)
+
+    now = time.time()
+    checks = {}
+    ready = True
+    with _lock:
+        results = dict(_results)
+    for name, (_, critical) in _checks.items():
+        result = dict(results.get(name) or {'ok': False, 'latency_seconds': None, 'checked_at': None,
+                                             'error': 'not probed yet'})
+        if result['checked_at'] is not None:
+            age = now - result['checked_at']
+            if age > HEALTH_PROBE_TTL:
+                result['ok'] = False
+                result['error'] = f"stale result ({age:.0f} s old)"
+            result['age_seconds'] = round(age, 1)
+            result['checked_at'] = datetime.fromtimestamp(result['checked_at'], timezone.utc).isoformat()
+        result['critical'] = critical
+        checks[name] = result
+        if critical and not result['ok']:
+            ready = False
+    return ready, checks
+
+
+def _reset():
+    """Forget the parent's results and locks in a forked child (its prober threads did not survive the fork)"""
+    global _lock, _start_lock, _first_round
+    _results.clear()
+    _lock = threading.Lock()
+    _start_lock = threading.Lock()
+    _first_round = threading.Event()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def _dependency_up():
+    with _lock:
+        return {(name,): 1 if result['ok'] else 0 for name, result in _results.items()}
+
+
+metrics.gauge('dependency_up', 'Whether the last readiness probe of each dependency succeeded (1) or failed (0)',
+              _dependency_up, labelnames=['dependency'])
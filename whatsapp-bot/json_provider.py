@@ -0,0 +1,85 @@
+# json_provider.py - JSON encoding and decoding for both services: orjson when installed, else the stdlib
+#
+# jsonify(), request.get_json() (webhooks and API bodies) and the aiohttp
+# server's responses all go through dumps()/loads(), so both servers produce
+# the same bytes for the same payload and ETags match. Output is compact with
+# sorted keys and UTF-8 text, whichever encoder is used. Datetimes (including
+# Firestore's DatetimeWithNanoseconds) become ISO 8601 strings and bytes
+# become base64.
+import base64
+import dataclasses
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:  # stdlib json, same output but slower
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def default(value):
+    """Encode the types neither encoder handles natively (orjson already does datetimes, UUIDs and dataclasses)"""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, "ToDatetime"):  # protobuf Timestamp
+        return value.ToDatetime(tzinfo=datetime.timezone.utc).isoformat()
+    if hasattr(value, "__html__"):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_bytes(obj, sort_keys=True, indent=None):
+    """obj as UTF-8 encoded JSON"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option)
+    return stdlib_dumps(obj, sort_keys, indent).encode("utf-8")
+
+
+def dumps(obj, sort_keys=True, indent=None):
+    """obj as a JSON str"""
+    if orjson is not None:
+        return dumps_bytes(obj, sort_keys, indent).decode("utf-8")
+    return stdlib_dumps(obj, sort_keys, indent)
+
+
+def stdlib_dumps(obj, sort_keys=True, indent=None):
+    """dumps() with the stdlib encoder, used when orjson is not installed"""
+    separators = (",", ":") if indent is None else (",", ": ")
+    return json.dumps(obj, default=default, sort_keys=sort_keys, indent=indent, separators=separators,
+                      ensure_ascii=False)
+
+
+def loads(data):
+    """Parse JSON from str or bytes; raises ValueError when it is invalid"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def install(app):
+    """Make dumps()/loads() the JSON provider of a Flask app (jsonify, request.get_json, app.json)"""
+    from flask.json.provider import DefaultJSONProvider
+
+    class FastJSONProvider(DefaultJSONProvider):
+        def dumps(self, obj, **kwargs):
+            return dumps(obj, sort_keys=kwargs.get("sort_keys", self.sort_keys), indent=kwargs.get("indent"))
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+    app.json = FastJSONProvider(app)
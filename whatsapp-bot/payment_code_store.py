@@ -0,0 +1,59 @@
+# payment_code_store.py - current payment code shared by the payment server and the WhatsApp bot
+import json
+import os
+import tempfile
+import threading
+
+# The payment server writes this file and the bot reads it.
+# Point both services at the same path with PAYMENT_CODE_FILE.
+PAYMENT_CODE_FILE = os.getenv("PAYMENT_CODE_FILE", "current_payment_code.json")
+
+_lock = threading.Lock()
+_cache = {"version": None, "value": {}}
+
+
+def _file_version(stat_result):
+    """Identify one write of the file; a rename always brings a new inode"""
+    return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+
+def save_current_payment_code(payment_code):
+    """Atomically replace the current payment code (write a temp file, then rename)"""
+    directory = os.path.dirname(os.path.abspath(PAYMENT_CODE_FILE))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".payment_code_", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(payment_code, f)
+            f.flush()
+            os.fsync(f.fileno())
+            version = _file_version(os.fstat(f.fileno()))
+        os.replace(temp_path, PAYMENT_CODE_FILE)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+    with _lock:
+        _cache["version"] = version
+        _cache["value"] = dict(payment_code)
+
+
+def get_current_payment_code():
+    """Get the current payment code from memory, re-reading the file only after it changed
+
+    Returns an empty dict when no payment code has been saved yet.
+    """
+    try:
+        version = _file_version(os.stat(PAYMENT_CODE_FILE))
+    except FileNotFoundError:
+        return {}
+
+    with _lock:
+        if version != _cache["version"]:
+            with open(PAYMENT_CODE_FILE, "r") as f:
+                _cache["value"] = json.load(f)
+            _cache["version"] = version
+        return dict(_cache["value"])
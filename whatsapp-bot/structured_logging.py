@@ -0,0 +1,163 @@
+# structured_logging.py - non-blocking JSON logging shared by the payment server and the WhatsApp bot
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# LOG_LEVEL is the default; LOG_LEVELS overrides it per logger, e.g. "graph_client=WARNING,outbox=DEBUG"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# json (one object per line) or text (for a terminal)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Default share of high-volume lines (marked with extra=sample()) that are written
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+# Records beyond this many waiting for the writer thread are dropped, never blocking the caller
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# LogRecord attributes that are not user-supplied extra fields
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample_rate"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, plus any extra= fields"""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a record with probability record.sample_rate (set through extra=sample(rate))"""
+
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never formats or blocks on the calling thread
+
+    Formatting and writing happen on the listener thread. When the queue is
+    full the record is dropped and counted.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Merge args now (they may change later) but leave JSON encoding to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+_lock = threading.Lock()
+_state = {"handler": None, "listener": None}
+
+
+def _apply_levels():
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def _start_listener():
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    _state["handler"].queue = log_queue
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    _state["listener"] = listener
+
+
+def _restart_in_child():
+    """The writer thread does not survive a fork (e.g. gunicorn workers); start a fresh one"""
+    if _state["handler"] is not None:
+        _state["handler"].queue = None
+        _start_listener()
+
+
+def configure():
+    """Route all logging through the queue to a background writer thread (idempotent)"""
+    if _state["handler"] is not None:
+        return
+    with _lock:
+        if _state["handler"] is not None:
+            return
+        handler = DroppingQueueHandler(None)
+        handler.addFilter(SamplingFilter())
+        _state["handler"] = handler
+        _start_listener()
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        _apply_levels()
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_restart_in_child)
+        atexit.register(_flush)
+
+
+def _flush():
+    listener = _state["listener"]
+    if listener is not None:
+        listener.stop()
+        _state["listener"] = None
+
+
+def get_logger(name):
+    """Logger for a module; configures the queue and writer thread on first use"""
+    configure()
+    return logging.getLogger(name)
+
+
+def sample(rate=None, **fields):
+    """extra= for a high-volume line: logged with probability `rate` (default LOG_SAMPLE_RATE)"""
+    return {"sample_rate": LOG_SAMPLE_RATE if rate is None else rate, **fields}
+
+
+def dropped_records():
+    """Records dropped because the writer thread could not keep up"""
+    return DroppingQueueHandler.dropped
+
+
+def mask_phone(number):
+    """Phone number reduced to its last four digits, for logs"""
+    digits = "".join(ch for ch in str(number or "") if ch.isdigit())
+    return f"***{digits[-4:]}" if digits else ""